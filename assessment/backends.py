@@ -0,0 +1,263 @@
+from functools import cache
+
+from loguru import logger
+import numpy as np
+import pandas as pd
+
+from assessment.config import (
+    BACKEND_THREADS,
+    DUCKDB_MEMORY_LIMIT,
+    DUCKDB_TEMP_DIR,
+    MIMIC_DATE_FORMAT,
+    MIMIC_DATETIME_FORMAT,
+    USE_HOSP_CACHE,
+)
+from assessment.datasets import (
+    HOSP_DATE_COLUMNS,
+    HOSP_TABLE_SCHEMAS,
+    LABEVENTS_DTYPES,
+    LABEVENTS_FEATURE_COLUMNS,
+    build_table_cache,
+    iter_labevents_chunks,
+    load_hosp_table,
+)
+from assessment.profiling import record_chunk
+
+try:
+    import duckdb
+    HAS_DUCKDB = True
+except ModuleNotFoundError:
+    HAS_DUCKDB = False
+
+try:
+    import polars as pl
+    HAS_POLARS = True
+except ModuleNotFoundError:
+    HAS_POLARS = False
+
+
+# Execution backends of the feature families. They run the relational part of a family (scan of the
+# source table, filter on the cohort admissions or lab items, projection) and hand pandas DataFrames
+# typed like the pandas reader to the feature definitions, so every backend gives the same features.
+# The joins and aggregations of the feature definitions themselves still run in pandas on those frames,
+# they are not expressed as engine plans yet. Rows come in any order: the aggregations do not depend
+# on it (ties of the last lab value are broken on the value, see lab_accumulators).
+# pandas is the reference.
+
+# DuckDB types of the HOSP_TABLE_SCHEMAS dtypes
+DUCKDB_TYPES = {
+    'int8': 'TINYINT', 'int16': 'SMALLINT', 'int32': 'INTEGER', 'Int32': 'INTEGER', 'float32': 'FLOAT',
+    'float64': 'DOUBLE', 'str': 'VARCHAR', 'category': 'VARCHAR',
+}
+
+
+def _sql_str(value) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _unique_ids(ids):
+    return pd.unique(np.asarray(ids))
+
+
+def _csv_columns(source_path) -> list:
+    return list(pd.read_csv(source_path, nrows=0).columns)
+
+
+def _as_table_dtypes(df, table) -> pd.DataFrame:
+    """
+    `df` read by an engine with the pandas dtypes of HOSP_TABLE_SCHEMAS (categories, nullable ids, ns datetimes).
+    """
+    schema = HOSP_TABLE_SCHEMAS[table]
+    dtypes = {col: schema['dtype'][col] for col in df.columns if schema['dtype'].get(col, 'str') != 'str'}
+    dtypes.update({col: 'datetime64[ns]' for col in schema['datetimes'] if col in df.columns})
+    return df.astype(dtypes)
+
+
+def _as_labevents_dtypes(chunk) -> pd.DataFrame:
+    """
+    Labevents chunk read by an engine with LABEVENTS_DTYPES, charttime already parsed.
+    """
+    dtypes = {col: LABEVENTS_DTYPES[col] for col in chunk.columns if col != 'charttime'}
+    return chunk.astype({**dtypes, 'charttime': 'datetime64[ns]'})
+
+
+class PandasBackend:
+    """
+    Reference backend: the typed readers of assessment.datasets, filtered in pandas.
+    """
+
+    name = 'pandas'
+
+    def load_table(self, table, source_path, usecols = None, subject_ids = None, hadm_ids = None) -> pd.DataFrame:
+        """
+        Rows of the hosp table `table` of `subject_ids` and `hadm_ids` when given, only `usecols` when given.
+        """
+        df = load_hosp_table(table, source_path, usecols, subject_ids)
+        if hadm_ids is not None:
+            df = df[df['hadm_id'].isin(_unique_ids(hadm_ids))].reset_index(drop=True)
+        logger.info(f"Loaded {len(df)} rows of {table} with the {self.name} backend")
+        return df
+
+    def iter_labevents_chunks(self, labevents_path, itemids, subject_ids, chunksize = 100000):
+        """
+        Lab events of `itemids` and `subject_ids` with a value, in chunks of LABEVENTS_FEATURE_COLUMNS.
+        """
+        for chunk in iter_labevents_chunks(labevents_path, itemids=itemids, subject_ids=subject_ids,
+                                           chunksize=chunksize):
+            yield chunk[chunk['valuenum'].notna()]
+
+
+class DuckDBBackend:
+    """
+    Runs the scans and filters as DuckDB queries: projections and filters are pushed into the parquet
+    cache or csv scan, scans use `threads` cores and spill to `temp_dir` beyond `memory_limit`.
+    """
+
+    name = 'duckdb'
+
+    def __init__(self, threads = BACKEND_THREADS, memory_limit = DUCKDB_MEMORY_LIMIT, temp_dir = DUCKDB_TEMP_DIR):
+        temp_dir.mkdir(parents=True, exist_ok=True)
+        self._con = duckdb.connect()
+        self._con.execute(f"SET threads = {int(threads)}")
+        self._con.execute(f"SET memory_limit = {_sql_str(memory_limit)}")
+        self._con.execute(f"SET temp_directory = {_sql_str(temp_dir)}")
+        # The features do not depend on the row order, scans and joins may stream rows in any order
+        self._con.execute("SET preserve_insertion_order = false")
+
+    def _scan(self, table, source_path) -> str:
+        """
+        Table function scanning `table`, its columnar cache when available.
+        """
+        cache_path = build_table_cache(table, source_path) if USE_HOSP_CACHE else None
+        if cache_path is not None:
+            return f"read_parquet({_sql_str(cache_path)})"
+        schema = HOSP_TABLE_SCHEMAS[table]
+        types = {col: 'TIMESTAMP' if col in schema['datetimes'] else DUCKDB_TYPES[schema['dtype'].get(col, 'str')]
+                 for col in _csv_columns(source_path)}
+        types_sql = ', '.join(f"{_sql_str(col)}: {_sql_str(sql_type)}" for col, sql_type in types.items())
+        return f"read_csv({_sql_str(source_path)}, header = true, types = {{{types_sql}}})"
+
+    def _query(self, scan, columns, filters, conditions = ()):
+        """
+        SELECT `columns` FROM `scan` WHERE every Dict[column] = ids of `filters` (None: no filter) matches,
+        and every SQL condition of `conditions`. The id sets are registered as tables and joined by the engine,
+        rows come out in the order the scan threads produce them.
+        """
+        conditions, registered = list(conditions), []
+        for col, ids in filters.items():
+            if ids is None:
+                continue
+            name = f"{col}_filter"
+            self._con.register(name, pd.DataFrame({col: _unique_ids(ids)}))
+            registered.append(name)
+            conditions.append(f'"{col}" IN (SELECT "{col}" FROM {name})')
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        select = ', '.join(f'"{col}"' for col in columns) if columns is not None else '*'
+        return f"SELECT {select} FROM {scan}{where}", registered
+
+    def _unregister(self, names):
+        for name in names:
+            self._con.unregister(name)
+
+    def load_table(self, table, source_path, usecols = None, subject_ids = None, hadm_ids = None) -> pd.DataFrame:
+        sql, registered = self._query(self._scan(table, source_path), usecols,
+                                      {'subject_id': subject_ids, 'hadm_id': hadm_ids})
+        try:
+            df = _as_table_dtypes(self._con.execute(sql).df(), table)
+        finally:
+            self._unregister(registered)
+        logger.info(f"Loaded {len(df)} rows of {table} with the {self.name} backend")
+        return df
+
+    def iter_labevents_chunks(self, labevents_path, itemids, subject_ids, chunksize = 100000):
+        types = {'subject_id': 'INTEGER', 'hadm_id': 'INTEGER', 'itemid': 'INTEGER', 'valuenum': 'DOUBLE',
+                 'charttime': 'TIMESTAMP'}
+        types_sql = ', '.join(f"{_sql_str(col)}: {_sql_str(sql_type)}" for col, sql_type in types.items())
+        scan = f"read_csv({_sql_str(labevents_path)}, header = true, types = {{{types_sql}}})"
+        sql, registered = self._query(scan, LABEVENTS_FEATURE_COLUMNS,
+                                      {'itemid': list(itemids), 'subject_id': subject_ids},
+                                      conditions=['valuenum IS NOT NULL'])
+        try:
+            # Handed over as Arrow record batches of `chunksize` events (to_arrow_reader since duckdb 1.5)
+            result = self._con.execute(sql)
+            reader = getattr(result, 'to_arrow_reader', None) or result.fetch_record_batch
+            for batch in reader(chunksize):
+                record_chunk(batch.num_rows)
+                yield _as_labevents_dtypes(batch.to_pandas())
+        finally:
+            self._unregister(registered)
+
+
+class PolarsBackend:
+    """
+    Runs the scans and filters as Polars lazy frames: projections and filters are pushed into the
+    parquet cache or csv scan, which runs on the streaming engine over all cores (polars >= 1.34).
+    """
+
+    name = 'polars'
+
+    def _scan(self, table, source_path):
+        cache_path = build_table_cache(table, source_path) if USE_HOSP_CACHE else None
+        if cache_path is not None:
+            return pl.scan_parquet(cache_path)
+        schema = HOSP_TABLE_SCHEMAS[table]
+        polars_types = {
+            'int8': pl.Int8, 'int16': pl.Int16, 'int32': pl.Int32, 'Int32': pl.Int32, 'float32': pl.Float32,
+            'float64': pl.Float64, 'str': pl.Utf8, 'category': pl.Utf8,
+        }
+        columns = _csv_columns(source_path)
+        types = {col: pl.Utf8 if col in schema['datetimes'] else polars_types[schema['dtype'].get(col, 'str')]
+                 for col in columns}
+        datetimes = [
+            pl.col(col).str.to_datetime(MIMIC_DATE_FORMAT if col in HOSP_DATE_COLUMNS else MIMIC_DATETIME_FORMAT,
+                                        time_unit='ns', strict=False)
+            for col in schema['datetimes'] if col in columns
+        ]
+        return pl.scan_csv(source_path, schema_overrides=types).with_columns(datetimes)
+
+    @staticmethod
+    def _filter(frame, filters):
+        for col, ids in filters.items():
+            if ids is not None:
+                frame = frame.filter(pl.col(col).is_in(pl.Series(_unique_ids(ids)).implode()))
+        return frame
+
+    def load_table(self, table, source_path, usecols = None, subject_ids = None, hadm_ids = None) -> pd.DataFrame:
+        frame = self._filter(self._scan(table, source_path), {'subject_id': subject_ids, 'hadm_id': hadm_ids})
+        if usecols is not None:
+            frame = frame.select(usecols)
+        df = _as_table_dtypes(frame.collect(engine='streaming').to_pandas(), table)
+        logger.info(f"Loaded {len(df)} rows of {table} with the {self.name} backend")
+        return df
+
+    def iter_labevents_chunks(self, labevents_path, itemids, subject_ids, chunksize = 100000):
+        types = {'subject_id': pl.Int32, 'hadm_id': pl.Int32, 'itemid': pl.Int32, 'valuenum': pl.Float64,
+                 'charttime': pl.Utf8}
+        frame = self._filter(pl.scan_csv(labevents_path, schema_overrides=types),
+                             {'itemid': list(itemids), 'subject_id': subject_ids})
+        events = (frame.filter(pl.col('valuenum').is_not_null())
+                  .select(LABEVENTS_FEATURE_COLUMNS)
+                  .with_columns(pl.col('charttime').str.to_datetime(MIMIC_DATETIME_FORMAT, time_unit='ns',
+                                                                    strict=False)))
+        # Streamed in batches of `chunksize` events, the filtered events are never all in memory
+        for chunk in events.collect_batches(chunk_size=chunksize, engine='streaming'):
+            record_chunk(len(chunk))
+            yield _as_labevents_dtypes(chunk.to_pandas())
+
+
+BACKENDS = {'pandas': PandasBackend, 'duckdb': DuckDBBackend, 'polars': PolarsBackend}
+_INSTALLED = {'pandas': True, 'duckdb': HAS_DUCKDB, 'polars': HAS_POLARS}
+
+
+@cache
+def get_backend(name):
+    """
+    Execution backend `name` ('pandas', 'duckdb' or 'polars'), one per process.
+    Falls back to pandas when the engine is not installed.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name}, expected one of {list(BACKENDS)}")
+    if not _INSTALLED[name]:
+        logger.warning(f"{name} is not installed, the feature families run on the pandas backend")
+        name = 'pandas'
+    return BACKENDS[name]()
@@ -0,0 +1,123 @@
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+
+class CodeClassifier:
+    """
+    Base of the code classifiers: maps strings to label bitmasks, one bit per label.
+    Masks use the smallest unsigned integer dtype holding every label bit.
+    Subclasses implement classify_unique.
+    """
+
+    def __init__(self, labels):
+        if len(labels) > 64:
+            raise ValueError(f"At most 64 labels fit in a label mask, got {len(labels)}")
+        self.labels = list(labels)
+        self.bits = {label: 1 << i for i, label in enumerate(self.labels)}
+        self.mask_dtype = np.min_scalar_type((1 << max(len(self.labels), 1)) - 1)
+
+    def classify_unique(self, codes) -> np.ndarray:
+        """
+        Label mask of each code in `codes` (distinct strings).
+        """
+        raise NotImplementedError
+
+    def classify(self, codes) -> np.ndarray:
+        """
+        Label mask of every code of the `codes` Series, missing codes get 0.
+        Each distinct code is classified once.
+        """
+        values, uniques = pd.factorize(codes)
+        masks = np.append(self.classify_unique(np.asarray(uniques)), 0).astype(self.mask_dtype)
+        # factorize marks missing values with -1, which picks the trailing 0
+        return masks[values]
+
+    def flags(self, codes) -> pd.DataFrame:
+        """
+        One boolean column per label telling whether each code of `codes` has it.
+        """
+        masks = self.classify(codes)
+        return pd.DataFrame({label: (masks & bit) != 0 for label, bit in self.bits.items()}, index=codes.index)
+
+
+class PrefixClassifier(CodeClassifier):
+    """
+    Compiled lookup of code prefixes, e.g. ICD_CONDITION_MAP.
+    prefix_map: Dict[label] = list of code prefixes
+
+    A code gets the bit of every label having a prefix of the code, found with one hash
+    lookup per distinct prefix length.
+    """
+
+    def __init__(self, prefix_map):
+        super().__init__(prefix_map)
+
+        # Dict[prefix length] = Dict[prefix] = mask of the labels having that prefix
+        self._prefixes = {}
+        for label, prefixes in prefix_map.items():
+            for prefix in prefixes:
+                by_prefix = self._prefixes.setdefault(len(prefix), {})
+                by_prefix[prefix] = by_prefix.get(prefix, 0) | self.bits[label]
+
+    def classify_unique(self, codes) -> np.ndarray:
+        codes = pd.Series(codes, dtype='object').astype(str)
+        masks = np.zeros(len(codes), dtype='uint64')
+        for length, by_prefix in self._prefixes.items():
+            masks |= codes.str[:length].map(by_prefix).fillna(0).to_numpy(dtype='uint64')
+        return masks
+
+
+class KeywordClassifier(CodeClassifier):
+    """
+    Case-insensitive substring matcher, e.g. DRUG_CLASS_MAP.
+    keyword_map: Dict[label] = list of keywords
+
+    All keywords are compiled into one Aho-Corasick automaton, so a string is scanned once
+    whatever the number of keywords, and gets the bit of every label with a keyword in it.
+    """
+
+    def __init__(self, keyword_map):
+        super().__init__(keyword_map)
+
+        # Trie of the keywords: goto transitions, failure links and output masks per node
+        self._goto, self._fail, self._output = [{}], [0], [0]
+        for label, keywords in keyword_map.items():
+            for keyword in keywords:
+                node = 0
+                for char in keyword.lower():
+                    if char not in self._goto[node]:
+                        self._goto[node][char] = len(self._goto)
+                        self._goto.append({})
+                        self._fail.append(0)
+                        self._output.append(0)
+                    node = self._goto[node][char]
+                self._output[node] |= self.bits[label]
+
+        # Failure links in breadth-first order, a node also outputs the matches of its failure node
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] |= self._output[self._fail[child]]
+
+    def match(self, text) -> int:
+        """
+        Label mask of one string.
+        """
+        node, mask = 0, 0
+        for char in text.lower():
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            mask |= self._output[node]
+        return mask
+
+    def classify_unique(self, codes) -> np.ndarray:
+        return np.fromiter((self.match(str(code)) for code in codes), dtype='uint64', count=len(codes))
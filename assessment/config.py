@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -10,13 +11,30 @@ load_dotenv()
 PROJ_ROOT = Path(__file__).resolve().parents[1]
 # logger.info(f"PROJ_ROOT path is: {PROJ_ROOT}")
 
-DATA_DIR = PROJ_ROOT / "data"
+# DATA_DIR can be pointed elsewhere from the environment, e.g. at synthetic tables for benchmarks
+DATA_DIR = Path(os.getenv("DATA_DIR", PROJ_ROOT / "data"))
 RAW_DATA_DIR = DATA_DIR / "raw"
 INTERIM_DATA_DIR = DATA_DIR / "interim"
 PROCESSED_DATA_DIR = DATA_DIR / "processed"
 EXTERNAL_DATA_DIR = DATA_DIR / "external"
 
 PROCESSED_HOSP_DATA_DIR = PROCESSED_DATA_DIR / "hosp/"
+# All hosp feature tables joined on subject_id (suffix of OUTPUT_FORMAT)
+MERGED_HOSP_FEATURES_PATH = PROCESSED_DATA_DIR / "hosp_ttl"
+# Save it compacted (see assessment.feature_dtypes): integer columns (flags, counts, ids) as the smallest
+# integer type, nullable when values are missing, float columns (stats) as float32 and columns with at least
+# COMPACT_SPARSE_NAN_SHARE missing values as sparse, with a dtype manifest.
+# A sparse float32 value also stores its int32 position, so it only saves memory below half the rows.
+COMPACT_FEATURES = False
+COMPACT_SPARSE_NAN_SHARE = 0.5
+
+# Format of the pipeline outputs (see assessment.outputs): 'csv', 'parquet' or 'feather', compressed with
+# OUTPUT_COMPRESSION when set ('gzip', 'zstd', ... for csv, 'zstd', 'gzip', ... for parquet and feather).
+# They are saved by a background thread, at most OUTPUT_QUEUE_SIZE frames wait to be written.
+# csv is what the notebooks read, parquet is several times faster to write and read back.
+OUTPUT_FORMAT = "csv"
+OUTPUT_COMPRESSION = None
+OUTPUT_QUEUE_SIZE = 4
 
 MODELS_DIR = PROJ_ROOT / "models"
 
@@ -29,6 +47,10 @@ MIMIC_DATA_DIR = RAW_DATA_DIR / "mimiciv/2.1/"
 MIMIC_HOSP_DATA_DIR = MIMIC_DATA_DIR / "hosp/"
 MIMIC_ICU_DATA_DIR = MIMIC_DATA_DIR / "icu/"
 
+# Synthetic hosp tables for load tests (see assessment.synthetic), run the pipeline on them with DATA_DIR=SYNTHETIC_DATA_DIR
+SYNTHETIC_DATA_DIR = DATA_DIR / "synthetic"
+SYNTHETIC_HOSP_DATA_DIR = SYNTHETIC_DATA_DIR / MIMIC_HOSP_DATA_DIR.relative_to(DATA_DIR)
+
 # GENERIC MIMIC IV DATA
 ADMISSIONS_PATH = MIMIC_HOSP_DATA_DIR / "admissions.csv"
 PATIENTS_PATH = MIMIC_HOSP_DATA_DIR / "patients.csv"
@@ -40,6 +62,55 @@ LABEVENTS_PATH = MIMIC_HOSP_DATA_DIR / "labevents.csv"
 D_LABITEMS_PATH = MIMIC_HOSP_DATA_DIR / "d_labitems.csv"
 PRESCRIPTIONS_PATH = MIMIC_HOSP_DATA_DIR / "prescriptions.csv"
 
+# Typed columnar (parquet) cache of the hosp tables, rebuilt when the raw csv changes
+HOSP_CACHE_DIR = INTERIM_DATA_DIR / "hosp_cache"
+USE_HOSP_CACHE = True
+# Rows per chunk when streaming a raw hosp csv
+HOSP_READ_CHUNKSIZE = 250000
+
+# Timestamp layouts of the MIMIC-IV csv files (charttime, admittime, ...) and of the date columns (dod, chartdate)
+MIMIC_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+MIMIC_DATE_FORMAT = "%Y-%m-%d"
+# Distinct timestamp strings kept parsed across chunks by assessment.timestamps (about 150 bytes each)
+TIMESTAMP_CACHE_SIZE = 200000
+
+# Chunk reader for labevents: 'pyarrow', 'pandas' or 'auto' (pyarrow when installed)
+LABEVENTS_READER_ENGINE = "auto"
+
+# labevents hash-partitioned by subject_id, for building lab features on several cores
+LABEVENTS_SHARD_DIR = INTERIM_DATA_DIR / "labevents_shards"
+LABEVENTS_N_SHARDS = 64
+LAB_FEATURE_WORKERS = os.cpu_count() or 1
+
+# Feature families run in parallel by the pipeline scheduler (each family is a process)
+PIPELINE_WORKERS = min(5, os.cpu_count() or 1)
+# Cores of the lab stage shard pool while the other feature families run next to it. The lab scan
+# outlasts them, so it is sized for the whole machine rather than an equal share
+LAB_STAGE_CPU_BUDGET = os.cpu_count() or 1
+
+# Stage outputs keyed by a hash of their inputs, config values and code, reused when nothing changed
+USE_STAGE_CACHE = True
+STAGE_CACHE_DIR = INTERIM_DATA_DIR / "stage_cache"
+STAGE_CACHE_KEEP = 3
+
+# Per stage profiling: JSON run reports, and cProfile stats of every stage when PROFILE_CPROFILE is set
+RUN_REPORTS_DIR = REPORTS_DIR / "runs"
+PROFILE_CPROFILE = os.getenv("PROFILE_CPROFILE", "0") == "1"
+
+# labevents sorted by (subject_id, charttime) with per subject offsets, for single patient lookups
+LABEVENTS_INDEX_DIR = INTERIM_DATA_DIR / "labevents_index"
+
+# Incremental lab features: accumulator state and labevents high-water mark kept between runs
+LAB_FEATURES_INCREMENTAL = False
+LAB_FEATURES_STATE_DIR = INTERIM_DATA_DIR / "lab_features_state"
+
+# Engine running the scans and filters of the feature families: 'pandas' (reference), 'duckdb' or 'polars'
+FEATURE_BACKEND = os.getenv("FEATURE_BACKEND", "pandas")
+BACKEND_THREADS = os.cpu_count() or 1
+# DuckDB spills to DUCKDB_TEMP_DIR beyond DUCKDB_MEMORY_LIMIT
+DUCKDB_MEMORY_LIMIT = "4GB"
+DUCKDB_TEMP_DIR = INTERIM_DATA_DIR / "duckdb_tmp"
+
 # ICU SPECIFIC MIMIC IV DATA
 
 
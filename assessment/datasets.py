@@ -1,32 +1,269 @@
-from pathlib import Path
+import json
+import os
 
 from loguru import logger
-from tqdm import tqdm
-
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+from tqdm import tqdm
 
 from assessment.config import (
-    PROCESSED_DATA_DIR, RAW_DATA_DIR, INTERIM_DATA_DIR, ADMISSIONS_PATH, PATIENTS_PATH, DIAGNOSES_ICD_PATH,
-    PROCEDURES_ICD_PATH, LABEVENTS_PATH, D_LABITEMS_PATH, PRESCRIPTIONS_PATH
+    ADMISSIONS_PATH,
+    D_LABITEMS_PATH,
+    DIAGNOSES_ICD_PATH,
+    HOSP_CACHE_DIR,
+    HOSP_READ_CHUNKSIZE,
+    INTERIM_DATA_DIR,
+    LABEVENTS_PATH,
+    LABEVENTS_READER_ENGINE,
+    PATIENTS_PATH,
+    PRESCRIPTIONS_PATH,
+    PROCEDURES_ICD_PATH,
+    USE_HOSP_CACHE,
 )
+from assessment.profiling import record_chunk
+from assessment.timestamps import parse_dates, parse_timestamps
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ModuleNotFoundError:
+    HAS_PYARROW = False
+
+
+# Bump when HOSP_TABLE_SCHEMAS changes so existing cache files are rebuilt
+HOSP_CACHE_SCHEMA_VERSION = 2
+
+# Typed schema of the hosp tables: explicit dtypes and the columns parsed as datetimes.
+# Columns that are not listed are read as text.
+HOSP_TABLE_SCHEMAS = {
+    'admissions': {
+        'dtype': {
+            'subject_id': 'int32', 'hadm_id': 'int32', 'admission_type': 'category',
+            'admit_provider_id': 'category', 'admission_location': 'category',
+            'discharge_location': 'category', 'insurance': 'category', 'language': 'category',
+            'marital_status': 'category', 'race': 'category', 'hospital_expire_flag': 'int8',
+        },
+        'datetimes': ['admittime', 'dischtime', 'deathtime', 'edregtime', 'edouttime'],
+    },
+    'patients': {
+        'dtype': {
+            'subject_id': 'int32', 'gender': 'category', 'anchor_age': 'int16', 'anchor_year': 'int16',
+            'anchor_year_group': 'category',
+        },
+        'datetimes': ['dod'],
+    },
+    'diagnoses_icd': {
+        'dtype': {
+            'subject_id': 'int32', 'hadm_id': 'Int32', 'seq_num': 'int16', 'icd_code': 'category',
+            'icd_version': 'int8',
+        },
+        'datetimes': [],
+    },
+    'procedures_icd': {
+        'dtype': {
+            'subject_id': 'int32', 'hadm_id': 'Int32', 'seq_num': 'int16', 'icd_code': 'category',
+            'icd_version': 'int8',
+        },
+        'datetimes': ['chartdate'],
+    },
+    'prescriptions': {
+        'dtype': {
+            'subject_id': 'int32', 'hadm_id': 'Int32', 'pharmacy_id': 'Int32', 'poe_id': 'str', 'poe_seq': 'Int32',
+            'order_provider_id': 'category', 'drug_type': 'category', 'drug': 'category',
+            'formulary_drug_cd': 'category', 'gsn': 'str', 'ndc': 'str', 'prod_strength': 'str',
+            'form_rx': 'category', 'dose_val_rx': 'str', 'dose_unit_rx': 'category', 'form_val_disp': 'str',
+            'form_unit_disp': 'category', 'doses_per_24_hrs': 'float32', 'route': 'category',
+        },
+        'datetimes': ['starttime', 'stoptime'],
+    },
+    'd_labitems': {
+        'dtype': {'itemid': 'int32', 'label': 'str', 'fluid': 'category', 'category': 'category'},
+        'datetimes': [],
+    },
+}
+
+# Datetime columns of HOSP_TABLE_SCHEMAS holding a date only (MIMIC_DATE_FORMAT)
+HOSP_DATE_COLUMNS = ['dod', 'chartdate']
+
+# Projection and dtypes of the labevents columns read by the lab feature families.
+# charttime is left as text and parsed by the consumer.
+LABEVENTS_DTYPES = {
+    'subject_id': 'int32', 'hadm_id': 'Int32', 'itemid': 'int32', 'charttime': 'str', 'valuenum': 'float64',
+}
+LABEVENTS_FEATURE_COLUMNS = list(LABEVENTS_DTYPES)
+
+
+def source_fingerprint(source_path) -> dict:
+    """
+    Identify the version of a raw csv by its size and modification time.
+    """
+    stat = os.stat(source_path)
+    return {
+        'source': str(source_path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'schema_version': HOSP_CACHE_SCHEMA_VERSION,
+    }
+
+
+def _cache_paths(table):
+    return HOSP_CACHE_DIR / f"{table}.parquet", HOSP_CACHE_DIR / f"{table}.meta.json"
+
+
+def _is_cache_fresh(table, source_path) -> bool:
+    cache_path, meta_path = _cache_paths(table)
+    if not cache_path.exists() or not meta_path.exists():
+        return False
+    return json.loads(meta_path.read_text()) == source_fingerprint(source_path)
 
 
-def load_admissions_data() -> pd.DataFrame:
+def iter_raw_table_chunks(table, source_path, usecols=None, subject_ids=None, chunksize=HOSP_READ_CHUNKSIZE):
+    """
+    Stream a raw MIMIC hosp csv in chunks typed with HOSP_TABLE_SCHEMAS, holding only the
+    columns in `usecols` and, when `subject_ids` is given, only the rows of those subjects.
+    Memory is bounded by one raw chunk plus the rows kept.
+    """
+    schema = HOSP_TABLE_SCHEMAS[table]
+    columns = list(pd.read_csv(source_path, nrows=0).columns)
+    if usecols is not None:
+        columns = [col for col in columns if col in usecols]
+    read_columns = columns if subject_ids is None or 'subject_id' in columns else columns + ['subject_id']
+    if subject_ids is not None:
+        subject_ids = pd.unique(np.asarray(subject_ids))
+
+    dtype = {col: schema['dtype'].get(col, 'str') for col in read_columns if col not in schema['datetimes']}
+    for chunk in pd.read_csv(source_path, usecols=read_columns, dtype=dtype, chunksize=chunksize):
+        record_chunk(len(chunk))
+        if subject_ids is not None:
+            chunk = chunk[chunk['subject_id'].isin(subject_ids)]
+        datetimes = {col: parse_dates(chunk[col]) if col in HOSP_DATE_COLUMNS else parse_timestamps(chunk[col])
+                     for col in schema['datetimes'] if col in columns}
+        yield chunk[columns].assign(**datetimes)
+
+
+def concat_chunks(chunks) -> pd.DataFrame:
+    """
+    Concatenate typed chunks. Category columns stay categorical over the union of the chunk categories.
+    """
+    chunks = list(chunks)
+    for col in chunks[0].select_dtypes('category').columns:
+        categories = union_categoricals([chunk[col] for chunk in chunks]).categories
+        for chunk in chunks:
+            chunk[col] = chunk[col].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_raw_table(table, source_path, usecols=None, subject_ids=None) -> pd.DataFrame:
+    """
+    Read a raw MIMIC hosp csv with the typed schema of HOSP_TABLE_SCHEMAS, see iter_raw_table_chunks.
+    """
+    return concat_chunks(iter_raw_table_chunks(table, source_path, usecols, subject_ids))
+
+
+def _arrow_schema(table, chunk):
+    """
+    Arrow schema of a hosp table cache file, fixed by HOSP_TABLE_SCHEMAS so that every chunk
+    is written with the same types.
+    """
+    import pyarrow as pa
+
+    schema = HOSP_TABLE_SCHEMAS[table]
+    arrow_types = {
+        'int8': pa.int8(), 'int16': pa.int16(), 'int32': pa.int32(), 'Int32': pa.int32(),
+        'float32': pa.float32(), 'float64': pa.float64(), 'str': pa.string(),
+        'category': pa.dictionary(pa.int32(), pa.string()),
+    }
+    fields = []
+    for col in chunk.columns:
+        if col in schema['datetimes']:
+            fields.append(pa.field(col, pa.timestamp('ns')))
+        else:
+            fields.append(pa.field(col, arrow_types[schema['dtype'].get(col, 'str')]))
+    # The pandas metadata restores the nullable and categorical dtypes on read
+    return pa.schema(fields, metadata=pa.Schema.from_pandas(chunk, preserve_index=False).metadata)
+
+
+def build_table_cache(table, source_path, force=False):
+    """
+    Convert a raw MIMIC hosp csv into its typed parquet cache file (one-time conversion).
+    Returns the cache path, or None when no parquet engine is installed.
+    """
+    if not HAS_PYARROW:
+        logger.warning(f"pyarrow is not installed, {table} is read from the raw csv")
+        return None
+
+    cache_path, meta_path = _cache_paths(table)
+    if not force and _is_cache_fresh(table, source_path):
+        return cache_path
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    logger.info(f"Building columnar cache of {table} from {source_path}")
+    HOSP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+    # Write next to the target first so an interrupted conversion never leaves a partial cache.
+    # The csv is converted chunk by chunk, one row group each.
+    tmp_path = cache_path.with_suffix(f'.parquet.{os.getpid()}.tmp')
+    writer, n_rows = None, 0
+    try:
+        for chunk in tqdm(iter_raw_table_chunks(table, source_path), desc=f"Caching {table}"):
+            if writer is None:
+                schema = _arrow_schema(table, chunk)
+                writer = pq.ParquetWriter(tmp_path, schema)
+            writer.write_table(pa.Table.from_pandas(chunk, preserve_index=False).cast(schema))
+            n_rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    os.replace(tmp_path, cache_path)
+    meta_path.write_text(json.dumps(source_fingerprint(source_path)))
+    logger.info(f"Cached {n_rows} rows of {table} to {cache_path}")
+    return cache_path
+
+
+def load_hosp_table(table, source_path, usecols=None, subject_ids=None) -> pd.DataFrame:
+    """
+    Load a MIMIC hosp table from its columnar cache, (re)building the cache when the raw csv
+    changed. Only the columns in `usecols` and the rows of `subject_ids` are read when given.
+    """
+    cache_path = build_table_cache(table, source_path) if USE_HOSP_CACHE else None
+    if cache_path is None:
+        return read_raw_table(table, source_path, usecols, subject_ids)
+    filters = None if subject_ids is None else [('subject_id', 'in', pd.unique(np.asarray(subject_ids)).tolist())]
+    return pd.read_parquet(cache_path, columns=usecols, filters=filters)
+
+
+def build_hosp_cache(force=False):
+    """
+    Convert every raw MIMIC hosp table used by the pipeline into the columnar cache.
+    """
+    sources = {
+        'admissions': ADMISSIONS_PATH, 'patients': PATIENTS_PATH, 'diagnoses_icd': DIAGNOSES_ICD_PATH,
+        'procedures_icd': PROCEDURES_ICD_PATH, 'prescriptions': PRESCRIPTIONS_PATH, 'd_labitems': D_LABITEMS_PATH,
+    }
+    for table, source_path in sources.items():
+        build_table_cache(table, source_path, force=force)
+
+
+def load_admissions_data(usecols = None) -> pd.DataFrame:
     """
     Load admissions data from the specified path.
     """
     logger.info(f"Loading admissions data from {ADMISSIONS_PATH}")
-    df = pd.read_csv(ADMISSIONS_PATH)
+    df = load_hosp_table('admissions', ADMISSIONS_PATH, usecols)
     logger.info(f"Loaded {len(df)} rows of admissions data.")
     return df
 
 
-def load_patients_data() -> pd.DataFrame:
+def load_patients_data(usecols = None) -> pd.DataFrame:
     """
     Load patients data from the specified path.
     """
     logger.info(f"Loading patients data from {PATIENTS_PATH}")
-    df = pd.read_csv(PATIENTS_PATH)
+    df = load_hosp_table('patients', PATIENTS_PATH, usecols)
     logger.info(f"Loaded {len(df)} rows of patients data.")
     return df
 
@@ -41,25 +278,25 @@ def load_cohort_data() -> pd.DataFrame:
     return df
 
 
-def load_diagnoses_data() -> pd.DataFrame:
+def load_diagnoses_data(usecols = None) -> pd.DataFrame:
     """
     Load diagnoses data from the specified path.
     """
     logger.info(f"Loading diagnoses data from {DIAGNOSES_ICD_PATH}")
-    df = pd.read_csv(DIAGNOSES_ICD_PATH)
+    df = load_hosp_table('diagnoses_icd', DIAGNOSES_ICD_PATH, usecols)
     logger.info(f"Loaded {len(df)} rows of diagnoses data.")
     return df
 
-def load_procedures_data() -> pd.DataFrame:
+def load_procedures_data(usecols = None) -> pd.DataFrame:
     """
     Load procedures data from the specified path.
     """
     logger.info(f"Loading procedures data from {PROCEDURES_ICD_PATH}")
-    df = pd.read_csv(PROCEDURES_ICD_PATH)
+    df = load_hosp_table('procedures_icd', PROCEDURES_ICD_PATH, usecols)
     logger.info(f"Loaded {len(df)} rows of procedures data.")
     return df
 
-def load_labevents_data(usecols = ['subject_id', 'hadm_id', 'itemid', 'charttime', 'valuenum']) -> pd.DataFrame:
+def load_labevents_data(usecols = LABEVENTS_FEATURE_COLUMNS) -> pd.DataFrame:
     """
     Load labevents data from the specified path.
     """
@@ -68,20 +305,98 @@ def load_labevents_data(usecols = ['subject_id', 'hadm_id', 'itemid', 'charttime
     logger.info(f"Loaded {len(df)} rows of labevents data.")
     return df
 
-def load_d_labitems_data() -> pd.DataFrame:
+def _iter_labevents_chunks_pandas(labevents_path, columns, itemids, subject_ids, chunksize, header_names):
+    dtype = {col: LABEVENTS_DTYPES[col] for col in columns if col in LABEVENTS_DTYPES}
+    header = None if header_names is not None else 'infer'
+    reader = pd.read_csv(labevents_path, header=header, names=header_names, usecols=columns, dtype=dtype,
+                         chunksize=chunksize)
+    for chunk in reader:
+        record_chunk(len(chunk))
+        if itemids is not None:
+            chunk = chunk[chunk['itemid'].isin(itemids)]
+        if subject_ids is not None:
+            chunk = chunk[chunk['subject_id'].isin(subject_ids)]
+        yield chunk[columns]
+
+
+def _iter_labevents_chunks_arrow(labevents_path, columns, itemids, subject_ids, chunksize, header_names):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+
+    arrow_types = {
+        'subject_id': pa.int32(), 'hadm_id': pa.int32(), 'itemid': pa.int32(), 'valuenum': pa.float64(),
+        'charttime': pa.timestamp('ns'),
+    }
+    reader = pa_csv.open_csv(
+        labevents_path,
+        # Roughly `chunksize` rows per block, MIMIC labevents rows are ~100-150 bytes
+        read_options=pa_csv.ReadOptions(block_size=max(chunksize * 128, 1 << 20), column_names=header_names),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=columns,
+            column_types={col: arrow_types[col] for col in columns if col in arrow_types},
+        ),
+    )
+    itemid_set = pa.array(list(itemids), pa.int32()) if itemids is not None else None
+    subject_set = pa.array(list(subject_ids), pa.int32()) if subject_ids is not None else None
+
+    for batch in reader:
+        record_chunk(batch.num_rows)
+        # Filter in Arrow so rejected rows never become pandas objects
+        if itemid_set is not None:
+            batch = batch.filter(pc.is_in(batch.column('itemid'), value_set=itemid_set))
+        if subject_set is not None:
+            batch = batch.filter(pc.is_in(batch.column('subject_id'), value_set=subject_set))
+        chunk = batch.to_pandas()[columns]
+        # Arrow converts nullable integers to float, restore the declared pandas dtypes
+        yield chunk.astype({col: LABEVENTS_DTYPES[col] for col in columns if col in LABEVENTS_DTYPES
+                            and col != 'charttime'})
+
+
+def iter_labevents_chunks(labevents_path = LABEVENTS_PATH, columns = LABEVENTS_FEATURE_COLUMNS, itemids = None,
+                          subject_ids = None, chunksize=100000, engine = LABEVENTS_READER_ENGINE,
+                          header_names = None):
+    """
+    Stream labevents in chunks holding only `columns`, parsed with LABEVENTS_DTYPES.
+    Rows are restricted to `itemids` and `subject_ids` when given.
+
+    labevents_path: path or binary file object. With `header_names` the source has no header
+                    row, e.g. a byte range in the middle of labevents.csv.
+
+    engine: 'pyarrow' (streaming Arrow csv reader, rows filtered before conversion to pandas),
+            'pandas', or 'auto' for pyarrow when it is installed.
+    """
+    columns = list(columns)
+    if engine == 'auto':
+        engine = 'pyarrow' if HAS_PYARROW else 'pandas'
+    if engine == 'pyarrow':
+        return _iter_labevents_chunks_arrow(labevents_path, columns, itemids, subject_ids, chunksize, header_names)
+    if engine == 'pandas':
+        return _iter_labevents_chunks_pandas(labevents_path, columns, itemids, subject_ids, chunksize, header_names)
+    raise ValueError(f"Unknown labevents reader engine: {engine}")
+
+
+def load_d_labitems_data(usecols = None) -> pd.DataFrame:
     """
     Load d_labitems data from the specified path.
     """
     logger.info(f"Loading d_labitems data from {D_LABITEMS_PATH}")
-    df = pd.read_csv(D_LABITEMS_PATH)
+    df = load_hosp_table('d_labitems', D_LABITEMS_PATH, usecols)
     logger.info(f"Loaded {len(df)} rows of d_labitems data.")
     return df
 
-def load_prescriptions_data(usecols = ['hadm_id', 'drug', 'route', 'starttime', 'stoptime']) -> pd.DataFrame:
+def load_prescriptions_data(usecols = ('subject_id', 'hadm_id', 'drug', 'route', 'starttime', 'stoptime'),
+                            subject_ids = None) -> pd.DataFrame:
     """
-    Load prescriptions data from the specified path.
+    Load prescriptions data from the specified path, only the rows of `subject_ids` when given.
+    The table is streamed, so memory is bounded by the rows and columns kept.
     """
     logger.info(f"Loading prescriptions data from {PRESCRIPTIONS_PATH}")
-    df = pd.read_csv(PRESCRIPTIONS_PATH)
+    usecols = list(usecols) if usecols is not None else None
+    df = load_hosp_table('prescriptions', PRESCRIPTIONS_PATH, usecols, subject_ids)
     logger.info(f"Loaded {len(df)} rows of prescriptions data.")
-    return df
\ No newline at end of file
+    return df
+
+
+if __name__ == "__main__":
+    build_hosp_cache()
@@ -0,0 +1,128 @@
+import json
+from pathlib import Path
+
+from loguru import logger
+import numpy as np
+import pandas as pd
+import typer
+
+from assessment.config import COMPACT_SPARSE_NAN_SHARE, PROCESSED_HOSP_DATA_DIR
+from assessment.outputs import OutputWriter, output_format, output_path, read_output
+from assessment.timestamps import parse_timestamps
+
+app = typer.Typer()
+
+
+def manifest_path(path) -> Path:
+    """
+    Dtype manifest saved next to the compacted table `path`, e.g. hosp_ttl.parquet.dtypes.json.
+    """
+    path = Path(path)
+    return path.with_name(f"{path.name}.dtypes.json")
+
+
+# Integers above 2**24 are not all exact in float32
+FLOAT32_EXACT_INT_MAX = 2**24
+
+
+def _nullable_integer_dtype(values) -> str:
+    """
+    Smallest nullable integer dtype (Int8 ... Int64) holding the whole numbers of `values`.
+    """
+    values = values.dropna().astype('int64')
+    return str(pd.to_numeric(values, downcast='integer').dtype).capitalize() if len(values) else 'Int8'
+
+
+def _is_whole(values) -> bool:
+    values = values.dropna()
+    return bool(np.isfinite(values).all() and (values == np.round(values)).all())
+
+
+def compact_dtypes(df, sparse_nan_share = COMPACT_SPARSE_NAN_SHARE) -> dict:
+    """
+    Compact dtype of every numeric column of `df`, e.g. {'flag_history_on_insulin': 'int8'}:
+    - integer columns (flags, counts, ids) as the smallest integer type that fits, nullable (Int32, ...)
+      when values are missing
+    - ids (`*_id`) and whole numbers of at least 2**24, which float32 would round, as nullable integers
+    - float columns (stats) as float32, about 7 significant digits, even when their values are whole
+    - float32 columns with at least `sparse_nan_share` missing values (short windows of rare labs) as sparse
+    The other columns (datetimes, categories, text) keep their dtype.
+    """
+    dtypes = {}
+    for col in df.columns:
+        values = df[col]
+        if pd.api.types.is_bool_dtype(values) or not pd.api.types.is_numeric_dtype(values):
+            dtypes[col] = str(values.dtype)
+            continue
+        nan_share = values.isna().mean() if len(values) else 0
+        if pd.api.types.is_integer_dtype(values):
+            dtypes[col] = (str(pd.to_numeric(values, downcast='integer').dtype) if nan_share == 0
+                           else _nullable_integer_dtype(values))
+        elif col.endswith('_id') or (values.abs().max() >= FLOAT32_EXACT_INT_MAX and _is_whole(values)):
+            # Ids read as floats because of missing values, never rounded by float32
+            dtypes[col] = _nullable_integer_dtype(values) if _is_whole(values) else str(values.dtype)
+        elif nan_share >= sparse_nan_share:
+            dtypes[col] = str(pd.SparseDtype('float32', np.nan))
+        else:
+            dtypes[col] = 'float32'
+    return dtypes
+
+
+def compact_feature_frame(df, sparse_nan_share = COMPACT_SPARSE_NAN_SHARE):
+    """
+    `df` converted to its compact dtypes, and the dtype manifest, see compact_dtypes.
+    """
+    dtypes = compact_dtypes(df, sparse_nan_share)
+    changed = {col: dtype for col, dtype in dtypes.items() if dtype != str(df[col].dtype)}
+    return df.astype(changed), dtypes
+
+
+def save_compact_features(df, path, sparse_nan_share = COMPACT_SPARSE_NAN_SHARE, writer = None) -> Path:
+    """
+    Save the compacted `df` with its dtype manifest, in the format of `writer` (an OutputWriter, the
+    default output format when not given). Returns the path written, read it back with load_compact_features.
+    """
+    writer = writer or OutputWriter(background=False)
+    compact_df, dtypes = compact_feature_frame(df, sparse_nan_share)
+    logger.info(f"Compacted {df.shape[1]} columns from {df.memory_usage(deep=True).sum() / 2**20:.1f} MB "
+                f"to {compact_df.memory_usage(deep=True).sum() / 2**20:.1f} MB")
+
+    # Files only hold dense columns, the manifest makes the sparse ones sparse again on load
+    sparse = [col for col, dtype in dtypes.items() if dtype.startswith('Sparse')]
+    path = writer.save(compact_df.astype({col: 'float32' for col in sparse}), path)
+    manifest_path(path).write_text(json.dumps(dtypes, indent=1))
+    return path
+
+
+def load_compact_features(path) -> pd.DataFrame:
+    """
+    Load a table saved by save_compact_features with the dtypes of its manifest.
+    """
+    dtypes = json.loads(manifest_path(path).read_text())
+    if output_format(path) != 'csv':
+        df = read_output(path)
+    else:
+        # Numbers and categories are parsed straight into their dtype, datetimes with the shared parser
+        datetimes = [col for col, dtype in dtypes.items() if dtype.startswith('datetime64')]
+        read_dtypes = {col: 'float32' if dtype.startswith('Sparse') else dtype
+                       for col, dtype in dtypes.items() if col not in datetimes and dtype != 'object'}
+        df = pd.read_csv(path, dtype=read_dtypes)
+        for col in datetimes:
+            df[col] = parse_timestamps(df[col])
+    return df.astype({col: dtype for col, dtype in dtypes.items() if dtype.startswith('Sparse')})
+
+
+@app.command()
+def main(
+    input_path: Path | None = None,
+    compact_path: Path = PROCESSED_HOSP_DATA_DIR / "final_feature_df_compact",
+    sparse_nan_share: float = COMPACT_SPARSE_NAN_SHARE,
+):
+    # Merged table in the configured output format by default
+    input_path = input_path or output_path(PROCESSED_HOSP_DATA_DIR / "final_feature_df")
+    compact_path = save_compact_features(read_output(input_path), compact_path, sparse_nan_share)
+    logger.info(f"Compacted {input_path} saved to {compact_path} ({manifest_path(compact_path).name})")
+
+
+if __name__ == "__main__":
+    app()
@@ -5,31 +5,65 @@ import numpy as np
 from loguru import logger
 from tqdm import tqdm
 
-from assessment.config import PROCESSED_DATA_DIR, LAB_KEYWORDS, INTERIM_DATA_DIR, FILTER_OVER_AGE_18
+from assessment.config import (
+    PROCESSED_DATA_DIR, LAB_KEYWORDS, INTERIM_DATA_DIR, FILTER_OVER_AGE_18, ETHNICITY_MAPPING,
+    ADMISSION_TYPE_MAPPING,
+)
 from assessment.datasets import load_admissions_data, load_patients_data, load_d_labitems_data
+from assessment.profiling import profiled
+from assessment.timestamps import parse_dates, parse_timestamps
 
+# Columns of the raw tables read to build the cohort
+COHORT_ADMISSIONS_COLUMNS = [
+    'subject_id', 'hadm_id', 'admittime', 'dischtime', 'admission_type', 'admission_location',
+    'discharge_location', 'insurance', 'race',
+]
+COHORT_PATIENTS_COLUMNS = ['subject_id', 'gender', 'anchor_age', 'anchor_year', 'anchor_year_group', 'dod']
+
+COHORT_COLUMNS = [
+    'subject_id', 'hadm_id', 'admittime', 'dischtime', 'age', 'gender', 'race', 'insurance', 'label',
+    'dod', 'time_to_death', 'admission_type', 'admission_location', 'discharge_location',
+]
+
+
+def _map_categories(series, mapping) -> pd.Series:
+    """
+    Categorical copy of `series` with its values replaced through `mapping`.
+    Only the categories are looked up, the rows are relabelled through their codes.
+    Values missing from the mapping are kept, also tried without a trailing '.' ('EW EMER.').
+    """
+    series = series.astype('category')
+    categories = series.cat.categories
+    mapped = pd.Index([mapping.get(value, mapping.get(str(value).rstrip('.'), value)) for value in categories])
+    unmapped = [value for value in categories if value not in mapping and str(value).rstrip('.') not in mapping]
+    if unmapped:
+        logger.warning(f"{series.name} values without a mapping are kept as is: {unmapped}")
+
+    new_categories = pd.Index(mapped.unique())
+    new_codes = new_categories.get_indexer(mapped)
+    codes = series.cat.codes.to_numpy()
+    codes = np.where(codes >= 0, new_codes[codes], -1)
+    return pd.Series(pd.Categorical.from_codes(codes, new_categories), index=series.index, name=series.name)
 
 
 def preprocess_admissions_data(admissions_df: pd.DataFrame) -> pd.DataFrame:
     """
     Preprocess the admissions data.
     """
-    # Convert admit time and discharge time to datetime
-    admissions_df['admittime'] = pd.to_datetime(admissions_df['admittime'])
-    admissions_df['dischtime'] = pd.to_datetime(admissions_df['dischtime'])
+    admittime = parse_timestamps(admissions_df['admittime'])
+    dischtime = parse_timestamps(admissions_df['dischtime'])
 
-    # Remove columns where admit time and discharge time are null
-    admissions_df = admissions_df.dropna(subset=['admittime', 'dischtime'])
+    # Keep the stays with both times, discharged after admission (NaT comparisons are False)
+    valid = (dischtime >= admittime).to_numpy()
+    admissions_df = admissions_df.loc[valid].assign(admittime=admittime[valid], dischtime=dischtime[valid])
 
-    # Remove rows where the discharge time is before the admit time
-    admissions_df = admissions_df[admissions_df['dischtime'] >= admissions_df['admittime']]
+    # Length of stay (LOS) in whole days
+    admissions_df['los'] = ((admissions_df['dischtime'] - admissions_df['admittime']).dt.days).astype('int32')
 
-    # Create a new column for the length of stay (LOS) in hours
-    admissions_df['los'] = pd.to_timedelta(admissions_df["dischtime"] - admissions_df["admittime"], unit='h')
-    admissions_df['los'] = admissions_df['los'].astype(str)
-    admissions_df[['days', 'dummy','hours']] = admissions_df['los'].str.split(' ', expand=True)
-    admissions_df['los']=pd.to_numeric(admissions_df['days'])
-    admissions_df=admissions_df.drop(columns=['days', 'dummy','hours'])
+    # Demographics as categoricals, race and admission type grouped by the config mappings
+    admissions_df['race'] = _map_categories(admissions_df['race'], ETHNICITY_MAPPING)
+    admissions_df['admission_type'] = _map_categories(admissions_df['admission_type'], ADMISSION_TYPE_MAPPING)
+    admissions_df['insurance'] = admissions_df['insurance'].astype('category')
 
     return admissions_df
 
@@ -47,6 +81,9 @@ def preprocess_patients_data(patients_df: pd.DataFrame) -> pd.DataFrame:
     # Clip any age < 0 (data noise)
     patients_df['age'] = patients_df['age'].clip(lower=0)
 
+    patients_df['dod'] = parse_dates(patients_df['dod'])
+    patients_df['gender'] = patients_df['gender'].astype('category')
+
     return patients_df
 
 def process_cohort(merged_df: pd.DataFrame) -> pd.DataFrame:
@@ -54,52 +91,43 @@ def process_cohort(merged_df: pd.DataFrame) -> pd.DataFrame:
     """Applies labels to individual visits according to whether or not a death has occurred within
     the times of the specified admit_col and disch_col"""
 
-    cohort = merged_df.loc[(~merged_df["admittime"].isna()) & (~merged_df["dischtime"].isna())]
-    
-    cohort['label'] = 0
-    cohort['time_to_death'] = 0
-
-    pos_cohort=cohort[~cohort["dod"].isna()]
-    neg_cohort=cohort[cohort["dod"].isna()]
-    neg_cohort=neg_cohort.fillna(0)
-    pos_cohort=pos_cohort.fillna(0)
-    pos_cohort["dod"] = pd.to_datetime(pos_cohort["dod"])
+    cohort = merged_df.loc[merged_df["admittime"].notna().to_numpy() & merged_df["dischtime"].notna().to_numpy()]
+    admittime, dischtime, dod = cohort['admittime'], cohort['dischtime'], cohort['dod']
 
-    pos_cohort['label'] = np.where((pos_cohort["dod"] >= pos_cohort["admittime"]) & (pos_cohort["dod"] <= pos_cohort["dischtime"]),1,0)
-    pos_cohort['time_to_death'] = pd.to_timedelta(pos_cohort['dod'] - pos_cohort['admittime']).dt.total_seconds() / (3600 * 24)
-    
-    pos_cohort['label'] = pos_cohort['label'].astype("Int32")
-    cohort=pd.concat([pos_cohort,neg_cohort], axis=0)
-
-    cohort=cohort.sort_values(by=["subject_id","admittime"])
+    # Label the stays during which the patient died, time to death in days from admission (0 without dod)
+    label = ((dod >= admittime) & (dod <= dischtime)).to_numpy()
+    time_to_death = ((dod - admittime) / pd.Timedelta(days=1)).fillna(0).to_numpy()
 
-    logger.info(f"Positive cohort size: {cohort[cohort['label']==1].shape[0]}")
-    logger.info(f"Negative cohort size: {cohort[cohort['label']==0].shape[0]}")
+    n_positive = int(label.sum())
+    logger.info(f"Positive cohort size: {n_positive}")
+    logger.info(f"Negative cohort size: {len(cohort) - n_positive}")
     logger.info(f"Total cohort size: {len(cohort)}")
 
-
-    # Extract subject ids where label = 1
-    subject_ids = cohort[cohort['label'] == 1]['subject_id'].unique()
-    # Filter cohort to only include data for these subject ids
-    cohort = cohort[cohort['subject_id'].isin(subject_ids)] 
+    # Keep the subjects who died during one of their stays
+    keep = cohort['subject_id'].isin(cohort['subject_id'].to_numpy()[label]).to_numpy()
+    cohort = cohort.loc[keep, [col for col in COHORT_COLUMNS if col in cohort.columns]]
+    cohort['label'] = label[keep].astype('int8')
+    cohort['time_to_death'] = time_to_death[keep]
+    # Missing locations are written as 0, like the other missing values of the cohort
+    for col in ['admission_location', 'discharge_location']:
+        cohort[col] = cohort[col].cat.add_categories([0]).fillna(0)
+    cohort = cohort[COHORT_COLUMNS].sort_values(by=["subject_id", "admittime"], kind='stable')
 
     logger.info(f"Filtered cohort size with patiends that have died eventually: {len(cohort)}")
 
-    # Keep only relevant columns:
-    cohort = cohort[['subject_id', 'hadm_id', 'admittime', 'dischtime', 'age', 'gender', 'race', 'insurance', 'label', 
-                     'dod', 'time_to_death','admission_type','admission_location','discharge_location']]
-
     return cohort
 
+@profiled
 def prepare_cohort(filter_over_age_18 = FILTER_OVER_AGE_18) -> pd.DataFrame:
 
     '''
     Prepare the base dataframe by loading, preprocessing, and merging admissions and patients data.
+    Only the columns of COHORT_ADMISSIONS_COLUMNS and COHORT_PATIENTS_COLUMNS are read.
     '''
 
     # use above functions to load data
-    admissions_df = load_admissions_data()
-    patients_df = load_patients_data()
+    admissions_df = load_admissions_data(usecols=COHORT_ADMISSIONS_COLUMNS)
+    patients_df = load_patients_data(usecols=COHORT_PATIENTS_COLUMNS)
 
     logger.info(f"Loaded {len(admissions_df)} rows of admissions data.")
     logger.info(f"Loaded {len(patients_df)} rows of patients data.")
@@ -118,11 +146,11 @@ def prepare_cohort(filter_over_age_18 = FILTER_OVER_AGE_18) -> pd.DataFrame:
         logger.info(f"Filtered patients data has {len(patients_df)} rows after removing under 18.")    
     
     # Merge patient info into admissions
-    merged_df = admissions_df.merge(patients_df, on='subject_id', how='inner')
+    merged_df = admissions_df.merge(patients_df[['subject_id', 'age', 'gender', 'dod']], on='subject_id', how='inner')
 
     logger.info(f"Merged data has {len(merged_df)} rows.")
-    logger.info(f"Unique hadm_id: {len(merged_df['hadm_id'].unique())}")
-    logger.info(f"Unique subject_id: {len(merged_df['subject_id'].unique())}")
+    logger.info(f"Unique hadm_id: {merged_df['hadm_id'].nunique()}")
+    logger.info(f"Unique subject_id: {merged_df['subject_id'].nunique()}")
 
     # Process the merged dataframe
     merged_df = process_cohort(merged_df)
@@ -133,6 +161,23 @@ def prepare_cohort(filter_over_age_18 = FILTER_OVER_AGE_18) -> pd.DataFrame:
     return merged_df
 
 
+def split_prior_admissions(cohort_df):
+    """
+    Split the admissions of every subject with at least two admissions into its final
+    admission (latest admittime) and its prior admissions.
+    Returns (final_adms indexed by subject_id, prior_adms), both sorted by subject_id, admittime.
+    """
+    adms = cohort_df.sort_values(['subject_id', 'admittime'], kind='stable')
+    grouped = adms.groupby('subject_id', sort=False)
+    adms = adms[grouped['hadm_id'].transform('size') >= 2]
+
+    is_final = adms.groupby('subject_id', sort=False).cumcount(ascending=False) == 0
+    final_adms = adms[is_final].set_index('subject_id')
+    prior_adms = adms[~is_final]
+    return final_adms, prior_adms
+
+
+@profiled
 def filter_time_to_death_dataframe(base_df) -> pd.DataFrame:
     """
     Prepare the time to death dataframe using the labels from the merged dataframe. labels = 1 will be filtered. 
@@ -1,53 +1,125 @@
-from datetime import timedelta
+from functools import partial, reduce
+
 import pandas as pd
-import numpy as np
 from pathlib import Path
 
 
 from loguru import logger
-from tqdm import tqdm
 
-from assessment.config import PROCESSED_HOSP_DATA_DIR
+from assessment.config import PROCESSED_HOSP_DATA_DIR, MERGED_HOSP_FEATURES_PATH, COMPACT_FEATURES
+from assessment.feature_dtypes import save_compact_features
+from assessment.outputs import OutputWriter, output_columns, output_format, read_output
+
+
+def _indexed_on(df, on, name) -> pd.DataFrame:
+    """
+    `df` indexed on the key column `on`, which must identify its rows.
+    """
+    if df.index.name != on:
+        df = df.set_index(on)
+    if not df.index.is_unique:
+        raise ValueError(f"{name} has several rows per {on}, feature tables are merged one row per {on}")
+    return df
+
+
+def _new_columns(columns, on, merged_columns):
+    """
+    Columns of a table that no earlier table provides, e.g. hadm_id is only taken from the first table
+    that has it. They are added to `merged_columns`.
+    """
+    columns = [col for col in columns if col != on and col not in merged_columns]
+    merged_columns.update(columns)
+    return columns
+
+
+def _join_on_key(tables, on) -> pd.DataFrame:
+    """
+    Inner join of `tables` (DataFrames indexed on `on`, no column in common) in one pass:
+    every table is aligned on their sorted common keys and the columns are concatenated once.
+    """
+    keys = reduce(pd.Index.intersection, (df.index for df in tables)).sort_values()
+    merged_data = pd.concat([df.reindex(keys) for df in tables], axis=1)
+    return merged_data.reset_index()
+
 
-def process_merge_hosp_data(merged_df):
-    # Remove columns with "_x" or "_y" suffix
-    merged_df = merged_df.loc[:, ~merged_df.columns.str.endswith(('_x', '_y'))]
-    logger.info("Removed columns with '_x' or '_y' suffix")
+def _save_merged(merged_data, output_path, writer):
+    """
+    Save the merged table with `writer` (compacted when COMPACT_FEATURES is set), returns its path.
+    """
+    writer = writer or OutputWriter(background=False)
+    save = partial(save_compact_features, writer=writer) if COMPACT_FEATURES else None
+    return writer.write(merged_data, output_path, name="Merged features", save=save)
+
+
+def merge_feature_frames(named_frames, on = 'subject_id', order = None,
+                         output_path = MERGED_HOSP_FEATURES_PATH, writer = None) -> pd.DataFrame:
+    """
+    Inner-merge feature DataFrames on `on` as they arrive, e.g. from a running pipeline.
+
+    named_frames: iterable of (name, DataFrame), one row per `on`
+    order: names in the order their columns should appear, arrival order when not given.
+           A column found in several tables (hadm_id) is taken from the first one in this order.
+    Every table is joined into the running result when it arrives and is not kept afterwards.
+    The merged DataFrame is sorted on `on` and saved to `output_path` by `writer` (an OutputWriter,
+    in this thread when not given).
+    """
+    rank = {name: i for i, name in enumerate(order or [])}
+    merged, owners, n_tables = None, {}, 0
+    for name, df in named_frames:
+        logger.info(f"Merging {name} ({df.shape[0]} rows, {df.shape[1]} columns)")
+        df = _indexed_on(df, on, name)
+        table_rank = rank.setdefault(name, len(rank))
+        # Columns of this table, and those an earlier arrival holds but this table comes first for
+        columns = [col for col in df.columns if col not in owners or table_rank < owners[col][0]]
+        if len(columns) < len(df.columns):
+            logger.info(f"{name}: skipping {len(df.columns) - len(columns)} columns merged from an earlier table")
+        owners.update({col: (table_rank, position) for position, col in enumerate(df.columns) if col in columns})
 
-    return merged_df
-       
+        if merged is None:
+            merged = df[columns]
+        else:
+            # Rows missing from either side are dropped, the new columns are aligned on the kept keys
+            keys = merged.index.intersection(df.index)
+            if len(keys) < len(merged):
+                merged = merged.loc[keys]
+            merged = pd.concat([merged.drop(columns=[col for col in columns if col in merged.columns]),
+                                df[columns].reindex(merged.index)], axis=1)
+        n_tables += 1
+    if merged is None:
+        raise ValueError("No feature tables to merge")
+
+    merged_data = merged[sorted(merged.columns, key=owners.get)].sort_index().reset_index()
+    logger.info(f"Merged {n_tables} feature tables into one DataFrame {merged_data.shape}")
+
+    _save_merged(merged_data, output_path, writer)
+
+    return merged_data
 
 
 # Write a function to merge all csvs in a directory on "subject_id and saves it"
-def merge_csvs_in_dir(dir_path = PROCESSED_HOSP_DATA_DIR, on = 'subject_id') -> pd.DataFrame:
+def merge_csvs_in_dir(dir_path = PROCESSED_HOSP_DATA_DIR, on = 'subject_id',
+                      output_path = MERGED_HOSP_FEATURES_PATH, writer = None) -> pd.DataFrame:
     """
-    Merges all csv files in a directory on the specified column and saves the merged DataFrame to a csv file.
+    Merges all output files (csv, parquet, feather) in a directory, in name order, on the specified column
+    and saves the merged DataFrame. Each file is read once, with only `on` and the columns no earlier file
+    provides, and only the rows whose key is in every file read so far are kept, see merge_feature_frames.
     """
     logger.info(f"Merging csvs in {dir_path} on {on}")
-    all_csv_files = list(dir_path.glob("*.csv"))
+    all_csv_files = sorted(path for path in Path(dir_path).iterdir() if output_format(path))
     logger.info(f"Found {len(all_csv_files)} files to merge")
 
-    # Read all csv files into a list of DataFrames
-    merged_data = pd.DataFrame()
+    tables, merged_columns, keys = [], set(), None
     for csv_file_name in all_csv_files:
-        
-        logger.info(f"Reading {csv_file_name}")
-        df = pd.read_csv(csv_file_name)
-        if merged_data.empty:
-            merged_data = df
-        else:
-            merged_data = pd.merge(merged_data, df, on=on, how='inner')
-    
-    logger.info(f"Merged {len(all_csv_files)} files into one DataFrame")
-
-    # Process the merged DataFrame
-    merged_data = process_merge_hosp_data(merged_data)
-    logger.info("Processed merged data")
-
-    # Save the merged DataFrame to a csv file
-    OUTPUT_DIR = PROCESSED_HOSP_DATA_DIR / "../hosp_ttl.csv"
-    merged_data.to_csv(OUTPUT_DIR, index=False)
-    logger.info(f"Saved merged data to {OUTPUT_DIR}")
+        columns = _new_columns(output_columns(csv_file_name), on, merged_columns)
+        logger.info(f"Reading {len(columns)} columns of {csv_file_name}")
+        df = _indexed_on(read_output(csv_file_name, columns=[on, *columns]), on, csv_file_name.name)
+        keys = df.index if keys is None else keys.intersection(df.index)
+        tables.append(df[df.index.isin(keys)])
+    if not tables:
+        raise ValueError(f"No feature tables to merge in {dir_path}")
+    merged_data = _join_on_key(tables, on)
+    logger.info(f"Merged {len(tables)} feature tables into one DataFrame {merged_data.shape}")
 
+    _save_merged(merged_data, output_path, writer)
 
-    return merged_data
\ No newline at end of file
+    return merged_data
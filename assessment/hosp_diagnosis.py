@@ -1,74 +1,80 @@
 from datetime import timedelta
-import pandas as pd
-import numpy as np
-from pathlib import Path
-
 
 from loguru import logger
-from tqdm import tqdm
+import pandas as pd
 
+from assessment.code_classifiers import PrefixClassifier
 from assessment.config import ICD_CONDITION_MAP
+from assessment.features_hosp import split_prior_admissions
+from assessment.profiling import profiled
 
-def create_diagnosis_features(cohort_df, diagnoses_df):
-    feature_rows = []
-    
-    for sid, group in tqdm(cohort_df.groupby('subject_id')):
-        patient_diag = diagnoses_df[diagnoses_df['subject_id'] == sid]
-        admissions_sorted = group.sort_values('admittime')
-        
-        if len(admissions_sorted) < 2:
-            continue  # no prior admissions to compare with
-        
-        final_adm = admissions_sorted.iloc[-1]
-        prior_adms = admissions_sorted.iloc[:-1]
-        final_hadm_id = final_adm['hadm_id']
-        final_adm_time = final_adm['admittime']
+ICD_CONDITION_CLASSIFIER = PrefixClassifier(ICD_CONDITION_MAP)
+
+
+@profiled
+def create_condition_features(prior_adms, prior_diag, final_admit_time) -> pd.DataFrame:
+    """
+    Condition history of each subject over its prior admissions: flag_history_*,
+    count_prior_admissions_with_* and time_since_first_diagnosis_*_years.
 
-        prior_diag = patient_diag[patient_diag['hadm_id'].isin(prior_adms['hadm_id'])]
-        icd_codes = prior_diag['icd_code'].astype(str)
+    prior_adms: subject_id, hadm_id, admittime of every prior admission
+    prior_diag: diagnoses of the prior admissions
+    final_admit_time: Series of final admission times indexed by subject_id
+    Returns one row per subject of final_admit_time, indexed by subject_id.
+    """
+    # Conditions diagnosed in each prior admission, every distinct ICD code is classified once
+    condition_flags = ICD_CONDITION_CLASSIFIER.flags(prior_diag['icd_code'])
+    condition_flags['hadm_id'] = prior_diag['hadm_id'].to_numpy()
+    hadm_conditions = condition_flags.groupby('hadm_id').any()
+    adm_conditions = prior_adms.merge(hadm_conditions, left_on='hadm_id', right_index=True)
+
+    grouped = adm_conditions.groupby('subject_id')
+    labels = ICD_CONDITION_CLASSIFIER.labels
+    with_condition = grouped[labels].sum().reindex(final_admit_time.index, fill_value=0)
+    first_admit = (pd.DataFrame({label: adm_conditions['admittime'].where(adm_conditions[label]) for label in labels})
+                   .groupby(adm_conditions['subject_id']).min().reindex(final_admit_time.index))
+
+    features = pd.DataFrame(index=final_admit_time.index)
+    for condition in labels:
+        features[f"flag_history_{condition}"] = (with_condition[condition] > 0).astype(int)
+    for condition in labels:
+        features[f'count_prior_admissions_with_{condition}'] = with_condition[condition]
+        years_since_first = (final_admit_time - first_admit[condition]).dt.days / 365.0
+        features[f'time_since_first_diagnosis_{condition}_years'] = years_since_first.round(2)
+    return features
+
+
+@profiled
+def create_diagnosis_features(cohort_df, diagnoses_df):
+    """
+    Diagnosis history features of the final admission of every subject with at least one prior admission.
+    """
+    final_adms, prior_adms = split_prior_admissions(cohort_df)
+    logger.info(f"Creating diagnosis features for {len(final_adms)} subjects with prior admissions")
+    final_admit_time = final_adms['admittime']
 
-        # Count Features
-        count_prior_adm = len(prior_adms)
-        unique_icd = icd_codes.nunique()
-        avg_diag_per_adm = prior_diag.groupby('hadm_id')['icd_code'].count().mean()
+    # Diagnoses of prior admissions, a hadm_id belongs to a single subject
+    prior_diag = diagnoses_df[diagnoses_df['hadm_id'].isin(prior_adms['hadm_id'])]
+    diag_by_subject = prior_diag.groupby('subject_id')
+    diag_per_adm = prior_diag.groupby(['subject_id', 'hadm_id'], observed=True)['icd_code'].count()
 
-        # Condition flags
-        flags = {f"flag_history_{k}": int(any(icd.startswith(tuple(v)) for icd in icd_codes)) 
-                 for k, v in ICD_CONDITION_MAP.items()}
-        
-        # Longitudinal features
-        condition_stats = {}
-        for condition, codes in ICD_CONDITION_MAP.items():
-            cond_mask = icd_codes.apply(lambda x: any(x.startswith(code) for code in codes))
-            relevant_hadm_ids = prior_diag[cond_mask]['hadm_id'].unique()
-            condition_stats[f'count_prior_admissions_with_{condition}'] = len(relevant_hadm_ids)
-            
-            relevant_diag = prior_diag[cond_mask]
-            if not relevant_diag.empty:
-                merged_dates = relevant_diag.merge(cohort_df[['hadm_id', 'admittime']], on='hadm_id')
-                time_first = (final_adm_time - merged_dates['admittime'].min()).days / 365.0
-                condition_stats[f'time_since_first_diagnosis_{condition}_years'] = round(time_first, 2)
-            else:
-                condition_stats[f'time_since_first_diagnosis_{condition}_years'] = np.nan
-        
-        # Time since last admission
-        time_last_discharge = prior_adms['dischtime'].max()
-        time_since_last = (final_adm_time - time_last_discharge).days
-        one_year_ago = final_adm_time - timedelta(days=365)
-        prior_in_last_year = prior_adms[prior_adms['admittime'] >= one_year_ago]
+    # Admission history before the final admission
+    adm_by_subject = prior_adms.groupby('subject_id')
+    one_year_ago = prior_adms['subject_id'].map(final_admit_time - timedelta(days=365))
+    in_last_year = (prior_adms['admittime'] >= one_year_ago).groupby(prior_adms['subject_id']).sum()
 
-        row = {
-            'subject_id': sid,
-            'hadm_id': final_hadm_id,
-            'count_prior_admissions': count_prior_adm,
-            'count_unique_diagnoses_prior': unique_icd,
-            'avg_diagnoses_per_prior_admission': avg_diag_per_adm,
-            'time_since_last_admission_days': time_since_last,
-            'admission_frequency_last_year': len(prior_in_last_year),
-            **flags,
-            **condition_stats
-        }
-        
-        feature_rows.append(row)
+    features = pd.DataFrame({
+        'subject_id': final_adms.index,
+        'hadm_id': final_adms['hadm_id'].to_numpy(),
+        'count_prior_admissions': adm_by_subject.size().reindex(final_adms.index).to_numpy(),
+        'count_unique_diagnoses_prior': diag_by_subject['icd_code'].nunique(dropna=False)
+            .reindex(final_adms.index, fill_value=0).to_numpy(),
+        'avg_diagnoses_per_prior_admission': diag_per_adm.groupby(level='subject_id').mean()
+            .reindex(final_adms.index).to_numpy(),
+        'time_since_last_admission_days': (final_admit_time - adm_by_subject['dischtime'].max()).dt.days.to_numpy(),
+        'admission_frequency_last_year': in_last_year.reindex(final_adms.index).to_numpy(),
+    })
 
-    return pd.DataFrame(feature_rows)
+    # Condition flags and longitudinal features
+    condition_features = create_condition_features(prior_adms, prior_diag, final_admit_time)
+    return features.merge(condition_features, left_on='subject_id', right_index=True, how='left')
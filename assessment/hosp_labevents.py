@@ -1,16 +1,19 @@
-import pandas as pd
-import numpy as np
 from collections import defaultdict
-from pathlib import Path
-
 import os
 
-
 from loguru import logger
+import pandas as pd
 from tqdm import tqdm
 
-from assessment.config import LAB_ITEM_ID_MAP, LAB_KEYWORDS, ANEMIA_THRESH, HYPONATREMIA_THRESH, AKI_RISE_THRESH
-from assessment.datasets import load_d_labitems_data
+from assessment.config import LAB_KEYWORDS
+from assessment.datasets import (
+    LABEVENTS_FEATURE_COLUMNS,
+    iter_labevents_chunks,
+    load_d_labitems_data,
+)
+from assessment.lab_accumulators import LabStatsAccumulator
+from assessment.profiling import profiled
+from assessment.timestamps import parse_timestamps
 
 
 # Identify relevant itemids from d_labitems for keywords in LAB_KEYWORDS
@@ -43,108 +46,149 @@ def identify_itemids_from_d_labelitems(lab_keywords = LAB_KEYWORDS) -> pd.DataFr
     
     return d_labelitems_df, lab_to_itemids
 
-def create_labsevents_features_chunked(cohort_df, labevents_path, lab_keywords = LAB_KEYWORDS, chunksize=100000):
+
+def ordered_lab_names(lab_itemid_map, lab_keywords = LAB_KEYWORDS) -> list:
     """
-    labevents_path: Path to labevents.csv
-    lab_itemid_map: Dict[itemid] = 'lab_name', e.g., {50912: 'creatinine'}
+    Lab names of `lab_itemid_map` in the order of `lab_keywords`, which fixes the column order of the
+    lab features. Names missing from `lab_keywords` follow in the order of the map.
     """
+    lab_names = list(dict.fromkeys(lab_itemid_map.values()))
+    return [lab for lab in lab_keywords if lab in lab_names] + [lab for lab in lab_names if lab not in lab_keywords]
 
-    d_labelitems_df, lab_to_itemids = identify_itemids_from_d_labelitems(lab_keywords)
-    lab_itemid_map = {row['itemid']: row['label'] for _, row in d_labelitems_df.iterrows()}
 
+def prepare_lab_events(chunk, lab_itemid_map) -> pd.DataFrame:
+    """
+    Keep the lab events of interest in a labevents chunk and tag them with their lab name.
+    """
+    chunk = chunk[chunk['itemid'].isin(lab_itemid_map.keys()) & chunk['valuenum'].notna()]
+    chunk = chunk[LABEVENTS_FEATURE_COLUMNS].copy()
+    chunk['lab_name'] = chunk['itemid'].map(lab_itemid_map)
+    chunk['charttime'] = parse_timestamps(chunk['charttime'])
+    return chunk
 
 
-    # Prepare structures
-    cohort_subjects = set(cohort_df['subject_id'])
-    final_hadm_map = cohort_df.set_index('subject_id')['hadm_id'].to_dict()
+class PriorLabFeatures:
+    """
+    Lab stats over the prior admissions of each cohort subject (*_prior_avg, last_*_value_prior, ...).
+    Feature family of the fused labevents scan, see scan_labevents.
 
+    Events without a hadm_id (outpatient labs) count as prior when drawn before the subject's final admission.
+    """
 
-    
-    # Collect all prior hadm_ids for each subject
-    prior_hadm_lookup = defaultdict(list)
-    for sid, group in cohort_df.groupby('subject_id'):
-        if sid in final_hadm_map:
-            final_admit_time = cohort_df[cohort_df['subject_id'] == sid]['admittime'].iloc[-1]
-            prior_admissions = group[group['admittime'] < final_admit_time]
-            prior_hadm_lookup[sid] = list(prior_admissions['hadm_id'])
-
-
-    # Aggregation structures
-    lab_stats = defaultdict(lambda: defaultdict(list))                  # sid → lab_name → [values...]
-    last_lab_values = defaultdict(dict)                                 # sid → lab_name → (last_time, value)
-    lab_abnormal_counts = defaultdict(lambda: defaultdict(int))         # sid → abnormality type → count
-
-
-    # Estimate number of chunks for progress bar
-    file_size_bytes = os.path.getsize(labevents_path)
-    num_chunks = (file_size_bytes // (chunksize * 100)) + 1
-
-    # Read in chunks
-    logger.info(f"Reading labevents from {labevents_path} in chunks of {chunksize}...")
-    for chunk in tqdm(pd.read_csv(labevents_path, chunksize=chunksize), total=num_chunks, desc="Processing Chunks"):
-        chunk = chunk[chunk['subject_id'].isin(cohort_subjects)]
-        chunk = chunk[chunk['hadm_id'].isin(chunk['subject_id'].map(prior_hadm_lookup).explode())]
-        chunk = chunk[chunk['itemid'].isin(d_labelitems_df["itemid"])]
-        chunk['charttime'] = pd.to_datetime(chunk['charttime'], errors='coerce')
-
-        
-
-        for _, row in chunk.iterrows():
-            sid = row['subject_id']
-            hadm_id = row['hadm_id']
-            val = row['valuenum']
-            itemid = row['itemid']
-
-            lab_name = lab_itemid_map.get(itemid, None)
-            if lab_name is None or pd.isna(val):
-                continue
-
-            # Stats collection
-            lab_stats[sid][lab_name].append(val)
-
-            # Last prior value
-            current_last = last_lab_values[sid].get(lab_name, (pd.Timestamp.min, np.nan))
-            if row['charttime'] > current_last[0]:
-                last_lab_values[sid][lab_name] = (row['charttime'], val)
-
-            # Abnormality flags
-            if lab_name == 'hemoglobin' and val < ANEMIA_THRESH:
-                lab_abnormal_counts[sid]['chronic_anemia'] += 1
-            if lab_name == 'sodium' and val < HYPONATREMIA_THRESH:
-                lab_abnormal_counts[sid]['severe_hyponatremia'] += 1
-            if lab_name == 'creatinine' and val >= AKI_RISE_THRESH:
-                lab_abnormal_counts[sid]['chronic_kidney_disease'] += 1
-
-    logger.info("Aggregating lab events data...")
-    logger.info(f"Number of subjects whose lab events were aggregated: {len(lab_stats)}")
-    logger.info(f"Number of subjects with last lab values: {len(last_lab_values)}")
-    logger.info(f"Number of subjects with abnormal counts: {len(lab_abnormal_counts)}")
-    logger.info(f"Number of subjects in cohort: {len(cohort_subjects)}")
-
-
-    # Final aggregation
-    feature_rows = []
-    for sid in cohort_subjects:
-        row = {'subject_id': sid}
-        labs = lab_stats.get(sid, {})
-        
-        row['count_prior_labevents'] = sum(len(vals) for vals in labs.values())
-        row['count_unique_labs_tested_prior'] = len(labs)
-
-        for lab, values in labs.items():
-            row[f'{lab}_prior_avg'] = np.mean(values)
-            row[f'{lab}_prior_min'] = np.min(values)
-            row[f'{lab}_prior_max'] = np.max(values)
-            row[f'{lab}_prior_std'] = np.std(values)
-
-        for lab in lab_itemid_map.values():
-            last_val = last_lab_values[sid].get(lab, (None, np.nan))[1]
-            row[f'last_{lab}_value_prior'] = last_val
-
-        # Abnormal flags
-        row['count_prior_severe_hyponatremia'] = lab_abnormal_counts[sid].get('severe_hyponatremia', 0)
-        row['flag_chronic_anemia_prior'] = int(lab_abnormal_counts[sid].get('chronic_anemia', 0) >= 2)
-
-        feature_rows.append(row)
-
-    return pd.DataFrame(feature_rows)
+    def __init__(self, cohort_df, lab_itemid_map):
+        self.cohort_subjects = cohort_df['subject_id'].unique()
+        self.lab_names = ordered_lab_names(lab_itemid_map)
+
+        # Prior admissions: every cohort admission before the subject's final admission
+        admittime = parse_timestamps(cohort_df['admittime'])
+        self.final_admit_time = admittime.groupby(cohort_df['subject_id']).max()
+        final_admit_time = cohort_df['subject_id'].map(self.final_admit_time)
+        self.prior_hadm_ids = cohort_df.loc[admittime < final_admit_time, 'hadm_id'].unique()
+
+        self.stats = LabStatsAccumulator(self.cohort_subjects, self.lab_names)
+
+    def update(self, events):
+        outpatient_prior = events['hadm_id'].isna() & \
+            (events['charttime'] < events['subject_id'].map(self.final_admit_time))
+        events = events[events['hadm_id'].isin(self.prior_hadm_ids) | outpatient_prior]
+        self.stats.update(events)
+
+    def finalize(self, subjects=None) -> pd.DataFrame:
+        """
+        Feature rows of every cohort subject, or only of `subjects` when given (with the columns of every subject).
+        """
+        stats = self.stats if subjects is None else self.stats.take(subjects)
+        logger.info("Aggregating lab events data...")
+        logger.info(f"Number of subjects whose lab events were aggregated: {(stats.count.sum(axis=(1, 2)) > 0).sum()}")
+        logger.info(f"Number of subjects in cohort: {len(self.cohort_subjects)}")
+        logger.info(f"Lab stats store size: {self.stats.nbytes / 1e6:.1f} MB")
+
+        features = stats.to_features(
+            0,
+            stat_col=lambda lab, stat: f'{lab}_prior_{stat}',
+            last_col=lambda lab: f'last_{lab}_value_prior',
+            # Stats columns of the labs seen in any subject, so the columns do not depend on `subjects`
+            observed=self.stats.count[..., 0].sum(axis=0) > 0,
+        )
+        features = features.rename(columns={
+            'count_labevents': 'count_prior_labevents',
+            'count_unique_labs': 'count_unique_labs_tested_prior',
+            'count_severe_hyponatremia': 'count_prior_severe_hyponatremia',
+            'flag_chronic_anemia': 'flag_chronic_anemia_prior',
+        })
+
+        return features.reset_index()
+
+
+def identify_lab_itemid_map(lab_keywords = LAB_KEYWORDS) -> dict:
+    """
+    Dict[itemid] = 'lab_name' for the lab items used by the lab feature families.
+    """
+    d_labelitems_df, _ = identify_itemids_from_d_labelitems(lab_keywords)
+    return dict(zip(d_labelitems_df['itemid'], d_labelitems_df['label']))
+
+
+def feed_labevents(cohort_df, labevents_path, family_factories, lab_keywords = LAB_KEYWORDS, chunksize=100000,
+                   lab_itemid_map = None, backend = None) -> dict:
+    """
+    Read labevents once and feed the events of cohort subjects to every lab feature family.
+
+    family_factories: Dict[name] = callable(cohort_df, lab_itemid_map) returning a family
+                      with update(events) and finalize() -> pd.DataFrame
+    lab_itemid_map: resolved from d_labitems with `lab_keywords` when not given
+    backend: execution backend (assessment.backends) running the scan and filters, the chunked reader when not given
+    Returns Dict[name] = family holding the stats of the events read, see scan_labevents.
+    """
+    if lab_itemid_map is None:
+        lab_itemid_map = identify_lab_itemid_map(lab_keywords)
+
+    families = {name: factory(cohort_df, lab_itemid_map) for name, factory in family_factories.items()}
+    cohort_subjects = cohort_df['subject_id'].unique()
+
+    def feed(chunk):
+        events = prepare_lab_events(chunk, lab_itemid_map)
+        if not events.empty:
+            for family in families.values():
+                family.update(events)
+
+    if backend is not None:
+        logger.info(f"Reading labevents from {labevents_path} with the {backend.name} backend for {list(families)}...")
+        for chunk in backend.iter_labevents_chunks(labevents_path, lab_itemid_map.keys(), cohort_subjects, chunksize):
+            feed(chunk)
+        return families
+
+    # Read in chunks, only the projected columns of the lab items and cohort subjects.
+    # Progress is tracked in bytes of the file read, the number of chunks is not known before the scan.
+    logger.info(f"Reading labevents from {labevents_path} in chunks of {chunksize} for {list(families)}...")
+    with open(labevents_path, 'rb') as labevents_file, \
+            tqdm(total=os.path.getsize(labevents_path), unit='B', unit_scale=True, desc="Processing labevents") as progress:
+        reader = iter_labevents_chunks(labevents_file, itemids=lab_itemid_map.keys(), subject_ids=cohort_subjects,
+                                       chunksize=chunksize)
+        for chunk in reader:
+            progress.update(labevents_file.tell() - progress.n)
+            feed(chunk)
+
+    return families
+
+
+def scan_labevents(cohort_df, labevents_path, family_factories, lab_keywords = LAB_KEYWORDS, chunksize=100000,
+                   lab_itemid_map = None, backend = None) -> dict:
+    """
+    Feature tables of the lab feature families fed by one read of labevents, see feed_labevents.
+    Returns Dict[name] = feature DataFrame of that family.
+    """
+    families = feed_labevents(cohort_df, labevents_path, family_factories, lab_keywords, chunksize, lab_itemid_map,
+                              backend)
+    return {name: family.finalize() for name, family in families.items()}
+
+
+@profiled
+def create_labsevents_features_chunked(cohort_df, labevents_path, lab_keywords = LAB_KEYWORDS, chunksize=100000):
+    """
+    labevents_path: Path to labevents.csv
+
+    Every chunk is reduced with grouped reductions into a LabStatsAccumulator holding one
+    statistics record per (subject_id, lab_name).
+    """
+    factories = {'labs_feature_df': PriorLabFeatures}
+    return scan_labevents(cohort_df, labevents_path, factories, lab_keywords, chunksize)['labs_feature_df']
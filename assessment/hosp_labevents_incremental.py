@@ -0,0 +1,209 @@
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import shutil
+
+from loguru import logger
+import pandas as pd
+from tqdm import tqdm
+
+from assessment.config import LAB_FEATURES_STATE_DIR, LAB_KEYWORDS
+from assessment.datasets import iter_labevents_chunks
+from assessment.hosp_labevents import identify_lab_itemid_map, prepare_lab_events
+from assessment.hosp_labevents_scan import LAB_FEATURE_FAMILIES
+from assessment.lab_accumulators import LabStatsAccumulator
+from assessment.profiling import profiled
+
+# Bytes at the head of labevents hashed to detect a replaced (rather than appended) file
+HEAD_DIGEST_BYTES = 1 << 16
+# Version of the saved stores, bumped when the way records are merged changes (2: last value ties)
+STATE_VERSION = 2
+
+
+class _ByteRangeReader(io.RawIOBase):
+    """
+    Binary file object over bytes [start, end) of the open binary file `file`, which the caller closes.
+    """
+
+    def __init__(self, file, start, end):
+        self._file = file
+        self._file.seek(start)
+        self._remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._remaining)
+        if size <= 0:
+            return 0
+        data = self._file.read(size)
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+
+def _complete_lines_end(path) -> int:
+    """
+    Byte offset just after the last newline of the file, so a row still being appended is left for the next run.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        end = size
+        while end > 0:
+            start = max(end - HEAD_DIGEST_BYTES, 0)
+            f.seek(start)
+            block = f.read(end - start)
+            newline = block.rfind(b"\n")
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+    return 0
+
+
+def _head_digest(path, end) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read(min(end, HEAD_DIGEST_BYTES))).hexdigest()
+
+
+def _read_header(path) -> list:
+    with open(path, "r") as f:
+        return f.readline().rstrip("\r\n").split(",")
+
+
+def cohort_fingerprint(cohort_df, lab_itemid_map) -> str:
+    """
+    Digest of the cohort admissions and lab items the persisted accumulators were built for.
+    """
+    digest = hashlib.sha1()
+    admissions = cohort_df[['subject_id', 'hadm_id', 'admittime']]
+    digest.update(pd.util.hash_pandas_object(admissions, index=False).to_numpy().tobytes())
+    digest.update(json.dumps(sorted((int(k), v) for k, v in lab_itemid_map.items())).encode())
+    return digest.hexdigest()
+
+
+def _load_state(state_dir, labevents_path, header, fingerprint, families):
+    """
+    Saved run metadata when it can be continued for this labevents file, cohort and families, else None.
+    """
+    meta_path = state_dir / "state.json"
+    if not meta_path.exists():
+        return None
+    meta = json.loads(meta_path.read_text())
+    if meta.get('version') != STATE_VERSION:
+        logger.info("Lab features were saved by another version of the lab stores, rebuilding lab features")
+        return None
+    if meta['labevents_path'] != str(labevents_path) or meta['header'] != header \
+            or meta['cohort_fingerprint'] != fingerprint:
+        logger.info("Labevents source or cohort changed since the last run, rebuilding lab features")
+        return None
+    if not set(families) <= set(meta['families']):
+        logger.info("New lab feature families requested, rebuilding lab features")
+        return None
+    if os.path.getsize(labevents_path) < meta['high_water_mark'] \
+            or _head_digest(labevents_path, meta['high_water_mark']) != meta['head_digest']:
+        logger.info(f"{labevents_path} was rewritten rather than appended to, rebuilding lab features")
+        return None
+    return meta
+
+
+def _save_state(state_dir, meta, families, outputs):
+    # Write into a temporary directory so an interrupted run keeps the previous state
+    tmp_dir = state_dir.with_name(state_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    for name, family in families.items():
+        family.stats.save(tmp_dir / f"{name}.npz")
+        outputs[name].to_pickle(tmp_dir / f"{name}.pkl")
+    (tmp_dir / "state.json").write_text(json.dumps(meta))
+    shutil.rmtree(state_dir, ignore_errors=True)
+    os.replace(tmp_dir, state_dir)
+
+
+@profiled
+def update_lab_feature_families(cohort_df, labevents_path, families = None, state_dir = LAB_FEATURES_STATE_DIR,
+                                lab_keywords = LAB_KEYWORDS, chunksize=100000, lab_itemid_map = None) -> dict:
+    """
+    Incremental variant of create_lab_feature_families for an append-only labevents csv.
+
+    The accumulators of every family, the feature tables and the byte offset read up to
+    (high-water mark) are kept in `state_dir`. The next run reads only the rows appended
+    since then, folds them into the saved accumulators and recomputes the feature rows of
+    the subjects those rows belong to. A changed cohort, lab item map or rewritten file
+    falls back to a full scan.
+    Returns Dict[name] = feature DataFrame.
+    """
+    labevents_path = Path(labevents_path)
+    state_dir = Path(state_dir)
+    if labevents_path.suffix == ".gz":
+        raise ValueError(f"Incremental lab features need an uncompressed labevents csv, got {labevents_path}")
+
+    families = families or list(LAB_FEATURE_FAMILIES)
+    if lab_itemid_map is None:
+        lab_itemid_map = identify_lab_itemid_map(lab_keywords)
+    fingerprint = cohort_fingerprint(cohort_df, lab_itemid_map)
+    header = _read_header(labevents_path)
+    meta = _load_state(state_dir, labevents_path, header, fingerprint, families)
+
+    family_objs = {name: LAB_FEATURE_FAMILIES[name](cohort_df, lab_itemid_map) for name in families}
+    if meta is not None:
+        saved = {name: LabStatsAccumulator.load(state_dir / f"{name}.npz") for name in families}
+        if any(saved[name].lab_names != family.stats.lab_names for name, family in family_objs.items()):
+            logger.info("Lab order of the saved lab features changed, rebuilding lab features")
+            meta = None
+    if meta is not None:
+        for name, family in family_objs.items():
+            family.stats = saved[name]
+        start, header_names = meta['high_water_mark'], header
+    else:
+        start, header_names = 0, None
+
+    end = _complete_lines_end(labevents_path)
+    logger.info(f"Reading labevents bytes {start}..{end} of {labevents_path} for {families}")
+
+    touched = set()
+    with open(labevents_path, "rb") as labevents_file:
+        source = io.BufferedReader(_ByteRangeReader(labevents_file, start, end), buffer_size=1 << 20)
+        reader = iter_labevents_chunks(source, itemids=lab_itemid_map.keys(),
+                                       subject_ids=cohort_df['subject_id'].unique(), chunksize=chunksize,
+                                       header_names=header_names)
+        for chunk in tqdm(reader if end > start else [], desc="Processing Chunks"):
+            events = prepare_lab_events(chunk, lab_itemid_map)
+            if events.empty:
+                continue
+            touched.update(events['subject_id'].unique().tolist())
+            for family in family_objs.values():
+                family.update(events)
+
+    if meta is None:
+        outputs = {name: family.finalize() for name, family in family_objs.items()}
+    else:
+        # Only the rows of subjects with new events change
+        subjects = sorted(touched)
+        logger.info(f"Recomputing lab features of {len(subjects)} subjects with new labevents")
+        outputs = {}
+        for name, family in family_objs.items():
+            previous = pd.read_pickle(state_dir / f"{name}.pkl")
+            if not subjects:
+                outputs[name] = previous
+                continue
+            updated = family.finalize(subjects)
+            kept = previous[~previous['subject_id'].isin(subjects)]
+            # Columns in the order of a full rebuild, which the updated rows carry
+            columns = list(dict.fromkeys(list(updated.columns) + list(previous.columns)))
+            merged = pd.concat([kept, updated], ignore_index=True)[columns].set_index('subject_id')
+            outputs[name] = merged.loc[previous['subject_id']].reset_index()
+
+    meta = {
+        'version': STATE_VERSION,
+        'labevents_path': str(labevents_path),
+        'header': header,
+        'high_water_mark': end,
+        'head_digest': _head_digest(labevents_path, end),
+        'cohort_fingerprint': fingerprint,
+        'families': families,
+    }
+    _save_state(state_dir, meta, family_objs, outputs)
+    return outputs
@@ -0,0 +1,191 @@
+from functools import lru_cache
+import json
+from pathlib import Path
+import shutil
+
+from loguru import logger
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+import typer
+
+from assessment.config import LABEVENTS_INDEX_DIR, LABEVENTS_PATH
+from assessment.datasets import iter_labevents_chunks, source_fingerprint
+from assessment.hosp_labevents import identify_lab_itemid_map, prepare_lab_events
+from assessment.hosp_labevents_scan import LAB_FEATURE_FAMILIES
+from assessment.timestamps import parse_timestamps
+
+app = typer.Typer()
+
+# Columns stored in the index, one memory-mapped .npy file each, rows sorted by (subject_id, charttime).
+# charttime is stored as int64 nanoseconds (NaT = int64 min), a missing hadm_id as HADM_MISSING.
+INDEX_COLUMNS = {'hadm_id': 'int32', 'itemid': 'int32', 'charttime': 'int64', 'valuenum': 'float64'}
+HADM_MISSING = -1
+
+
+def _count_events_per_subject(labevents_path, chunksize) -> pd.Series:
+    counts = pd.Series(dtype='int64')
+    for chunk in tqdm(iter_labevents_chunks(labevents_path, chunksize=chunksize), desc="Counting labevents"):
+        counts = counts.add(chunk['subject_id'].value_counts(), fill_value=0)
+    return counts.sort_index().astype('int64')
+
+
+def _chunk_columns(chunk) -> dict:
+    return {
+        'hadm_id': chunk['hadm_id'].fillna(HADM_MISSING).to_numpy(dtype='int32'),
+        'itemid': chunk['itemid'].to_numpy(dtype='int32'),
+        'charttime': parse_timestamps(chunk['charttime']).to_numpy(dtype='datetime64[ns]').astype('int64'),
+        'valuenum': chunk['valuenum'].to_numpy(dtype='float64'),
+    }
+
+
+def build_labevents_index(labevents_path = LABEVENTS_PATH, index_dir = LABEVENTS_INDEX_DIR, chunksize=1000000,
+                          sort_block_rows=5000000, force=False) -> Path:
+    """
+    Build a CSR-style index of labevents: the events sorted by (subject_id, charttime) in
+    memory-mapped column files, plus `subject_ids` and `offsets` so that the events of
+    subject_ids[i] are rows offsets[i]:offsets[i + 1].
+
+    Three streaming passes with bounded memory: count events per subject, scatter every
+    chunk to its subjects' row ranges, then sort blocks of whole subjects by charttime.
+    """
+    index_dir = Path(index_dir)
+    manifest = {**source_fingerprint(labevents_path), 'columns': INDEX_COLUMNS}
+    manifest_path = index_dir / "manifest.json"
+    if not force and manifest_path.exists() and json.loads(manifest_path.read_text()) == manifest:
+        logger.info(f"labevents index in {index_dir} is up to date")
+        return index_dir
+
+    tmp_dir = index_dir.with_name(index_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    # Pass 1: events per subject -> offsets
+    counts = _count_events_per_subject(labevents_path, chunksize)
+    subject_ids = counts.index.to_numpy(dtype='int64')
+    offsets = np.concatenate([[0], np.cumsum(counts.to_numpy())]).astype('int64')
+    n_events = int(offsets[-1])
+    logger.info(f"Indexing {n_events} labevents of {len(subject_ids)} subjects into {index_dir}")
+
+    columns = {
+        col: np.lib.format.open_memmap(tmp_dir / f"{col}.npy", mode='w+', dtype=dtype, shape=(n_events,))
+        for col, dtype in INDEX_COLUMNS.items()
+    }
+
+    # Pass 2: scatter each chunk after the rows already written for its subjects (keeps file order)
+    cursor = offsets[:-1].copy()
+    for chunk in tqdm(iter_labevents_chunks(labevents_path, chunksize=chunksize), desc="Scattering labevents"):
+        subject_idx = np.searchsorted(subject_ids, chunk['subject_id'].to_numpy())
+        rank = pd.Series(subject_idx).groupby(subject_idx).cumcount().to_numpy()
+        destination = cursor[subject_idx] + rank
+        for col, values in _chunk_columns(chunk).items():
+            columns[col][destination] = values
+        cursor += np.bincount(subject_idx, minlength=len(subject_ids))
+
+    # Pass 3: sort blocks of whole subjects by (subject, charttime), stable on ties
+    block_start = 0
+    while block_start < len(subject_ids):
+        block_end = int(np.searchsorted(offsets, offsets[block_start] + sort_block_rows, side='right')) - 1
+        block_end = min(max(block_end, block_start + 1), len(subject_ids))
+        rows = slice(offsets[block_start], offsets[block_end])
+
+        local_subject = np.repeat(np.arange(block_end - block_start), np.diff(offsets[block_start:block_end + 1]))
+        order = np.lexsort((columns['charttime'][rows], local_subject))
+        for col in columns.values():
+            col[rows] = col[rows][order]
+        block_start = block_end
+
+    for col in columns.values():
+        col.flush()
+    del columns
+
+    np.save(tmp_dir / "subject_ids.npy", subject_ids)
+    np.save(tmp_dir / "offsets.npy", offsets)
+    shutil.rmtree(index_dir, ignore_errors=True)
+    tmp_dir.rename(index_dir)
+    manifest_path.write_text(json.dumps(manifest))
+    # Indexes opened before the rebuild still map the replaced files
+    open_labevents_index.cache_clear()
+    logger.info(f"labevents index written to {index_dir}")
+    return index_dir
+
+
+class LabEventsIndex:
+    """
+    Read side of the labevents index built by build_labevents_index.
+    """
+
+    def __init__(self, index_dir = LABEVENTS_INDEX_DIR):
+        index_dir = Path(index_dir)
+        self.subject_ids = np.load(index_dir / "subject_ids.npy")
+        self.offsets = np.load(index_dir / "offsets.npy")
+        self.columns = {col: np.load(index_dir / f"{col}.npy", mmap_mode='r') for col in INDEX_COLUMNS}
+
+    def subject_rows(self, subject_id) -> slice:
+        pos = np.searchsorted(self.subject_ids, subject_id)
+        if pos == len(self.subject_ids) or self.subject_ids[pos] != subject_id:
+            return slice(0, 0)
+        return slice(self.offsets[pos], self.offsets[pos + 1])
+
+    def get_subject_labs(self, subject_id) -> dict:
+        """
+        Zero-copy views on the memory-mapped columns holding the events of one subject,
+        sorted by charttime. charttime is viewed as datetime64[ns].
+        """
+        rows = self.subject_rows(subject_id)
+        labs = {col: values[rows] for col, values in self.columns.items()}
+        labs['charttime'] = labs['charttime'].view('datetime64[ns]')
+        return labs
+
+    def subject_labs_frame(self, subject_id) -> pd.DataFrame:
+        """
+        The events of one subject as a labevents-like DataFrame (copies the rows).
+        """
+        labs = self.get_subject_labs(subject_id)
+        frame = pd.DataFrame({'subject_id': subject_id, **{col: np.asarray(v) for col, v in labs.items()}})
+        frame['hadm_id'] = frame['hadm_id'].astype('Int32').mask(frame['hadm_id'] == HADM_MISSING)
+        return frame
+
+
+@lru_cache(maxsize=4)
+def open_labevents_index(index_dir = LABEVENTS_INDEX_DIR) -> LabEventsIndex:
+    return LabEventsIndex(index_dir)
+
+
+def get_subject_labs(subject_id, index_dir = LABEVENTS_INDEX_DIR) -> dict:
+    """
+    Lab history of one subject from the labevents index, see LabEventsIndex.get_subject_labs.
+    """
+    return open_labevents_index(index_dir).get_subject_labs(subject_id)
+
+
+def compute_subject_lab_features(subject_id, cohort_df, families = None, index_dir = LABEVENTS_INDEX_DIR,
+                                 lab_itemid_map = None) -> dict:
+    """
+    Lab feature families of a single subject, in O(events of that subject).
+    Returns Dict[name] = one-row feature DataFrame.
+    """
+    families = families or list(LAB_FEATURE_FAMILIES)
+    lab_itemid_map = lab_itemid_map or identify_lab_itemid_map()
+    subject_cohort = cohort_df[cohort_df['subject_id'] == subject_id]
+
+    events = prepare_lab_events(open_labevents_index(index_dir).subject_labs_frame(subject_id), lab_itemid_map)
+    results = {}
+    for name in families:
+        family = LAB_FEATURE_FAMILIES[name](subject_cohort, lab_itemid_map)
+        family.update(events)
+        results[name] = family.finalize()
+    return results
+
+
+@app.command()
+def main(
+    labevents_path: Path = LABEVENTS_PATH,
+    index_dir: Path = LABEVENTS_INDEX_DIR,
+    force: bool = False,
+):
+    build_labevents_index(labevents_path, index_dir, force=force)
+
+
+if __name__ == "__main__":
+    app()
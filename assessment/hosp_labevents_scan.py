@@ -0,0 +1,36 @@
+from loguru import logger
+
+from assessment.config import LAB_KEYWORDS
+from assessment.hosp_labevents import PriorLabFeatures, scan_labevents
+from assessment.hosp_labevents_windowed import WindowedLabFeatures
+from assessment.profiling import profiled
+
+# Lab feature families computed by the fused labevents scan.
+# Dict[name] = callable(cohort_df, lab_itemid_map) -> family with update(events), finalize(subjects=None)
+# and its LabStatsAccumulator in `stats` (persisted by the incremental mode).
+# The name is also the stem of the processed csv the family is saved to.
+LAB_FEATURE_FAMILIES = {
+    'labs_feature_df': PriorLabFeatures,
+    'temporal_labs_feature_df': WindowedLabFeatures,
+}
+
+
+def register_lab_feature_family(name, factory):
+    """
+    Add a lab feature family to the fused labevents scan.
+    """
+    LAB_FEATURE_FAMILIES[name] = factory
+
+
+@profiled
+def create_lab_feature_families(cohort_df, labevents_path, families = None, lab_keywords = LAB_KEYWORDS,
+                                chunksize=100000, lab_itemid_map = None, backend = None):
+    """
+    Compute every registered lab feature family (or only `families`) with a single read of labevents,
+    run by `backend` (assessment.backends) when given.
+    Returns Dict[name] = feature DataFrame.
+    """
+    families = families or list(LAB_FEATURE_FAMILIES)
+    factories = {name: LAB_FEATURE_FAMILIES[name] for name in families}
+    logger.info(f"Running fused labevents scan for families: {families}")
+    return scan_labevents(cohort_df, labevents_path, factories, lab_keywords, chunksize, lab_itemid_map, backend)
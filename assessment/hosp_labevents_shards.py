@@ -0,0 +1,117 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+import json
+import os
+import shutil
+
+from loguru import logger
+from tqdm import tqdm
+
+from assessment.config import (
+    LAB_FEATURE_WORKERS,
+    LAB_KEYWORDS,
+    LABEVENTS_N_SHARDS,
+    LABEVENTS_SHARD_DIR,
+)
+from assessment.datasets import (
+    LABEVENTS_FEATURE_COLUMNS,
+    iter_labevents_chunks,
+    source_fingerprint,
+)
+from assessment.hosp_labevents import feed_labevents, identify_lab_itemid_map
+from assessment.hosp_labevents_scan import LAB_FEATURE_FAMILIES, create_lab_feature_families
+from assessment.lab_accumulators import LabStatsAccumulator
+from assessment.profiling import profiled
+
+
+def shard_of(subject_ids, n_shards):
+    """
+    Shard index of each subject_id. All events of a subject land in the same shard.
+    """
+    return subject_ids % n_shards
+
+
+def partition_labevents(labevents_path, shard_dir = LABEVENTS_SHARD_DIR, n_shards = LABEVENTS_N_SHARDS,
+                        chunksize=1000000, force=False):
+    """
+    Hash-partition labevents by subject_id into `n_shards` csv files holding the columns
+    the lab feature families read. Partitioning is skipped when the shards already match
+    the current labevents file.
+    Returns the list of shard paths, shard k holding subjects with shard_of(subject_id) == k.
+    """
+    manifest_path = shard_dir / "manifest.json"
+    shard_paths = [shard_dir / f"labevents_shard_{k:03d}.csv" for k in range(n_shards)]
+    manifest = {**source_fingerprint(labevents_path), 'n_shards': n_shards, 'columns': LABEVENTS_FEATURE_COLUMNS}
+
+    if not force and manifest_path.exists() and json.loads(manifest_path.read_text()) == manifest:
+        logger.info(f"Reusing {n_shards} labevents shards in {shard_dir}")
+        return shard_paths
+
+    # Write into a temporary directory so an interrupted run never looks complete
+    tmp_dir = shard_dir.with_name(shard_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    logger.info(f"Partitioning {labevents_path} into {n_shards} shards by subject_id...")
+    with ExitStack() as stack:
+        handles = [stack.enter_context(open(tmp_dir / path.name, "w", newline="")) for path in shard_paths]
+        for handle in handles:
+            handle.write(",".join(LABEVENTS_FEATURE_COLUMNS) + "\n")
+
+        reader = iter_labevents_chunks(labevents_path, chunksize=chunksize)
+        for chunk in tqdm(reader, desc="Partitioning labevents"):
+            for shard, shard_chunk in chunk.groupby(shard_of(chunk['subject_id'], n_shards)):
+                shard_chunk.to_csv(handles[shard], header=False, index=False)
+
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    os.replace(tmp_dir, shard_dir)
+    manifest_path.write_text(json.dumps(manifest))
+    logger.info(f"Wrote {n_shards} labevents shards to {shard_dir}")
+    return shard_paths
+
+
+def _shard_stats(cohort_df, shard_path, families, chunksize, lab_itemid_map) -> dict:
+    """
+    Dict[name] = LabStatsAccumulator of the family `name` over the events of one shard.
+    """
+    factories = {name: LAB_FEATURE_FAMILIES[name] for name in families}
+    fed = feed_labevents(cohort_df, shard_path, factories, chunksize=chunksize, lab_itemid_map=lab_itemid_map)
+    return {name: family.stats for name, family in fed.items()}
+
+
+@profiled
+def create_lab_feature_families_parallel(cohort_df, labevents_path, families = None, lab_keywords = LAB_KEYWORDS,
+                                         n_shards = LABEVENTS_N_SHARDS, max_workers = LAB_FEATURE_WORKERS,
+                                         shard_dir = LABEVENTS_SHARD_DIR, chunksize=100000):
+    """
+    Same output as create_lab_feature_families, computed per labevents shard in a process pool.
+    Every subject's events sit in one shard, in file order, so the per shard stats are concatenated
+    and every family is finalized once over the whole cohort.
+    """
+    families = families or list(LAB_FEATURE_FAMILIES)
+    shard_paths = partition_labevents(labevents_path, shard_dir, n_shards)
+    cohort_shards = shard_of(cohort_df['subject_id'], n_shards)
+    # Resolved once here instead of loading d_labitems in every worker
+    lab_itemid_map = identify_lab_itemid_map(lab_keywords)
+
+    logger.info(f"Building lab features for {n_shards} shards with {max_workers} workers")
+    shard_stats = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(_shard_stats, cohort_df[cohort_shards == k], shard_path, families, chunksize, lab_itemid_map)
+            for k, shard_path in enumerate(shard_paths)
+            if (cohort_shards == k).any()
+        ]
+        for future in tqdm(futures, desc="Lab feature shards"):
+            shard_stats.append(future.result())
+
+    if not shard_stats:
+        return create_lab_feature_families(cohort_df, labevents_path, families, lab_keywords, chunksize,
+                                           lab_itemid_map)
+
+    outputs = {}
+    for name in families:
+        family = LAB_FEATURE_FAMILIES[name](cohort_df, lab_itemid_map)
+        family.stats = LabStatsAccumulator.concat([stats[name] for stats in shard_stats]).take(family.stats.subjects)
+        outputs[name] = family.finalize()
+    return outputs
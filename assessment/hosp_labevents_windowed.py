@@ -1,121 +1,98 @@
-from datetime import timedelta
-import pandas as pd
-import numpy as np
-from collections import defaultdict
-from pathlib import Path
-
-import os
-
+from functools import partial
 
 from loguru import logger
-from tqdm import tqdm
+import numpy as np
+import pandas as pd
 
-from assessment.config import LAB_ITEM_ID_MAP, LAB_KEYWORDS, ANEMIA_THRESH, HYPONATREMIA_THRESH, AKI_RISE_THRESH
-from assessment.datasets import load_d_labitems_data
-from assessment.hosp_labevents import identify_itemids_from_d_labelitems
+from assessment.config import LAB_KEYWORDS
+from assessment.hosp_labevents import ordered_lab_names, scan_labevents
+from assessment.lab_accumulators import LabStatsAccumulator
+from assessment.profiling import profiled
+from assessment.timestamps import parse_timestamps
 
-# Thresholds for conditions
-HGB_LOW = 10  # g/dL
-NA_CRIT_LOW = 120  # mEq/L
-AKI_DELTA = 0.3  # mg/dL rise in creatinine
 
-# Let's re-import required packages since execution state has been reset
-def create_longitudinal_lab_features(cohort_df, labevents_path, lab_keywords = LAB_KEYWORDS, 
-                                     window_days=[365, 180, 90, 30, 7], chunksize=100000):
+def tag_smallest_window(events, final_admit_time, window_days) -> pd.Series:
     """
-    Generates longitudinal lab features from labevents in defined time windows prior to final admission.
+    Index (into sorted(window_days)) of the smallest window that contains each event, -1 if none.
+    An event is inside a window when charttime >= final admittime - window days.
     """
+    windows = np.sort(np.asarray(window_days, dtype='int64'))
+    boundaries_ns = (windows * np.timedelta64(1, 'D')).astype('timedelta64[ns]').astype('int64')
 
-    d_labelitems_df, lab_to_itemids = identify_itemids_from_d_labelitems(lab_keywords)
-    lab_itemid_map = {row['itemid']: row['label'] for _, row in d_labelitems_df.iterrows()}
-
-    # Precompute cohort metadata
-    cohort_subjects = cohort_df['subject_id'].unique()
-
-    cohort_df['admittime'] = pd.to_datetime(cohort_df['admittime'], errors='coerce')
-    final_admit_time = cohort_df.groupby('subject_id')['admittime'].max().to_dict()
-
-    # Create time boundaries for each subject per window
-    time_boundaries = {
-        sid: {days: final_admit_time[sid] - timedelta(days=days) for days in window_days}
-        for sid in cohort_subjects
-    }
-
-    # Initialize data stores
-    lab_stats = {days: defaultdict(lambda: defaultdict(list)) for days in window_days}
-    last_lab_values = {days: defaultdict(dict) for days in window_days}
-    abnormal_counts = {days: defaultdict(lambda: defaultdict(int)) for days in window_days}
-
-    # Map itemid to lab name (handle duplicates)
-    itemid_to_lab = {}
-    for iid, lname in lab_itemid_map.items():
-        itemid_to_lab.setdefault(iid, lname)
-
-    reader = pd.read_csv(labevents_path, chunksize=chunksize)
-    for chunk in tqdm(reader, desc="Processing labevents in chunks"):
-        chunk = chunk[chunk['subject_id'].isin(cohort_subjects)]
-        chunk = chunk[chunk['itemid'].isin(itemid_to_lab.keys())]
-        chunk['charttime'] = pd.to_datetime(chunk['charttime'], errors='coerce')
-        chunk = chunk.dropna(subset=['charttime', 'valuenum'])
-
-        for _, row in chunk.iterrows():
-            sid = row['subject_id']
-            charttime = row['charttime']
-            val = row['valuenum']
-            lab_name = itemid_to_lab.get(row['itemid'], None)
-            if lab_name is None:
-                continue
-
-            for days in window_days:
-                if charttime >= time_boundaries[sid][days]:
-                    lab_stats[days][sid][lab_name].append(val)
-
-                    # last value
-                    curr_last = last_lab_values[days][sid].get(lab_name, (pd.Timestamp.min, np.nan))
-                    if charttime > curr_last[0]:
-                        last_lab_values[days][sid][lab_name] = (charttime, val)
-
-                    # abnormality tracking
-                    if lab_name == 'hemoglobin' and val < ANEMIA_THRESH:
-                        abnormal_counts[days][sid]['chronic_anemia'] += 1
-                    if lab_name == 'sodium' and val < HYPONATREMIA_THRESH:
-                        abnormal_counts[days][sid]['severe_hyponatremia'] += 1
-                    if lab_name == 'creatinine' and val >= AKI_RISE_THRESH:
-                        abnormal_counts[days][sid]['chronic_kidney_disease'] += 1
-    
-    logger.info("Aggregating lab features for each time window")
-    # Print len of lab_stats
-    for days in window_days:
-        logger.info(f"Window {days} days: {len(lab_stats[days])} subjects with lab data")
-        logger.info(f"Window {days} days: {len(last_lab_values[days])} subjects with last lab values")
-        logger.info(f"Window {days} days: {len(abnormal_counts[days])} subjects with abnormal counts")
-        logger.info("-" * 50)
-        
-
-    # Aggregate features
-    feature_rows = []
-    for sid in cohort_subjects:
-        row = {'subject_id': sid}
-        for days in window_days:
-            prefix = f'window_{days}d'
-            labs = lab_stats[days].get(sid, {})
+    age = events['subject_id'].map(final_admit_time) - events['charttime']
+    window_idx = np.searchsorted(boundaries_ns, age.to_numpy(dtype='int64', na_value=np.iinfo('int64').max))
+    window_idx[window_idx == len(windows)] = -1
+    return pd.Series(window_idx, index=events.index)
 
-            row[f'{prefix}_count_labevents'] = sum(len(vals) for vals in labs.values())
-            row[f'{prefix}_count_unique_labs'] = len(labs)
 
-            for lab, values in labs.items():
-                row[f'{prefix}_{lab}_avg'] = np.mean(values)
-                row[f'{prefix}_{lab}_min'] = np.min(values)
-                row[f'{prefix}_{lab}_max'] = np.max(values)
-                row[f'{prefix}_{lab}_std'] = np.std(values)
-
-            for lab in set(itemid_to_lab.values()):
-                row[f'{prefix}_last_{lab}'] = last_lab_values[days][sid].get(lab, (None, np.nan))[1]
+class WindowedLabFeatures:
+    """
+    Lab stats in time windows before the final admission (window_{days}d_*).
+    Feature family of the fused labevents scan, see scan_labevents.
 
-            # abnormal counts
-            row[f'{prefix}_count_severe_hyponatremia'] = abnormal_counts[days][sid].get('severe_hyponatremia', 0)
-            row[f'{prefix}_flag_chronic_anemia'] = int(abnormal_counts[days][sid].get('chronic_anemia', 0) >= 2)
+    Each event is tagged once with the smallest window containing it and added to that
+    window's record in a LabStatsAccumulator. The stats of a window are then the cumulative
+    combination of its own record and those of every smaller window.
+    """
 
-        feature_rows.append(row)
+    def __init__(self, cohort_df, lab_itemid_map, window_days=(365, 180, 90, 30, 7)):
+        self.cohort_subjects = cohort_df['subject_id'].unique()
+        lab_names = ordered_lab_names(lab_itemid_map)
+        self.window_days = window_days
+        self.sorted_windows = sorted(window_days)
+
+        admittime = parse_timestamps(cohort_df['admittime'])
+        self.final_admit_time = admittime.groupby(cohort_df['subject_id']).max()
+
+        self.stats = LabStatsAccumulator(self.cohort_subjects, lab_names, n_windows=len(window_days))
+
+    def update(self, events):
+        events = events.dropna(subset=['charttime'])
+        window_idx = tag_smallest_window(events, self.final_admit_time, self.sorted_windows)
+        in_window = (window_idx >= 0).to_numpy()
+        self.stats.update(events[in_window], window_idx[in_window])
+
+    def finalize(self, subjects=None) -> pd.DataFrame:
+        """
+        Feature rows of every cohort subject, or only of `subjects` when given.
+        """
+        stats = self.stats if subjects is None else self.stats.take(subjects)
+        logger.info("Aggregating lab features for each time window")
+        logger.info(f"Lab stats store size: {self.stats.nbytes / 1e6:.1f} MB")
+        # Window k covers the events tagged with window k or any smaller window
+        cumulative = stats.cumulative()
+        # Labs seen in each window by any subject, so the columns do not depend on `subjects`
+        observed = np.cumsum(self.stats.count.sum(axis=0), axis=1) > 0
+
+        # Aggregate features
+        window_features = []
+        for days in self.window_days:
+            window = self.sorted_windows.index(days)
+            logger.info(f"Window {days} days: {(cumulative.count[..., window].sum(axis=1) > 0).sum()} subjects with lab data")
 
-    return pd.DataFrame(feature_rows)
+            prefix = f'window_{days}d'
+            features = cumulative.to_features(
+                window,
+                stat_col=lambda lab, stat, prefix=prefix: f'{prefix}_{lab}_{stat}',
+                last_col=lambda lab, prefix=prefix: f'{prefix}_last_{lab}',
+                observed=observed[:, window],
+            )
+            features = features.rename(columns={
+                'count_labevents': f'{prefix}_count_labevents',
+                'count_unique_labs': f'{prefix}_count_unique_labs',
+                'count_severe_hyponatremia': f'{prefix}_count_severe_hyponatremia',
+                'flag_chronic_anemia': f'{prefix}_flag_chronic_anemia',
+            })
+            window_features.append(features)
+
+        return pd.concat(window_features, axis=1).reset_index()
+
+
+@profiled
+def create_longitudinal_lab_features(cohort_df, labevents_path, lab_keywords = LAB_KEYWORDS, 
+                                     window_days=(365, 180, 90, 30, 7), chunksize=100000):
+    """
+    Generates longitudinal lab features from labevents in defined time windows prior to final admission.
+    """
+    factories = {'temporal_labs_feature_df': partial(WindowedLabFeatures, window_days=window_days)}
+    return scan_labevents(cohort_df, labevents_path, factories, lab_keywords, chunksize)['temporal_labs_feature_df']
@@ -1,64 +1,61 @@
-from datetime import timedelta
-import pandas as pd
-import numpy as np
-from pathlib import Path
-
-
 from loguru import logger
-from tqdm import tqdm
+import numpy as np
+import pandas as pd
 
+from assessment.code_classifiers import KeywordClassifier
 from assessment.config import DRUG_CLASS_MAP
+from assessment.profiling import profiled
 
+DRUG_CLASSIFIER = KeywordClassifier(DRUG_CLASS_MAP)
 
-def create_meds_features(cohort_df, prescriptions_df):
-    feature_rows = []
-
-    # Ensure datetime columns are correct
-    prescriptions_df['starttime'] = pd.to_datetime(prescriptions_df['starttime'], errors='coerce')
-    prescriptions_df['stoptime'] = pd.to_datetime(prescriptions_df['stoptime'], errors='coerce')
-
-    for sid, group in tqdm(cohort_df.groupby('subject_id')):
-        patient_presc = prescriptions_df[prescriptions_df['subject_id'] == sid].copy()
-        group = group.sort_values('admittime')
-
-        # Identify final admission
-        final_admission = group.sort_values('admittime').iloc[-1]
-        final_hadm = final_admission['hadm_id']
-        final_admit_time = final_admission['admittime']
-
-        # Admissions before final one
-        prior_admits = group[group['admittime'] < final_admit_time]['hadm_id'].values
-        prior_presc = patient_presc[patient_presc['hadm_id'].isin(prior_admits)]
-
-        feature = {
-            'subject_id': sid,
-            'count_prior_prescriptions': len(prior_presc),
-            'count_unique_drugs_prior': prior_presc['drug'].nunique(),
-            'avg_drugs_per_prior_admission': (
-                prior_presc.groupby('hadm_id')['drug'].nunique().mean() if len(prior_admits) > 0 else 0
-            ),
-        }
+# Prescriptions columns read by the medication features
+MEDS_FEATURE_COLUMNS = ['subject_id', 'hadm_id', 'drug']
 
-        # Flags for drug classes
-        drug_list = prior_presc['drug'].str.lower().dropna().unique()
-        for drug_class, keywords in DRUG_CLASS_MAP.items():
-            match = any(any(kw in drug for kw in keywords) for drug in drug_list)
-            feature[f'flag_history_on_{drug_class}'] = int(match)
 
-            matched_hadm = prior_presc[
-                prior_presc['drug'].str.lower().str.contains('|'.join(keywords), na=False)
-            ]['hadm_id'].unique()
-            feature[f'count_prior_admissions_on_{drug_class}'] = len(matched_hadm)
-
-        # Flag for drug class in last prior admission
-        if len(prior_admits) > 0:
-            last_admit = group[group['admittime'] < final_admit_time].sort_values('admittime').iloc[-1]
-            last_presc = patient_presc[patient_presc['hadm_id'] == last_admit['hadm_id']]
-            last_steroids = last_presc['drug'].str.lower().str.contains('|'.join(DRUG_CLASS_MAP['steroids']), na=False).any()
-            feature['flag_on_steroids_last_prior_admission'] = int(last_steroids)
-        else:
-            feature['flag_on_steroids_last_prior_admission'] = 0
-
-        feature_rows.append(feature)
-
-    return pd.DataFrame(feature_rows)
+@profiled
+def create_meds_features(cohort_df, prescriptions_df):
+    """
+    Medication history features of every cohort subject over the admissions before its final admission.
+    prescriptions_df: needs the MEDS_FEATURE_COLUMNS, see load_prescriptions_data
+    """
+    # Admissions before the final one
+    final_admit_time = cohort_df.groupby('subject_id')['admittime'].max()
+    subjects = final_admit_time.index
+    prior_adms = cohort_df[cohort_df['admittime'] < cohort_df['subject_id'].map(final_admit_time)]
+    prior_adms = prior_adms.sort_values(['subject_id', 'admittime'], kind='stable')
+    logger.info(f"Creating medication features for {len(subjects)} subjects")
+
+    # Prescriptions of prior admissions with the drug classes of each, every distinct drug is classified once
+    prior_presc = prescriptions_df[prescriptions_df['hadm_id'].isin(prior_adms['hadm_id'])]
+    drug_flags = DRUG_CLASSIFIER.flags(prior_presc['drug'])
+    drug_flags['subject_id'] = prior_presc['subject_id'].to_numpy()
+    drug_flags['hadm_id'] = prior_presc['hadm_id'].to_numpy()
+
+    presc_by_subject = prior_presc.groupby('subject_id')
+    drugs_per_adm = prior_presc.groupby(['subject_id', 'hadm_id'], observed=True)['drug'].nunique()
+    has_prior_adm = subjects.isin(prior_adms['subject_id'])
+
+    features = pd.DataFrame({
+        'subject_id': subjects,
+        'count_prior_prescriptions': presc_by_subject.size().reindex(subjects, fill_value=0).to_numpy(),
+        'count_unique_drugs_prior': presc_by_subject['drug'].nunique().reindex(subjects, fill_value=0).to_numpy(),
+        'avg_drugs_per_prior_admission': np.where(
+            has_prior_adm, drugs_per_adm.groupby(level='subject_id').mean().reindex(subjects), 0),
+    })
+
+    # Flags and counts of admissions for drug classes
+    labels = DRUG_CLASSIFIER.labels
+    history = drug_flags.groupby('subject_id')[labels].any().reindex(subjects, fill_value=False)
+    adms_on_class = (drug_flags.groupby(['subject_id', 'hadm_id'])[labels].any()
+                     .groupby(level='subject_id').sum().reindex(subjects, fill_value=0))
+    for drug_class in labels:
+        features[f'flag_history_on_{drug_class}'] = history[drug_class].astype(int).to_numpy()
+        features[f'count_prior_admissions_on_{drug_class}'] = adms_on_class[drug_class].to_numpy()
+
+    # Flag for drug class in last prior admission
+    last_prior_hadm_ids = prior_adms.groupby('subject_id')['hadm_id'].last()
+    last_flags = drug_flags[drug_flags['hadm_id'].isin(last_prior_hadm_ids)]
+    last_steroids = last_flags.groupby('subject_id')['steroids'].any().reindex(subjects, fill_value=False)
+    features['flag_on_steroids_last_prior_admission'] = last_steroids.astype(int).to_numpy()
+
+    return features
@@ -1,68 +1,59 @@
-from datetime import timedelta
-import pandas as pd
-import numpy as np
-from pathlib import Path
-
-
 from loguru import logger
-from tqdm import tqdm
+import pandas as pd
 
+from assessment.code_classifiers import PrefixClassifier
 from assessment.config import PROCEDURE_ICD_MAP
+from assessment.features_hosp import split_prior_admissions
+from assessment.profiling import profiled
 
+PROCEDURE_CLASSIFIER = PrefixClassifier(PROCEDURE_ICD_MAP)
 
-def create_procedures_features(cohort_df, procedures_df):
-    feature_rows = []
-    admissions_df = cohort_df.copy()
-
-    for sid, group in tqdm(admissions_df.groupby('subject_id')):
-        patient_proc = procedures_df[procedures_df['subject_id'] == sid]
-        admissions_sorted = group.sort_values('admittime')
-
-        if len(admissions_sorted) < 2:
-            continue
-
-        final_adm = admissions_sorted.iloc[-1]
-        prior_adms = admissions_sorted.iloc[:-1]
-        final_hadm_id = final_adm['hadm_id']
-        final_adm_time = final_adm['admittime']
 
-        prior_proc = patient_proc[patient_proc['hadm_id'].isin(prior_adms['hadm_id'])]
-        proc_codes = prior_proc['icd_code'].astype(str)
-
-        # Count features
-        count_proc = len(proc_codes)
-        count_unique_proc = proc_codes.nunique()
-        count_adm_with_proc = prior_proc['hadm_id'].nunique()
-
-        # Specific procedure flags
-        flags = {f"flag_history_{k}": int(any(code.startswith(tuple(v)) for code in proc_codes))
-                 for k, v in PROCEDURE_ICD_MAP.items()}
-
-        # Longitudinal: time since last major surgery
-        major_surg_codes = PROCEDURE_ICD_MAP['major_surgery']
-        major_surg_mask = proc_codes.apply(lambda x: any(x.startswith(code) for code in major_surg_codes))
-        prior_major_surg = prior_proc[major_surg_mask]
-        if not prior_major_surg.empty:
-            merged_dates = prior_major_surg.merge(admissions_df[['hadm_id', 'admittime']], on='hadm_id')
-            time_since_major_surg = (final_adm_time - merged_dates['admittime'].max()).days / 365.0
-        else:
-            time_since_major_surg = np.nan
-
-        # Flag: procedure in last prior admission
-        last_prior_adm = prior_adms.iloc[-1]['hadm_id']
-        had_proc_last_adm = int(last_prior_adm in prior_proc['hadm_id'].unique())
-
-        row = {
-            'subject_id': sid,
-            'hadm_id': final_hadm_id,
-            'count_prior_procedures': count_proc,
-            'count_unique_procedures_prior': count_unique_proc,
-            'count_prior_admissions_with_procedure': count_adm_with_proc,
-            'time_since_last_major_surgery_years': round(time_since_major_surg, 2) if pd.notnull(time_since_major_surg) else np.nan,
-            'flag_procedure_in_last_prior_admission': had_proc_last_adm,
-            **flags
-        }
-
-        feature_rows.append(row)
-
-    return pd.DataFrame(feature_rows)
+@profiled
+def create_procedures_features(cohort_df, procedures_df):
+    """
+    Procedure history features of the final admission of every subject with at least one prior admission.
+    """
+    final_adms, prior_adms = split_prior_admissions(cohort_df)
+    logger.info(f"Creating procedure features for {len(final_adms)} subjects with prior admissions")
+    subjects = final_adms.index
+
+    # Procedures of prior admissions, every distinct ICD code is classified once
+    prior_proc = procedures_df[procedures_df['hadm_id'].isin(prior_adms['hadm_id'])]
+    proc_flags = PROCEDURE_CLASSIFIER.flags(prior_proc['icd_code'])
+    proc_flags['subject_id'] = prior_proc['subject_id'].to_numpy()
+    proc_flags['hadm_id'] = prior_proc['hadm_id'].to_numpy()
+    proc_by_subject = prior_proc.groupby('subject_id')
+
+    # Time since last major surgery: latest prior admission with a major surgery, as of the final admission
+    surgery_hadm_ids = proc_flags.loc[proc_flags['major_surgery'], 'hadm_id'].unique()
+    surgery_adms = prior_adms.loc[prior_adms['hadm_id'].isin(surgery_hadm_ids), ['subject_id', 'admittime']]
+    last_surgery = pd.merge_asof(
+        final_adms[['admittime']].reset_index().sort_values('admittime'),
+        surgery_adms.rename(columns={'admittime': 'surgery_time'}).sort_values('surgery_time'),
+        left_on='admittime', right_on='surgery_time', by='subject_id', direction='backward',
+    ).set_index('subject_id').reindex(subjects)
+    years_since_surgery = ((last_surgery['admittime'] - last_surgery['surgery_time']).dt.days / 365.0).round(2)
+
+    # Last prior admission of each subject (prior_adms is sorted by admittime)
+    last_prior_hadm_ids = prior_adms.groupby('subject_id')['hadm_id'].last()
+
+    features = pd.DataFrame({
+        'subject_id': subjects,
+        'hadm_id': final_adms['hadm_id'].to_numpy(),
+        'count_prior_procedures': proc_by_subject.size().reindex(subjects, fill_value=0).to_numpy(),
+        'count_unique_procedures_prior': proc_by_subject['icd_code'].nunique(dropna=False)
+            .reindex(subjects, fill_value=0).to_numpy(),
+        'count_prior_admissions_with_procedure': proc_by_subject['hadm_id'].nunique()
+            .reindex(subjects, fill_value=0).to_numpy(),
+        'time_since_last_major_surgery_years': years_since_surgery.to_numpy(),
+        'flag_procedure_in_last_prior_admission': last_prior_hadm_ids.reindex(subjects)
+            .isin(prior_proc['hadm_id']).astype(int).to_numpy(),
+    })
+
+    # Specific procedure flags
+    history = proc_flags.groupby('subject_id')[PROCEDURE_CLASSIFIER.labels].any().reindex(subjects, fill_value=False)
+    for procedure in PROCEDURE_CLASSIFIER.labels:
+        features[f"flag_history_{procedure}"] = history[procedure].astype(int).to_numpy()
+
+    return features
@@ -0,0 +1,219 @@
+import numpy as np
+import pandas as pd
+
+from assessment.config import ANEMIA_THRESH, HYPONATREMIA_THRESH
+
+# Value used for "no charttime seen yet", below any real datetime64[ns]
+NO_TIME = np.iinfo('int64').min
+
+
+def _latest(time_a, value_a, time_b, value_b):
+    """
+    Last charttime and value of two records: the later charttime wins, the larger value on equal charttimes,
+    so the result does not depend on the order the events are read in (chunks, shards, engines).
+    """
+    value = np.where(time_b > time_a, value_b, np.where(time_b == time_a, np.fmax(value_a, value_b), value_a))
+    return np.maximum(time_a, time_b), value
+
+
+class LabStatsAccumulator:
+    """
+    Array-backed lab statistics with one record per subject x lab x window:
+    count, mean, m2 (Welford), min, max, last_time and last_value.
+    Abnormality counts are kept per subject x window.
+
+    The store is sized by the cohort (subjects x labs x windows), not by the number of events,
+    and is updated in bulk from the grouped partials of each chunk.
+    """
+
+    FIELDS = ('count', 'mean', 'm2', 'min', 'max', 'last_time', 'last_value')
+    # Every array of the store, the record fields and the abnormality counts
+    ARRAYS = FIELDS + ('count_anemia', 'count_hyponatremia')
+
+    def __init__(self, subjects, lab_names, n_windows=1):
+        self.subjects = pd.Index(subjects, name='subject_id')
+        self.lab_names = list(lab_names)
+        self.n_windows = n_windows
+
+        shape = (len(self.subjects), len(self.lab_names), n_windows)
+        self.count = np.zeros(shape, dtype='int32')
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+        self.last_time = np.full(shape, NO_TIME, dtype='int64')
+        self.last_value = np.full(shape, np.nan)
+
+        self.count_anemia = np.zeros((len(self.subjects), n_windows), dtype='int32')
+        self.count_hyponatremia = np.zeros((len(self.subjects), n_windows), dtype='int32')
+
+        self._lab_codes = {lab: code for code, lab in enumerate(self.lab_names)}
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [getattr(self, field) for field in self.ARRAYS]
+        return sum(array.nbytes for array in arrays)
+
+    def update(self, events, window_idx=None):
+        """
+        Add lab events (subject_id, lab_name, charttime, valuenum) to the store.
+        `window_idx` gives the window of each event when the store has several windows.
+        Events of subjects or labs outside the store are ignored.
+        """
+        subject_idx = self.subjects.get_indexer(events['subject_id'])
+        lab_idx = events['lab_name'].map(self._lab_codes).fillna(-1).to_numpy(dtype='int64')
+        window = np.zeros(len(events), dtype='int64') if window_idx is None else np.asarray(window_idx, dtype='int64')
+
+        keep = (subject_idx >= 0) & (lab_idx >= 0)
+        if not keep.any():
+            return
+        subject_idx, lab_idx, window = subject_idx[keep], lab_idx[keep], window[keep]
+        values = events['valuenum'].to_numpy(dtype='float64')[keep]
+        times = events['charttime'].to_numpy(dtype='datetime64[ns]')[keep].astype('int64')
+        lab_names = events['lab_name'].to_numpy()[keep]
+
+        flat = np.ravel_multi_index((subject_idx, lab_idx, window), self.count.shape)
+        self._merge_partials(self._chunk_partials(flat, values, times))
+
+        # Abnormality counts per subject x window
+        anemia = (lab_names == 'hemoglobin') & (values < ANEMIA_THRESH)
+        np.add.at(self.count_anemia, (subject_idx[anemia], window[anemia]), 1)
+        hyponatremia = (lab_names == 'sodium') & (values < HYPONATREMIA_THRESH)
+        np.add.at(self.count_hyponatremia, (subject_idx[hyponatremia], window[hyponatremia]), 1)
+
+    @staticmethod
+    def _chunk_partials(flat, values, times) -> pd.DataFrame:
+        """
+        Grouped reductions of one chunk, one row per flat record index.
+        """
+        chunk = pd.DataFrame({'flat': flat, 'value': values, 'time': times})
+        grouped = chunk.groupby('flat', sort=False)
+        partials = grouped['value'].agg(['count', 'mean', 'min', 'max'])
+        partials['m2'] = grouped['value'].var(ddof=0) * partials['count']
+
+        # Last value = value at the latest charttime, the larger value wins on ties (see _latest)
+        timed = chunk[chunk['time'] != NO_TIME].sort_values(['time', 'value'], na_position='first')
+        last_rows = timed.drop_duplicates('flat', keep='last').set_index('flat')
+        partials['last_time'] = last_rows['time'].reindex(partials.index, fill_value=NO_TIME)
+        partials['last_value'] = last_rows['value'].reindex(partials.index)
+        return partials
+
+    def _merge_partials(self, partials):
+        idx = partials.index.to_numpy()
+        count, mean, m2 = (self.count.reshape(-1), self.mean.reshape(-1), self.m2.reshape(-1))
+
+        n_a = count[idx].astype('float64')
+        n_b = partials['count'].to_numpy(dtype='float64')
+        n = n_a + n_b
+        delta = partials['mean'].to_numpy() - mean[idx]
+        mean[idx] = mean[idx] + delta * n_b / n
+        m2[idx] = m2[idx] + partials['m2'].to_numpy() + delta ** 2 * n_a * n_b / n
+        count[idx] = n.astype('int32')
+
+        self.min.reshape(-1)[idx] = np.fmin(self.min.reshape(-1)[idx], partials['min'].to_numpy())
+        self.max.reshape(-1)[idx] = np.fmax(self.max.reshape(-1)[idx], partials['max'].to_numpy())
+
+        last_time, last_value = self.last_time.reshape(-1), self.last_value.reshape(-1)
+        last_time[idx], last_value[idx] = _latest(last_time[idx], last_value[idx],
+                                                  partials['last_time'].to_numpy(), partials['last_value'].to_numpy())
+
+    def take(self, subjects) -> 'LabStatsAccumulator':
+        """
+        New store holding only the records of `subjects` (which must be in the store).
+        """
+        rows = self.subjects.get_indexer(subjects)
+        result = LabStatsAccumulator(self.subjects[rows], self.lab_names, self.n_windows)
+        for field in self.ARRAYS:
+            setattr(result, field, getattr(self, field)[rows])
+        return result
+
+    @classmethod
+    def concat(cls, stores) -> 'LabStatsAccumulator':
+        """
+        Store holding the records of `stores`, built over disjoint subjects with the same labs and windows
+        (e.g. one per labevents shard).
+        """
+        result = cls(stores[0].subjects.append([store.subjects for store in stores[1:]]), stores[0].lab_names,
+                     stores[0].n_windows)
+        for field in cls.ARRAYS:
+            setattr(result, field, np.concatenate([getattr(store, field) for store in stores]))
+        return result
+
+    def save(self, path):
+        """
+        Persist the store to an .npz file, see load.
+        """
+        arrays = {field: getattr(self, field) for field in self.ARRAYS}
+        np.savez(path, subjects=self.subjects.to_numpy(), lab_names=np.array(self.lab_names, dtype=object),
+                 **arrays)
+
+    @classmethod
+    def load(cls, path) -> 'LabStatsAccumulator':
+        with np.load(path, allow_pickle=True) as saved:
+            result = cls(saved['subjects'], list(saved['lab_names']), saved['count'].shape[2])
+            for field in cls.ARRAYS:
+                setattr(result, field, saved[field])
+        return result
+
+    def cumulative(self) -> 'LabStatsAccumulator':
+        """
+        New store whose window k combines the records of windows 0..k.
+        """
+        result = LabStatsAccumulator(self.subjects, self.lab_names, self.n_windows)
+        for field in self.FIELDS:
+            getattr(result, field)[..., 0] = getattr(self, field)[..., 0]
+
+        for w in range(1, self.n_windows):
+            n_a = result.count[..., w - 1].astype('float64')
+            n_b = self.count[..., w].astype('float64')
+            n = n_a + n_b
+            with np.errstate(invalid='ignore', divide='ignore'):
+                delta = self.mean[..., w] - result.mean[..., w - 1]
+                result.mean[..., w] = np.where(n > 0, result.mean[..., w - 1] + delta * n_b / n, 0)
+                result.m2[..., w] = np.where(
+                    n > 0, result.m2[..., w - 1] + self.m2[..., w] + delta ** 2 * n_a * n_b / n, 0)
+            result.count[..., w] = n.astype('int32')
+            result.min[..., w] = np.fmin(result.min[..., w - 1], self.min[..., w])
+            result.max[..., w] = np.fmax(result.max[..., w - 1], self.max[..., w])
+
+            result.last_time[..., w], result.last_value[..., w] = _latest(
+                result.last_time[..., w - 1], result.last_value[..., w - 1],
+                self.last_time[..., w], self.last_value[..., w])
+
+        result.count_anemia = np.cumsum(self.count_anemia, axis=1, dtype='int32')
+        result.count_hyponatremia = np.cumsum(self.count_hyponatremia, axis=1, dtype='int32')
+        return result
+
+    def to_features(self, window, stat_col, last_col, observed=None) -> pd.DataFrame:
+        """
+        One feature row per subject for `window`, indexed by subject_id.
+        `stat_col(lab, stat)` and `last_col(lab)` name the per lab columns, in the order of lab_names.
+        Stats are only emitted for the `observed` labs (one flag per lab), by default the labs seen
+        in the window, last values for every lab.
+        """
+        count = self.count[..., window]
+        features = pd.DataFrame(index=self.subjects)
+        features['count_labevents'] = count.sum(axis=1)
+        features['count_unique_labs'] = (count > 0).sum(axis=1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(self.m2[..., window] / count)
+
+        lab_columns = {}
+        if observed is None:
+            observed = count.sum(axis=0) > 0
+        for code, lab in enumerate(self.lab_names):
+            if not observed[code]:
+                continue
+            seen = count[:, code] > 0
+            lab_columns[stat_col(lab, 'avg')] = np.where(seen, self.mean[:, code, window], np.nan)
+            lab_columns[stat_col(lab, 'min')] = np.where(seen, self.min[:, code, window], np.nan)
+            lab_columns[stat_col(lab, 'max')] = np.where(seen, self.max[:, code, window], np.nan)
+            lab_columns[stat_col(lab, 'std')] = np.where(seen, std[:, code], np.nan)
+        for code, lab in enumerate(self.lab_names):
+            lab_columns[last_col(lab)] = self.last_value[:, code, window]
+
+        features = pd.concat([features, pd.DataFrame(lab_columns, index=self.subjects)], axis=1)
+        features['count_severe_hyponatremia'] = self.count_hyponatremia[:, window]
+        features['flag_chronic_anemia'] = (self.count_anemia[:, window] >= 2).astype(int)
+        return features
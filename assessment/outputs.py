@@ -0,0 +1,208 @@
+from pathlib import Path
+import queue
+import threading
+import time
+
+from loguru import logger
+import pandas as pd
+
+from assessment.config import OUTPUT_COMPRESSION, OUTPUT_FORMAT, OUTPUT_QUEUE_SIZE
+from assessment.datasets import HAS_PYARROW
+
+# File suffix of each output format. Compressed csv files get the suffix pandas infers the compression from.
+OUTPUT_SUFFIXES = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+CSV_COMPRESSION_SUFFIXES = {'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz', 'zstd': '.zst', 'zip': '.zip'}
+
+_FORMAT_BY_SUFFIX = {
+    **{'.csv' + suffix: 'csv' for suffix in CSV_COMPRESSION_SUFFIXES.values()},
+    **{suffix: format for format, suffix in OUTPUT_SUFFIXES.items()},
+}
+
+
+def _split_suffix(path):
+    name = Path(path).name
+    for suffix, format in _FORMAT_BY_SUFFIX.items():
+        if name.endswith(suffix):
+            return name[:-len(suffix)], format
+    return name, None
+
+
+def output_format(path):
+    """
+    Format of the output file `path` from its suffix, None for other files.
+    """
+    return _split_suffix(path)[1]
+
+
+def output_path(path, format = OUTPUT_FORMAT, compression = OUTPUT_COMPRESSION) -> Path:
+    """
+    `path` with the suffix of `format`, e.g. data/processed/hosp/diagnosis_feat_df.parquet.
+    """
+    suffix = OUTPUT_SUFFIXES[format]
+    if format == 'csv' and compression:
+        suffix += CSV_COMPRESSION_SUFFIXES[compression]
+    path = Path(path)
+    return path.with_name(_split_suffix(path)[0] + suffix)
+
+
+def output_columns(path) -> list:
+    """
+    Column names of the output file `path`, without reading its rows.
+    """
+    format = output_format(path)
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_schema(path).names
+    if format == 'feather':
+        import pyarrow as pa
+        return pa.ipc.open_file(path).schema.names
+    return pd.read_csv(path, nrows=0).columns.tolist()
+
+
+def read_output(path, columns = None) -> pd.DataFrame:
+    """
+    Read the output file `path` (any format), only `columns` when given.
+    """
+    format = output_format(path)
+    if format == 'parquet':
+        return pd.read_parquet(path, columns=columns)
+    if format == 'feather':
+        return pd.read_feather(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
+
+
+def _as_columnar(df) -> pd.DataFrame:
+    """
+    `df` with the columns mixing text and numbers, e.g. the locations whose missing values are filled
+    with 0, turned to text, which a parquet or feather column requires.
+    """
+    df = df.copy(deep=False)
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            if pd.api.types.infer_dtype(df[col].cat.categories).startswith('mixed'):
+                df[col] = df[col].cat.rename_categories(str)
+        elif df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True).startswith('mixed'):
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+
+class OutputWriter:
+    """
+    Saves the pipeline outputs as `format` ('csv', 'parquet' or 'feather'), compressed with `compression`
+    when given ('gzip', 'zstd', ... for csv, 'zstd', 'gzip', ... for parquet and feather, which are
+    compressed with snappy and lz4 otherwise). The columnar formats fall back to csv without pyarrow.
+
+    With `background`, write() queues the DataFrame and returns its path at once, and a writer thread
+    saves the queued frames in order, so the next stage computes while the previous one is written.
+    At most `queue_size` frames wait, write() blocks while the queue is full. A queued frame must not
+    be modified. flush() waits for the queued frames and raises the error of a failed write.
+    """
+
+    def __init__(self, format = OUTPUT_FORMAT, compression = OUTPUT_COMPRESSION, queue_size = OUTPUT_QUEUE_SIZE,
+                 background = True):
+        if format not in OUTPUT_SUFFIXES:
+            raise ValueError(f"Unknown output format {format}, expected one of {list(OUTPUT_SUFFIXES)}")
+        if format != 'csv' and not HAS_PYARROW:
+            logger.warning(f"pyarrow is not installed, outputs are saved as csv instead of {format}")
+            format = 'csv'
+            compression = compression if compression in CSV_COMPRESSION_SUFFIXES else None
+        if format == 'csv' and compression is not None and compression not in CSV_COMPRESSION_SUFFIXES:
+            raise ValueError(f"Unknown csv compression {compression}, expected one of {list(CSV_COMPRESSION_SUFFIXES)}")
+        self.format = format
+        self.compression = compression
+        self._errors = []
+        self._queue = queue.Queue(maxsize=queue_size) if background else None
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._run, name='output-writer', daemon=True)
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # An error of the pipeline itself is not hidden by one of the writer
+        if exc_type is None:
+            self.close()
+        else:
+            self._stop()
+
+    def path_for(self, path) -> Path:
+        return output_path(path, self.format, self.compression)
+
+    def save(self, df, path) -> Path:
+        """
+        Save `df` to `path`, with the suffix of the format, in the calling thread.
+        """
+        path = self.path_for(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        options = {} if self.compression is None else {'compression': self.compression}
+        if self.format == 'parquet':
+            _as_columnar(df).to_parquet(path, index=False, **options)
+        elif self.format == 'feather':
+            _as_columnar(df).reset_index(drop=True).to_feather(path, **options)
+        else:
+            df.to_csv(path, index=False, **options)
+        return path
+
+    def write(self, df, path, name = None, save = None) -> Path:
+        """
+        Save `df` to `path` on the writer thread (in the calling thread without background) and log where it landed.
+
+        name: what is saved, for the log, the file name by default
+        save: save(df, path) used instead of OutputWriter.save, e.g. to compact the frame first
+        Returns the path of the file, with the suffix of the format.
+        """
+        path = self.path_for(path)
+        job = (df, path, name or path.stem, save or self.save)
+        if self._queue is None:
+            self._save_logged(*job)
+        else:
+            self._queue.put(job)
+        return path
+
+    def _save_logged(self, df, path, name, save):
+        start = time.perf_counter()
+        save(df, path)
+        logger.info(f"{name} saved to {path} ({time.perf_counter() - start:.1f}s)")
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._save_logged(*job)
+            # Any failure is handed to the caller, raised again by flush() or close()
+            except Exception as error:  # noqa: BLE001
+                logger.error(f"Saving {job[2]} to {job[1]} failed: {error!r}")
+                self._errors.append(error)
+            finally:
+                self._queue.task_done()
+
+    def _raise_errors(self):
+        if self._errors:
+            error, self._errors = self._errors[0], []
+            raise error
+
+    def flush(self):
+        """
+        Wait until every queued frame is saved.
+        """
+        if self._queue is not None:
+            self._queue.join()
+        self._raise_errors()
+
+    def _stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            # Frames written after close() are saved in the calling thread
+            self._thread, self._queue = None, None
+
+    def close(self):
+        """
+        Save the queued frames and stop the writer thread.
+        """
+        self._stop()
+        self._raise_errors()
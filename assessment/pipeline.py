@@ -0,0 +1,194 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import os
+
+from loguru import logger
+
+from assessment.config import PIPELINE_WORKERS
+from assessment.profiling import count_rows, profile_block
+from assessment.stage_cache import stage_key, value_digest
+
+# Cores the running stage may use for its own workers, see stage_cpu_budget
+_cpu_budget = os.cpu_count() or 1
+
+
+class Stage:
+    """
+    One step of a pipeline DAG.
+    func(*inputs) is called with the values named by `inputs` and returns
+    Dict[output] = value holding every name in `outputs`.
+    func must be importable (module level) to run in a worker process.
+
+    sources, config and code feed the stage cache key (see stage_cache.stage_key):
+    the raw files the stage reads, the names of the config.py values it depends on
+    and the modules implementing it.
+    artifacts: Dict[output] = path the output is saved to by the run's OutputWriter,
+               the suffix is set by the output format
+    cpu_budget: cores the stage may use for workers of its own whatever runs next to it,
+                by default an equal share of the cores per concurrent stage
+    """
+
+    def __init__(self, name, func, inputs, outputs, sources = (), config = (), code = (), artifacts = None,
+                 cpu_budget = None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.sources = list(sources)
+        self.config = list(config)
+        self.code = list(code)
+        self.artifacts = dict(artifacts or {})
+        self.cpu_budget = cpu_budget
+
+    def __repr__(self):
+        return f"Stage({self.name}: {self.inputs} -> {self.outputs})"
+
+
+def _check_dag(stages, initial):
+    producers = {name: '<initial>' for name in initial}
+    for stage in stages:
+        for output in stage.outputs:
+            if output in producers:
+                raise ValueError(f"{output} is produced by both {producers[output]} and {stage.name}")
+            producers[output] = stage.name
+    for stage in stages:
+        missing = [name for name in stage.inputs if name not in producers]
+        if missing:
+            raise ValueError(f"Stage {stage.name} needs {missing}, which no stage produces")
+
+
+def stage_cpu_budget() -> int:
+    """
+    Cores the running stage may use for a pool of its own: every core when stages run one at a time,
+    its Stage.cpu_budget or an equal share of the cores per concurrent stage when they run in a pool.
+    """
+    return _cpu_budget
+
+
+def _run_stage(stage, args, profile_dir = None, cpu_budget = None):
+    global _cpu_budget
+    _cpu_budget = cpu_budget or os.cpu_count() or 1
+    with profile_block(stage.name, rows_in=count_rows(args), profile_dir=profile_dir) as record:
+        outputs = stage.func(*args)
+        record['rows_out'] = count_rows(outputs)
+    missing = set(stage.outputs) - set(outputs)
+    if missing:
+        raise ValueError(f"Stage {stage.name} did not return {sorted(missing)}")
+    return outputs, record
+
+
+def run_stages(stages, initial, max_workers = PIPELINE_WORKERS, cache = None, report = None, writer = None):
+    """
+    Run `stages` in dependency order, independent stages in parallel in a pool of at most
+    `max_workers` processes (in this process when max_workers <= 1).
+
+    initial: Dict[name] = value available to every stage before the run, e.g. the cohort
+    cache: StageCache, stages whose key matches a stored entry are skipped and their
+           outputs loaded; outputs of the stages that ran are stored
+    report: RunReport receiving the profiling record of every stage
+    writer: OutputWriter saving the artifacts of the stages that ran, in the background, and
+            the missing artifacts of the stages loaded from the cache (deleted, or saved in
+            another output format)
+    Yields (stage, outputs) as soon as each stage finishes, so results can be consumed
+    while the remaining stages still run.
+    """
+    _check_dag(stages, initial)
+    values = dict(initial)
+    pending = list(stages)
+    digests, keys = {}, {}
+
+    profile_dir = report.profile_dir if report is not None else None
+
+    def cached(stage):
+        if cache is None:
+            return None
+        with profile_block(stage.name) as record:
+            for name in stage.inputs:
+                if name not in digests:
+                    digests[name] = value_digest(values[name])
+            keys[stage.name] = stage_key(stage, digests)
+            outputs = cache.load(stage, keys[stage.name])
+            record['rows_out'] = count_rows(outputs)
+        if outputs is not None:
+            logger.info(f"Stage {stage.name} is up to date, loaded its outputs from the stage cache")
+            if report is not None:
+                report.add({**record, 'cached': True})
+            save_artifacts(stage, outputs, missing_only=True)
+        return outputs
+
+    def save_artifacts(stage, outputs, missing_only = False):
+        if writer is None:
+            return
+        for name, path in stage.artifacts.items():
+            if not (missing_only and writer.path_for(path).exists()):
+                writer.write(outputs[name], path, name=f"Stage {stage.name} output {name}")
+
+    def finished(stage, outputs, record):
+        if cache is not None:
+            cache.save(stage, keys[stage.name], outputs)
+        if report is not None:
+            report.add({**record, 'cached': False})
+        save_artifacts(stage, outputs)
+        values.update(outputs)
+
+    def ready():
+        runnable = [stage for stage in pending if all(name in values for name in stage.inputs)]
+        for stage in runnable:
+            pending.remove(stage)
+        return runnable
+
+    if max_workers <= 1:
+        while pending:
+            runnable = ready()
+            if not runnable:
+                raise ValueError(f"Stages {pending} have cyclic dependencies")
+            for stage in runnable:
+                outputs = cached(stage)
+                if outputs is not None:
+                    values.update(outputs)
+                    yield stage, outputs
+                    continue
+                logger.info(f"Running stage {stage.name}")
+                outputs, record = _run_stage(stage, [values[name] for name in stage.inputs], profile_dir)
+                finished(stage, outputs, record)
+                yield stage, outputs
+        return
+
+    # Stages with workers of their own share the cores with the concurrent stages, unless they set
+    # their own budget: the lab stage outlives the other feature stages and keeps the cores they free
+    cpu_count = os.cpu_count() or 1
+    shared_budget = max(1, cpu_count // min(max_workers, len(stages)))
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        running = {}
+        forked = False
+        while pending or running:
+            runnable = ready()
+            while runnable:
+                for stage in runnable:
+                    outputs = cached(stage)
+                    if outputs is not None:
+                        values.update(outputs)
+                        yield stage, outputs
+                        continue
+                    # The workers are forked on the first submit. Forking while the writer thread holds
+                    # a lock (e.g. of the Arrow allocator) could leave it locked forever in the workers
+                    if writer is not None and not forked:
+                        writer.flush()
+                        forked = True
+                    logger.info(f"Submitting stage {stage.name}")
+                    args = [values[name] for name in stage.inputs]
+                    cpu_budget = min(stage.cpu_budget or shared_budget, cpu_count)
+                    running[pool.submit(_run_stage, stage, args, profile_dir, cpu_budget)] = stage
+                # Stages loaded from the cache can make their dependents runnable
+                runnable = ready()
+            if not running:
+                if pending:
+                    raise ValueError(f"Stages {pending} have cyclic dependencies")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                outputs, record = future.result()
+                logger.info(f"Stage {stage.name} finished in {record['wall_s']:.1f}s")
+                finished(stage, outputs, record)
+                yield stage, outputs
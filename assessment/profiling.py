@@ -0,0 +1,183 @@
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+from functools import wraps
+import json
+import os
+from pathlib import Path
+import platform
+import resource
+import sys
+import time
+
+from loguru import logger
+import pandas as pd
+
+from assessment.config import PROFILE_CPROFILE, RUN_REPORTS_DIR
+
+# Raw chunks read by the chunk iterators of this process, see record_chunk
+_chunk_counters = {'chunks': 0, 'chunk_rows': 0}
+
+# Records of the profiled blocks open in this process, innermost last
+_open_records = []
+
+
+def record_chunk(rows):
+    """
+    Count one chunk of `rows` rows read from a raw table, for the chunk throughput of the open blocks.
+    """
+    _chunk_counters['chunks'] += 1
+    _chunk_counters['chunk_rows'] += rows
+
+
+def count_rows(value) -> int:
+    """
+    Rows of the DataFrames and Series in `value`, searched through dicts, lists and tuples.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(count_rows(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(count_rows(item) for item in value)
+    return 0
+
+
+def _peak_rss_mb(who = resource.RUSAGE_SELF) -> float:
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+
+def _bytes_read():
+    """
+    Bytes read by this process so far, from /proc/self/io (Linux only, None elsewhere).
+    """
+    try:
+        with open('/proc/self/io') as io_stats:
+            for line in io_stats:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def _children_cpu_s() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+@contextmanager
+def profile_block(name, rows_in = 0, profile_dir = None):
+    """
+    Measure the block: wall and CPU time, peak RSS, bytes read and raw chunk throughput.
+    Yields the record (a dict), set record['rows_out'] inside the block.
+    Records of blocks opened inside this one are nested in its 'steps'.
+
+    profile_dir: when given, cProfile stats of the block are written to profile_dir/<name>.prof
+                 (outermost block of a process only, cProfile cannot be nested)
+    """
+    record = {
+        'name': name, 'pid': os.getpid(), 'started_at': datetime.now().isoformat(timespec='seconds'),
+        'rows_in': rows_in, 'rows_out': None, 'steps': [],
+    }
+    start_wall, start_cpu, start_children_cpu = time.perf_counter(), time.process_time(), _children_cpu_s()
+    start_rss, start_read, start_chunks = _peak_rss_mb(), _bytes_read(), dict(_chunk_counters)
+
+    profiler = cProfile.Profile() if profile_dir is not None and not _open_records else None
+    _open_records.append(record)
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            Path(profile_dir).mkdir(parents=True, exist_ok=True)
+            record['cprofile'] = str(Path(profile_dir) / f"{name}.prof")
+            profiler.dump_stats(record['cprofile'])
+        _open_records.pop()
+
+        wall = time.perf_counter() - start_wall
+        chunks = _chunk_counters['chunks'] - start_chunks['chunks']
+        chunk_rows = _chunk_counters['chunk_rows'] - start_chunks['chunk_rows']
+        end_read = _bytes_read()
+        record.update({
+            'wall_s': round(wall, 4),
+            'cpu_s': round(time.process_time() - start_cpu, 4),
+            # CPU of the worker processes of the block that exited (e.g. lab feature shards)
+            'cpu_children_s': round(_children_cpu_s() - start_children_cpu, 4),
+            'peak_rss_mb': _peak_rss_mb(),
+            'peak_rss_increase_mb': round(_peak_rss_mb() - start_rss, 1),
+            'bytes_read': end_read - start_read if end_read is not None else None,
+            'chunks': chunks,
+            'chunk_rows': chunk_rows,
+            'chunks_per_s': round(chunks / wall, 2) if wall > 0 else None,
+            'chunk_rows_per_s': round(chunk_rows / wall, 1) if wall > 0 else None,
+        })
+        record['steps'] = record.pop('steps')
+        if _open_records:
+            _open_records[-1]['steps'].append(record)
+
+
+def profiled(func):
+    """
+    Decorator profiling every call of `func` as a step of the enclosing profiled block.
+    rows_in and rows_out count the rows of the DataFrame arguments and result.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with profile_block(func.__name__, rows_in=count_rows(args) + count_rows(kwargs)) as record:
+            result = func(*args, **kwargs)
+            record['rows_out'] = count_rows(result)
+        return result
+    return wrapper
+
+
+class RunReport:
+    """
+    Stage records of one pipeline run, saved as a JSON report to compare runs.
+    With `cprofile`, every stage also writes cProfile stats next to the report
+    (inspect with `python -m pstats` or snakeviz). Each record holds the pid of the
+    process running the stage, to attach a sampling profiler such as py-spy.
+    """
+
+    def __init__(self, name = 'pipeline', reports_dir = RUN_REPORTS_DIR, cprofile = PROFILE_CPROFILE):
+        self.name = name
+        self.started_at = datetime.now()
+        self.run_id = self.started_at.strftime('%Y%m%d_%H%M%S') + f"_{os.getpid()}"
+        self.reports_dir = Path(reports_dir)
+        self.profile_dir = self.reports_dir / f"{self.name}_{self.run_id}_cprofile" if cprofile else None
+        self.stages = []
+        self._start_wall = time.perf_counter()
+
+    def add(self, record):
+        self.stages.append(record)
+
+    @contextmanager
+    def block(self, name, rows_in = 0):
+        """
+        Profile a block of the driver process as one more stage of the report.
+        """
+        with profile_block(name, rows_in) as record:
+            yield record
+        self.add(record)
+
+    def save(self) -> Path:
+        report = {
+            'run': self.name,
+            'run_id': self.run_id,
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'wall_s': round(time.perf_counter() - self._start_wall, 4),
+            'peak_rss_mb': _peak_rss_mb(),
+            'peak_rss_children_mb': _peak_rss_mb(resource.RUSAGE_CHILDREN),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'cpu_count': os.cpu_count(),
+            'stages': self.stages,
+        }
+        self.reports_dir.mkdir(parents=True, exist_ok=True)
+        report_path = self.reports_dir / f"{self.name}_{self.run_id}.json"
+        report_path.write_text(json.dumps(report, indent=2))
+        logger.info(f"Run report saved to {report_path}")
+        return report_path
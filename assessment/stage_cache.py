@@ -0,0 +1,104 @@
+import hashlib
+import importlib.util
+import inspect
+import json
+import os
+from pathlib import Path
+import pickle
+import shutil
+
+from loguru import logger
+import pandas as pd
+
+from assessment import config
+from assessment.config import STAGE_CACHE_DIR, STAGE_CACHE_KEEP
+from assessment.datasets import HOSP_TABLE_SCHEMAS, LABEVENTS_DTYPES, source_fingerprint
+
+# Config every stage output depends on, on top of Stage.config: how raw timestamps are parsed
+SHARED_CONFIG = ['MIMIC_DATETIME_FORMAT', 'MIMIC_DATE_FORMAT']
+
+
+def value_digest(value) -> str:
+    """
+    Content hash of a stage input value.
+    """
+    digest = hashlib.sha256()
+    if isinstance(value, pd.DataFrame):
+        digest.update(pd.util.hash_pandas_object(value, index=False).to_numpy().tobytes())
+        digest.update(json.dumps([[str(col), str(dtype)] for col, dtype in value.dtypes.items()]).encode())
+    else:
+        digest.update(pickle.dumps(value))
+    return digest.hexdigest()
+
+
+def _file_digest(path) -> str:
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
+def code_digest(stage) -> dict:
+    """
+    Hash of the source of the stage function and of the modules listed in stage.code.
+    """
+    digests = {module: _file_digest(importlib.util.find_spec(module).origin) for module in stage.code}
+    try:
+        digests[stage.func.__qualname__] = hashlib.sha256(inspect.getsource(stage.func).encode()).hexdigest()
+    except (OSError, TypeError):
+        digests[stage.func.__qualname__] = stage.func.__qualname__
+    return digests
+
+
+def stage_key(stage, input_digests) -> str:
+    """
+    Cache key of a stage: digest of its input values, raw source files, config values (SHARED_CONFIG and
+    the stage's own), the dtypes the raw tables are read with and code.
+    """
+    parts = {
+        'stage': stage.name,
+        'inputs': {name: input_digests[name] for name in stage.inputs},
+        'sources': [source_fingerprint(path) for path in stage.sources],
+        'config': {name: repr(getattr(config, name)) for name in [*SHARED_CONFIG, *stage.config]},
+        'schemas': repr(HOSP_TABLE_SCHEMAS) + repr(LABEVENTS_DTYPES),
+        'code': code_digest(stage),
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:32]
+
+
+class StageCache:
+    """
+    Content-addressed store of stage outputs: cache_dir/<stage>/<key>/<output>.pkl.
+    The `keep` most recently written keys are kept per stage.
+    """
+
+    def __init__(self, cache_dir = STAGE_CACHE_DIR, keep = STAGE_CACHE_KEEP):
+        self.cache_dir = Path(cache_dir)
+        self.keep = keep
+
+    def load(self, stage, key):
+        """
+        Outputs stored for `key`, or None when the stage has to run.
+        """
+        entry_dir = self.cache_dir / stage.name / key
+        if not (entry_dir / "manifest.json").exists():
+            return None
+        outputs = {name: pd.read_pickle(entry_dir / f"{name}.pkl") for name in stage.outputs}
+        os.utime(entry_dir)
+        return outputs
+
+    def save(self, stage, key, outputs):
+        stage_dir = self.cache_dir / stage.name
+        entry_dir = stage_dir / key
+        tmp_dir = stage_dir / f"{key}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+        for name in stage.outputs:
+            pd.to_pickle(outputs[name], tmp_dir / f"{name}.pkl")
+        (tmp_dir / "manifest.json").write_text(json.dumps({'stage': stage.name, 'outputs': stage.outputs}))
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+        logger.info(f"Stored outputs of stage {stage.name} in {entry_dir}")
+
+        # Keep only the most recent entries of the stage
+        entries = sorted((path for path in stage_dir.iterdir() if path.is_dir() and not path.name.endswith('.tmp')),
+                         key=lambda path: path.stat().st_mtime, reverse=True)
+        for path in entries[self.keep:]:
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,466 @@
+from contextlib import ExitStack
+import json
+import os
+from pathlib import Path
+
+from loguru import logger
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+import typer
+
+from assessment.config import (
+    DRUG_CLASS_MAP,
+    ICD_CONDITION_MAP,
+    LAB_ITEM_ID_MAP,
+    PROCEDURE_ICD_MAP,
+    SYNTHETIC_HOSP_DATA_DIR,
+)
+from assessment.datasets import HAS_PYARROW
+
+app = typer.Typer()
+
+# Column layout of the MIMIC-IV 2.1 hosp tables
+HOSP_TABLE_COLUMNS = {
+    'patients': ['subject_id', 'gender', 'anchor_age', 'anchor_year', 'anchor_year_group', 'dod'],
+    'admissions': [
+        'subject_id', 'hadm_id', 'admittime', 'dischtime', 'deathtime', 'admission_type', 'admit_provider_id',
+        'admission_location', 'discharge_location', 'insurance', 'language', 'marital_status', 'race',
+        'edregtime', 'edouttime', 'hospital_expire_flag',
+    ],
+    'diagnoses_icd': ['subject_id', 'hadm_id', 'seq_num', 'icd_code', 'icd_version'],
+    'procedures_icd': ['subject_id', 'hadm_id', 'seq_num', 'chartdate', 'icd_code', 'icd_version'],
+    'prescriptions': [
+        'subject_id', 'hadm_id', 'pharmacy_id', 'poe_id', 'poe_seq', 'order_provider_id', 'starttime', 'stoptime',
+        'drug_type', 'drug', 'formulary_drug_cd', 'gsn', 'ndc', 'prod_strength', 'form_rx', 'dose_val_rx',
+        'dose_unit_rx', 'form_val_disp', 'form_unit_disp', 'doses_per_24_hrs', 'route',
+    ],
+    'd_labitems': ['itemid', 'label', 'fluid', 'category'],
+    'labevents': [
+        'labevent_id', 'subject_id', 'hadm_id', 'specimen_id', 'itemid', 'order_provider_id', 'charttime',
+        'storetime', 'value', 'valuenum', 'valueuom', 'ref_range_lower', 'ref_range_upper', 'flag', 'priority',
+        'comments',
+    ],
+}
+# Columns holding a date without time
+HOSP_DATE_COLUMNS = {'patients': ['dod'], 'procedures_icd': ['chartdate']}
+
+FIRST_SUBJECT_ID = 10000000
+FIRST_HADM_ID = 20000000
+
+# Admissions per subject: 1 + negative binomial, overdispersed so a few subjects have dozens
+ADMISSIONS_NB_R, ADMISSIONS_NB_P = 0.5, 0.25
+MEAN_ADMISSIONS = 1 + ADMISSIONS_NB_R * (1 - ADMISSIONS_NB_P) / ADMISSIONS_NB_P
+# Length of stay in days ~ gamma(shape, scale)
+LOS_SHAPE, LOS_SCALE = 1.3, 4.0
+# Subjects dying, and the share of those deaths happening during their last admission
+DEATH_RATE, IN_HOSPITAL_DEATH_RATE = 0.25, 0.4
+# Spread of the per subject lab intensity (lognormal with mean 1), the source of the heavy tail
+LAB_INTENSITY_SIGMA = 1.0
+# Share of lab events of items outside LAB_ITEM_ID_MAP, and of events outside any admission
+OTHER_LAB_RATE, OUTPATIENT_LAB_RATE = 0.25, 0.1
+# Lab events come in panels of this many labs sharing a specimen and a charttime (minute resolution)
+LAB_PANEL_SIZE = 8
+
+# (mean, sd, unit) of the values of each lab of LAB_ITEM_ID_MAP
+LAB_VALUE_DISTRIBUTIONS = {
+    'glucose': (125, 45, 'mg/dL'), 'hemoglobin': (10.8, 2.2, 'g/dL'), 'lactate': (2.2, 1.6, 'mmol/L'),
+    'potassium': (4.2, 0.7, 'mEq/L'), 'albumin': (3.3, 0.7, 'g/dL'), 'bicarbonate': (24, 4.5, 'mEq/L'),
+    'creatinine': (1.4, 1.2, 'mg/dL'), 'sodium': (138, 5, 'mEq/L'), 'urea nitrogen': (26, 18, 'mg/dL'),
+    'hematocrit': (32, 6, '%'), 'bilirubin': (1.3, 1.8, 'mg/dL'), 'wbc': (9.5, 4.5, 'K/uL'),
+    'bun': (26, 18, 'mg/dL'),
+}
+OTHER_LAB_ITEMS = {
+    50902: 'Chloride', 50868: 'Anion Gap', 50960: 'Magnesium', 50970: 'Phosphate', 51265: 'Platelet Count',
+    51301: 'White Blood Cells', 51237: 'INR(PT)', 51274: 'PT', 51275: 'PTT', 50820: 'pH',
+}
+
+FILLER_ICD_CODES = ['4019', 'E785', 'Z7901', '2724', 'I10', 'K219', 'F329', 'Z87891', '3051', 'E039', 'D649', 'N390']
+FILLER_PROCEDURE_CODES = ['0040', '8856', '3893', '9904', '0BH17EZ', '02HV33Z', '5A1955Z', '3E0G76Z']
+FILLER_DRUGS = [
+    'Sodium Chloride 0.9%  Flush', 'Acetaminophen', 'Potassium Chloride', 'Docusate Sodium', 'Senna', 'Ondansetron',
+    'Pantoprazole', 'Bag', 'Magnesium Sulfate', 'Metoprolol Tartrate', 'Atorvastatin', 'OxyCODONE (Immediate Release)',
+]
+
+
+def _zipf_weights(n, exponent = 1.1):
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def _zipf_choice(rng, values, size, exponent = 1.1):
+    """
+    Draw from `values` with Zipf-like frequencies, the first values being the most common.
+    """
+    return np.asarray(values, dtype=object)[rng.choice(len(values), size, p=_zipf_weights(len(values), exponent))]
+
+
+def _repeat_rows(counts):
+    """
+    Index of the parent row of every child row, `counts` children per parent.
+    """
+    return np.repeat(np.arange(len(counts)), counts)
+
+
+def _seconds(values):
+    return np.asarray(values, dtype='float64').astype('int64').astype('timedelta64[s]')
+
+
+class _CsvWriter:
+    """
+    Append DataFrame chunks to the open binary file `file` as a csv with the MIMIC layout (header row,
+    no index, empty nulls), with the streaming Arrow csv writer when pyarrow is installed.
+    The caller closes the file after close().
+    """
+
+    def __init__(self, file, columns, date_columns = ()):
+        self.columns = columns
+        self.date_columns = list(date_columns)
+        self.rows = 0
+        self._file = file
+        self._file.write((",".join(columns) + "\n").encode())
+        self._arrow_writer = None
+        self._schema = None
+
+    def write(self, df):
+        df = df[self.columns]
+        if HAS_PYARROW:
+            import pyarrow as pa
+            import pyarrow.csv as pa_csv
+
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._schema is None:
+                # Fixed by the first chunk: all-null columns are text, date columns are dates
+                self._schema = pa.schema([
+                    pa.field(field.name, pa.date32() if field.name in self.date_columns
+                             else pa.string() if pa.types.is_null(field.type) else field.type)
+                    for field in table.schema
+                ])
+                self._arrow_writer = pa_csv.CSVWriter(self._file, self._schema, write_options=pa_csv.WriteOptions(
+                    include_header=False, quoting_style='needed'))
+            self._arrow_writer.write_table(table.cast(self._schema))
+        else:
+            dates = {col: df[col].dt.strftime('%Y-%m-%d') for col in self.date_columns}
+            df.assign(**dates).to_csv(self._file, header=False, index=False, date_format='%Y-%m-%d %H:%M:%S')
+        self.rows += len(df)
+
+    def close(self):
+        if self._arrow_writer is not None:
+            self._arrow_writer.close()
+
+
+def _lab_items():
+    """
+    d_labitems of the synthetic tables: the items of LAB_ITEM_ID_MAP labelled with their lab
+    name, so that they match LAB_KEYWORDS, and OTHER_LAB_ITEMS.
+    """
+    items = pd.DataFrame(
+        [(itemid, lab_name.title(), lab_name) for lab_name, itemids in LAB_ITEM_ID_MAP.items() for itemid in itemids]
+        + [(itemid, label, None) for itemid, label in OTHER_LAB_ITEMS.items()],
+        columns=['itemid', 'label', 'lab_name'],
+    )
+    items['fluid'] = 'Blood'
+    items['category'] = np.where(items['lab_name'].isin(['hemoglobin', 'hematocrit', 'wbc']), 'Hematology',
+                                 'Chemistry')
+    mean_sd_unit = items['lab_name'].map(LAB_VALUE_DISTRIBUTIONS)
+    items['mean'] = [value[0] if isinstance(value, tuple) else 50.0 for value in mean_sd_unit]
+    items['sd'] = [value[1] if isinstance(value, tuple) else 15.0 for value in mean_sd_unit]
+    items['unit'] = [value[2] if isinstance(value, tuple) else 'units' for value in mean_sd_unit]
+    return items
+
+
+def _admissions_batch(rng, subject_ids, first_hadm_id):
+    """
+    Patients and admissions of one batch of subjects, and per admission frame used by the event tables.
+    """
+    n_subjects = len(subject_ids)
+    n_adms = 1 + rng.negative_binomial(ADMISSIONS_NB_R, ADMISSIONS_NB_P, n_subjects)
+    adm_subject = _repeat_rows(n_adms)
+    n = len(adm_subject)
+
+    # Consecutive stays of each subject, separated by gaps of weeks to years
+    first_admit = (np.datetime64('2110-01-01T00:00:00')
+                   + _seconds(rng.uniform(0, 100 * 365 * 86400, n_subjects)))
+    los = _seconds(rng.gamma(LOS_SHAPE, LOS_SCALE, n) * 86400 + 3600)
+    gaps = _seconds(rng.exponential(200 * 86400, n))
+    gaps[np.r_[0, np.cumsum(n_adms)[:-1]]] = np.timedelta64(0, 's')
+    elapsed = pd.Series(gaps + los).groupby(adm_subject).cumsum().to_numpy().astype('timedelta64[s]')
+    admittime = first_admit[adm_subject] + elapsed - los
+    dischtime = admittime + los
+
+    # Deaths: during the last admission (hospital_expire_flag) or some time after discharge
+    last_adm = np.cumsum(n_adms) - 1
+    dies = rng.random(n_subjects) < DEATH_RATE
+    in_hospital = dies & (rng.random(n_subjects) < IN_HOSPITAL_DEATH_RATE)
+    deathtime = np.full(n, np.datetime64('NaT'), dtype='datetime64[s]')
+    death_in_stay = admittime[last_adm] + (los[last_adm] * rng.uniform(0.05, 1.0, n_subjects)).astype('timedelta64[s]')
+    deathtime[last_adm[in_hospital]] = death_in_stay[in_hospital]
+    dischtime = np.where(np.isnat(deathtime), dischtime, deathtime)
+    after_discharge = dischtime[last_adm] + _seconds(rng.exponential(300 * 86400, n_subjects) + 86400)
+    dod = np.where(in_hospital, deathtime[last_adm], after_discharge).astype('datetime64[D]')
+    dod[~dies] = np.datetime64('NaT')
+    expire = ~np.isnat(deathtime)
+
+    anchor_age = np.clip(rng.normal(58, 19, n_subjects), 0, 91).astype(int)
+    patients = pd.DataFrame({
+        'subject_id': subject_ids,
+        'gender': rng.choice(['F', 'M'], n_subjects),
+        'anchor_age': anchor_age,
+        'anchor_year': first_admit.astype('datetime64[Y]').astype(int) + 1970,
+        'anchor_year_group': rng.choice(['2008 - 2010', '2011 - 2013', '2014 - 2016', '2017 - 2019', '2020 - 2022'],
+                                        n_subjects),
+        'dod': dod.astype('datetime64[s]'),
+    })
+
+    emergency = rng.random(n) < 0.7
+    edregtime = np.where(emergency, admittime - _seconds(rng.uniform(3600, 12 * 3600, n)), np.datetime64('NaT'))
+    admissions = pd.DataFrame({
+        'subject_id': subject_ids[adm_subject],
+        'hadm_id': np.arange(first_hadm_id, first_hadm_id + n),
+        'admittime': admittime,
+        'dischtime': dischtime,
+        'deathtime': deathtime,
+        'admission_type': np.where(emergency, _zipf_choice(rng, ['EW EMER.', 'EU OBSERVATION', 'OBSERVATION ADMIT',
+                                                                 'URGENT', 'DIRECT EMER.'], n),
+                                   _zipf_choice(rng, ['ELECTIVE', 'SURGICAL SAME DAY ADMISSION',
+                                                      'DIRECT OBSERVATION', 'AMBULATORY OBSERVATION'], n)),
+        'admit_provider_id': pd.Series(rng.integers(1, 20000, n)).map('P{:05d}'.format),
+        'admission_location': np.where(emergency, 'EMERGENCY ROOM',
+                                       _zipf_choice(rng, ['PHYSICIAN REFERRAL', 'TRANSFER FROM HOSPITAL',
+                                                          'WALK-IN/SELF REFERRAL', 'CLINIC REFERRAL'], n)),
+        'discharge_location': np.where(expire, 'DIED', _zipf_choice(
+            rng, ['HOME', 'HOME HEALTH CARE', 'SKILLED NURSING FACILITY', 'REHAB', None, 'HOSPICE'], n)),
+        'insurance': _zipf_choice(rng, ['Other', 'Medicare', 'Medicaid'], n),
+        'language': np.where(rng.random(n) < 0.9, 'ENGLISH', '?'),
+        'marital_status': _zipf_choice(rng, ['MARRIED', 'SINGLE', 'WIDOWED', None, 'DIVORCED'], n),
+        'race': _zipf_choice(rng, [
+            'WHITE', 'BLACK/AFRICAN AMERICAN', 'OTHER', 'UNKNOWN', 'HISPANIC/LATINO - PUERTO RICAN',
+            'WHITE - OTHER EUROPEAN', 'ASIAN', 'ASIAN - CHINESE', 'UNABLE TO OBTAIN',
+        ], n),
+        'edregtime': edregtime,
+        'edouttime': np.where(emergency, admittime, np.datetime64('NaT')),
+        'hospital_expire_flag': expire.astype(int),
+    })
+
+    # Lab intensity of each admission: heavy tailed per subject, scaled by the length of stay
+    subject_intensity = rng.lognormal(-LAB_INTENSITY_SIGMA ** 2 / 2, LAB_INTENSITY_SIGMA, n_subjects)
+    adm_frame = pd.DataFrame({
+        'subject_id': admissions['subject_id'].to_numpy(),
+        'hadm_id': admissions['hadm_id'].to_numpy(),
+        'admittime': admittime,
+        'los_s': (dischtime - admittime).astype('int64'),
+        'intensity': subject_intensity[adm_subject] * (los / np.timedelta64(86400, 's')) / (LOS_SHAPE * LOS_SCALE),
+    })
+    return patients, admissions, adm_frame
+
+
+def _code_events_batch(rng, adm_frame, counts, codes):
+    """
+    ICD coded events (diagnoses or procedures) of a batch of admissions, and the time of each event.
+    """
+    rows = _repeat_rows(counts)
+    events = pd.DataFrame({
+        'subject_id': adm_frame['subject_id'].to_numpy()[rows],
+        'hadm_id': adm_frame['hadm_id'].to_numpy()[rows],
+        'seq_num': pd.Series(rows).groupby(rows).cumcount().to_numpy() + 1,
+        'icd_code': _zipf_choice(rng, codes, len(rows), exponent=0.8),
+    })
+    events['icd_version'] = np.where(pd.Series(events['icd_code']).str[0].str.isalpha(), 10, 9)
+    offsets = _seconds(rng.uniform(0, 1, len(rows)) * adm_frame['los_s'].to_numpy()[rows])
+    return events, adm_frame['admittime'].to_numpy()[rows] + offsets
+
+
+def _prescriptions_batch(rng, adm_frame, first_pharmacy_id):
+    counts = rng.poisson(18 * np.sqrt(adm_frame['intensity'].to_numpy()))
+    rows = _repeat_rows(counts)
+    n = len(rows)
+    drugs = [keyword.title() for keywords in DRUG_CLASS_MAP.values() for keyword in keywords]
+    drugs = FILLER_DRUGS[:4] + drugs + FILLER_DRUGS[4:]
+    starttime = (adm_frame['admittime'].to_numpy()[rows]
+                 + _seconds(rng.uniform(0, 1, n) * adm_frame['los_s'].to_numpy()[rows]))
+    hadm_ids = adm_frame['hadm_id'].to_numpy()[rows]
+    seq = pd.Series(rows).groupby(rows).cumcount().to_numpy() + 1
+    return pd.DataFrame({
+        'subject_id': adm_frame['subject_id'].to_numpy()[rows],
+        'hadm_id': hadm_ids,
+        'pharmacy_id': np.arange(first_pharmacy_id, first_pharmacy_id + n),
+        'poe_id': pd.Series(hadm_ids).astype(str) + '-' + pd.Series(seq).astype(str),
+        'poe_seq': seq,
+        'order_provider_id': pd.Series(rng.integers(1, 20000, n)).map('P{:05d}'.format),
+        'starttime': starttime,
+        'stoptime': starttime + _seconds(rng.exponential(2 * 86400, n) + 3600),
+        'drug_type': _zipf_choice(rng, ['MAIN', 'BASE', 'ADDITIVE'], n, exponent=2.0),
+        'drug': _zipf_choice(rng, drugs, n, exponent=0.9),
+        'formulary_drug_cd': None, 'gsn': None, 'ndc': None, 'prod_strength': None, 'form_rx': None,
+        'dose_val_rx': rng.choice(['1', '2', '5', '10', '20', '40'], n),
+        'dose_unit_rx': _zipf_choice(rng, ['mg', 'mL', 'UNIT', 'mEq'], n),
+        'form_val_disp': rng.choice(['1', '2', '0.5'], n), 'form_unit_disp': 'TAB',
+        'doses_per_24_hrs': rng.choice([1.0, 2.0, 3.0, 4.0, np.nan], n),
+        'route': _zipf_choice(rng, ['PO', 'IV', 'SC', 'PO/NG', 'IV DRIP', 'IH'], n),
+    })
+
+
+def _labevents_chunks(rng, adm_frame, lab_items, labs_per_admission, chunk_rows, first_labevent_id):
+    """
+    Lab events of a batch of admissions, in chunks of about `chunk_rows` rows.
+    """
+    counts = rng.poisson(labs_per_admission * adm_frame['intensity'].to_numpy())
+    bounds = np.searchsorted(np.cumsum(counts), np.arange(chunk_rows, counts.sum() + chunk_rows, chunk_rows),
+                             side='right')
+    starts = np.r_[0, bounds[:-1]]
+
+    is_mapped = lab_items['lab_name'].notna().to_numpy()
+    mapped_items = lab_items[is_mapped].reset_index(drop=True)
+    other_items = lab_items[~is_mapped].reset_index(drop=True)
+    labevent_id = first_labevent_id
+
+    for start, stop in zip(starts, np.r_[bounds[:-1], len(counts)]):
+        if counts[start:stop].sum() == 0:
+            continue
+        adms = adm_frame.iloc[start:stop]
+        rows = _repeat_rows(counts[start:stop])
+        n = len(rows)
+
+        # Items: Zipf over the mapped items, some events of unrelated items
+        item_rows = rng.choice(len(mapped_items), n, p=_zipf_weights(len(mapped_items), 0.8))
+        items = mapped_items.iloc[item_rows]
+        other = rng.random(n) < OTHER_LAB_RATE
+        other_rows = rng.choice(len(other_items), other.sum())
+        itemid = items['itemid'].to_numpy().copy()
+        mean, sd = items['mean'].to_numpy().copy(), items['sd'].to_numpy().copy()
+        unit = items['unit'].to_numpy().copy()
+        itemid[other] = other_items['itemid'].to_numpy()[other_rows]
+        mean[other], sd[other] = other_items['mean'].to_numpy()[other_rows], other_items['sd'].to_numpy()[other_rows]
+        unit[other] = other_items['unit'].to_numpy()[other_rows]
+
+        valuenum = np.clip(rng.normal(mean, sd), 0, None).round(2)
+        valuenum[rng.random(n) < 0.03] = np.nan
+        lower, upper = (mean - sd).round(1), (mean + sd).round(1)
+
+        # Panels: consecutive events of an admission drawn at the same time from one specimen
+        first_row = np.r_[0, np.cumsum(counts[start:stop])[:-1]]
+        panel_start = (np.arange(n) - first_row[rows]) % LAB_PANEL_SIZE == 0
+        panel = np.cumsum(panel_start) - 1
+        panel_rows = rows[panel_start]
+        n_panels = len(panel_rows)
+
+        # Panels during the stay (from a day before admission), outpatient ones in the months before
+        outpatient = rng.random(n_panels) < OUTPATIENT_LAB_RATE
+        offsets = rng.uniform(-86400, 1, n_panels) + rng.uniform(0, 1, n_panels) * adms['los_s'].to_numpy()[panel_rows]
+        offsets[outpatient] = -rng.uniform(2 * 86400, 180 * 86400, outpatient.sum())
+        charttime = (adms['admittime'].to_numpy()[panel_rows] + _seconds(offsets)).astype('datetime64[m]')
+        storetime = charttime + _seconds(rng.exponential(3600, n_panels))
+        hadm_id = pd.array(adms['hadm_id'].to_numpy()[rows], dtype='Int64')
+        hadm_id[outpatient[panel]] = pd.NA
+
+        yield pd.DataFrame({
+            'labevent_id': np.arange(labevent_id, labevent_id + n),
+            'subject_id': adms['subject_id'].to_numpy()[rows],
+            'hadm_id': hadm_id,
+            'specimen_id': rng.integers(1, 100000000, n_panels)[panel],
+            'itemid': itemid,
+            'order_provider_id': None,
+            'charttime': charttime[panel].astype('datetime64[s]'),
+            'storetime': storetime[panel],
+            'value': valuenum,
+            'valuenum': valuenum,
+            'valueuom': unit,
+            'ref_range_lower': lower,
+            'ref_range_upper': upper,
+            'flag': np.where((valuenum < lower) | (valuenum > upper), 'abnormal', None),
+            'priority': np.where(rng.random(n_panels) < 0.7, 'ROUTINE', 'STAT')[panel],
+            'comments': None,
+        })
+        labevent_id += n
+
+
+def generate_hosp_tables(output_dir = SYNTHETIC_HOSP_DATA_DIR, n_subjects = 10000, n_labevents = None, seed = 0,
+                         batch_subjects = 10000, chunk_rows = 1000000, force = False) -> dict:
+    """
+    Write schema-faithful synthetic versions of the hosp tables read by the pipeline
+    (patients, admissions, diagnoses_icd, procedures_icd, prescriptions, d_labitems and labevents)
+    into `output_dir`, for load tests without the credentialed dataset.
+
+    n_labevents: approximate number of lab events, 60 per admission by default
+    Subjects are generated in batches of `batch_subjects` and lab events written in chunks of
+    about `chunk_rows` rows, so memory does not grow with the scale.
+    Refuses to write into a directory holding csv files it did not generate, unless `force`.
+    Returns the row count of every table.
+    """
+    output_dir = Path(output_dir)
+    manifest_path = output_dir / "synthetic.json"
+    if not force and not manifest_path.exists() and any(output_dir.glob("*.csv")):
+        raise FileExistsError(f"{output_dir} holds csv files that are not synthetic, pass force=True to overwrite")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if n_labevents is None:
+        n_labevents = 60 * MEAN_ADMISSIONS * n_subjects
+    labs_per_admission = n_labevents / (MEAN_ADMISSIONS * n_subjects)
+
+    lab_items = _lab_items()
+    icd_codes = [prefix + suffix for prefixes in ICD_CONDITION_MAP.values() for prefix in prefixes
+                 for suffix in ('0', '1', '9')]
+    icd_codes = FILLER_ICD_CODES[:6] + icd_codes + FILLER_ICD_CODES[6:]
+    procedure_codes = [code for codes in PROCEDURE_ICD_MAP.values() for code in codes]
+    procedure_codes = FILLER_PROCEDURE_CODES[:3] + procedure_codes + FILLER_PROCEDURE_CODES[3:]
+
+    # Tables are written as <table>.csv.tmp and moved into place once complete
+    paths = {table: output_dir / f"{table}.csv" for table in HOSP_TABLE_COLUMNS}
+    tmp_paths = {table: path.with_name(path.name + ".tmp") for table, path in paths.items()}
+    with ExitStack() as stack:
+        writers = {table: _CsvWriter(stack.enter_context(open(tmp_paths[table], 'wb')), columns,
+                                     HOSP_DATE_COLUMNS.get(table, ()))
+                   for table, columns in HOSP_TABLE_COLUMNS.items()}
+        writers['d_labitems'].write(lab_items)
+
+        logger.info(f"Generating synthetic hosp tables for {n_subjects} subjects and about {int(n_labevents)} "
+                    f"lab events into {output_dir}")
+        next_hadm_id, next_pharmacy_id, next_labevent_id = FIRST_HADM_ID, 0, 0
+        for batch, first in enumerate(tqdm(range(0, n_subjects, batch_subjects), desc="Synthetic subjects")):
+            rng = np.random.default_rng([seed, batch])
+            subject_ids = np.arange(FIRST_SUBJECT_ID + first, FIRST_SUBJECT_ID + min(first + batch_subjects, n_subjects))
+            patients, admissions, adm_frame = _admissions_batch(rng, subject_ids, next_hadm_id)
+            next_hadm_id += len(admissions)
+            writers['patients'].write(patients)
+            writers['admissions'].write(admissions)
+
+            diagnoses, _ = _code_events_batch(rng, adm_frame, 1 + rng.poisson(10, len(adm_frame)), icd_codes)
+            writers['diagnoses_icd'].write(diagnoses)
+            procedures, chartdate = _code_events_batch(rng, adm_frame, rng.poisson(1.5, len(adm_frame)), procedure_codes)
+            writers['procedures_icd'].write(procedures.assign(chartdate=chartdate.astype('datetime64[D]')
+                                                              .astype('datetime64[s]')))
+
+            prescriptions = _prescriptions_batch(rng, adm_frame, next_pharmacy_id)
+            next_pharmacy_id += len(prescriptions)
+            writers['prescriptions'].write(prescriptions)
+
+            for chunk in _labevents_chunks(rng, adm_frame, lab_items, labs_per_admission, chunk_rows, next_labevent_id):
+                writers['labevents'].write(chunk)
+                next_labevent_id += len(chunk)
+
+        for writer in writers.values():
+            writer.close()
+    for table, path in paths.items():
+        os.replace(tmp_paths[table], path)
+    row_counts = {table: writer.rows for table, writer in writers.items()}
+    manifest_path.write_text(json.dumps({
+        'n_subjects': n_subjects, 'n_labevents': n_labevents, 'seed': seed, 'rows': row_counts,
+    }, indent=2))
+    logger.success(f"Synthetic hosp tables written to {output_dir}: {row_counts}")
+    return row_counts
+
+
+@app.command()
+def main(
+    output_dir: Path = SYNTHETIC_HOSP_DATA_DIR,
+    n_subjects: int = 10000,
+    n_labevents: int | None = None,
+    seed: int = 0,
+    batch_subjects: int = 10000,
+    chunk_rows: int = 1000000,
+    force: bool = False,
+):
+    generate_hosp_tables(output_dir, n_subjects, n_labevents, seed, batch_subjects, chunk_rows, force)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+
+from assessment.config import MIMIC_DATE_FORMAT, MIMIC_DATETIME_FORMAT, TIMESTAMP_CACHE_SIZE
+
+# int64 value of NaT
+NAT = np.iinfo('int64').min
+
+# Parsing a distinct string with a fixed format costs less than caching it, so the cache is only
+# used while the share of hits among the distinct strings of a call (moving average) is at least
+# MIN_HIT_RATE, and otherwise probed every PROBE_EVERY calls, to notice when strings start repeating.
+MIN_HIT_RATE = 0.25
+PROBE_EVERY = 8
+# Calls whose first DISTINCT_SAMPLE_SIZE values are mostly (MAX_DISTINCT_SHARE) distinct are parsed
+# row by row, deduplicating them would cost more than it saves
+DISTINCT_SAMPLE_SIZE = 1000
+MAX_DISTINCT_SHARE = 0.7
+
+
+class TimestampParser:
+    """
+    Parse timestamp strings of one fixed layout (`format`) into datetime64[ns].
+
+    Only the distinct strings of each call are parsed and mapped back to the rows, and the
+    parsed values (int64 nanoseconds since epoch) are kept across calls in a bounded LRU of
+    at most `max_size` strings, so the chunks of a table share the work of the timestamps they repeat.
+    Strings in another layout fall back to ISO 8601 parsing, unparseable ones become NaT.
+
+    The cache is a hashed pd.Index looked up for all the strings of a call at once. Strings parsed
+    since its last rebuild are pending: they are merged in, and the least recently used strings
+    evicted, once they reach half the size of the index, so rebuilds stay amortized.
+    See MIN_HIT_RATE for when the cache is used.
+    """
+
+    def __init__(self, format = MIMIC_DATETIME_FORMAT, max_size = TIMESTAMP_CACHE_SIZE):
+        self.format = format
+        self.max_size = max_size
+        self._keys = pd.Index([], dtype=object)
+        self._epochs = np.empty(0, dtype='int64')
+        self._last_used = np.empty(0, dtype='int64')
+        self._pending_keys, self._pending_epochs = [], []
+        self._n_pending = 0
+        self._calls = 0
+        self.hit_rate = MIN_HIT_RATE
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._keys) + self._n_pending
+
+    def _parse(self, values) -> np.ndarray:
+        values = np.asarray(values, dtype=object)
+        parsed = pd.to_datetime(values, format=self.format, errors='coerce')
+        failed = parsed.isna()
+        if failed.any():
+            retry = pd.to_datetime(np.where(failed, values, None), format='ISO8601', errors='coerce')
+            parsed = parsed.where(~failed, retry)
+        return parsed.as_unit('ns').asi8
+
+    def _rebuild(self):
+        """
+        Merge the pending strings into the cache, keeping the `max_size` most recently used.
+        """
+        keys = self._keys.append(pd.Index(np.concatenate(self._pending_keys), dtype=object))
+        epochs = np.concatenate([self._epochs] + self._pending_epochs)
+        last_used = np.concatenate([self._last_used, np.full(self._n_pending, self._calls, dtype='int64')])
+        self._pending_keys, self._pending_epochs, self._n_pending = [], [], 0
+
+        # A string missed by several calls before the rebuild is pending more than once
+        keep = ~keys.duplicated()
+        if keep.sum() > self.max_size:
+            recent = np.argsort(-np.where(keep, last_used, -1), kind='stable')[:self.max_size]
+            keep = np.zeros(len(keys), dtype=bool)
+            keep[recent] = True
+        self._keys, self._epochs, self._last_used = keys[keep], epochs[keep], last_used[keep]
+
+    def _parse_cached(self, uniques) -> np.ndarray:
+        """
+        Epochs of the distinct strings `uniques`, from the cache or parsed and added to it.
+        """
+        positions = self._keys.get_indexer(uniques)
+        found = positions >= 0
+        epochs = np.empty(len(uniques), dtype='int64')
+        epochs[found] = self._epochs[positions[found]]
+        self._last_used[positions[found]] = self._calls
+
+        missing = ~found
+        n_missing = int(missing.sum())
+        if n_missing:
+            epochs[missing] = self._parse(uniques[missing])
+            # More distinct strings than the cache holds are not worth keeping
+            if n_missing <= self.max_size // 2:
+                self._pending_keys.append(uniques[missing].to_numpy())
+                self._pending_epochs.append(epochs[missing])
+                self._n_pending += n_missing
+                if self._n_pending >= max(len(self._keys) // 2, 1024):
+                    self._rebuild()
+        self.hits += len(uniques) - n_missing
+        self.misses += n_missing
+        if len(uniques):
+            self.hit_rate = 0.75 * self.hit_rate + 0.25 * (1 - n_missing / len(uniques))
+        return epochs
+
+    def parse(self, values) -> pd.Series:
+        """
+        datetime64[ns] Series of `values` (Series of strings, missing values become NaT).
+        Values already parsed, e.g. by the Arrow reader, are returned as they are.
+        """
+        if not isinstance(values, pd.Series):
+            values = pd.Series(values)
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return values
+        sample = values.iloc[:DISTINCT_SAMPLE_SIZE]
+        if len(values) > DISTINCT_SAMPLE_SIZE and sample.nunique() > MAX_DISTINCT_SHARE * len(sample):
+            return pd.Series(self._parse(values).view('datetime64[ns]'), index=values.index, name=values.name)
+
+        self._calls += 1
+        codes, uniques = pd.factorize(values)
+        uniques = pd.Index(uniques, dtype=object)
+        if self.hit_rate < MIN_HIT_RATE and self._calls % PROBE_EVERY:
+            epochs = self._parse(uniques)
+            self.misses += len(uniques)
+        else:
+            epochs = self._parse_cached(uniques)
+
+        # Missing values have code -1, the NaT appended last
+        result = np.append(epochs, NAT)[codes].view('datetime64[ns]')
+        return pd.Series(result, index=values.index, name=values.name)
+
+
+# Parsers shared by every reader of the process, one per layout
+_parsers = {}
+
+
+def parse_timestamps(values, format = MIMIC_DATETIME_FORMAT) -> pd.Series:
+    """
+    Parse MIMIC timestamp strings with the shared TimestampParser of `format`.
+    """
+    parser = _parsers.get(format)
+    if parser is None:
+        parser = _parsers[format] = TimestampParser(format)
+    return parser.parse(values)
+
+
+def parse_dates(values) -> pd.Series:
+    """
+    Parse MIMIC date strings (dod, chartdate), see parse_timestamps.
+    """
+    return parse_timestamps(values, MIMIC_DATE_FORMAT)
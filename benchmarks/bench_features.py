@@ -0,0 +1,289 @@
+from datetime import datetime
+import json
+import math
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+from typing import List
+
+from loguru import logger
+import pandas as pd
+import typer
+
+from assessment.config import (
+    DATA_DIR, INTERIM_DATA_DIR, LABEVENTS_PATH, MIMIC_HOSP_DATA_DIR, PROCESSED_HOSP_DATA_DIR, PROJ_ROOT, REPORTS_DIR
+)
+from assessment.datasets import build_hosp_cache, load_diagnoses_data, load_prescriptions_data, load_procedures_data
+from assessment.features_hosp import filter_time_to_death_dataframe, prepare_cohort
+from assessment.hosp_agg_processed_features import merge_csvs_in_dir
+from assessment.hosp_diagnosis import create_diagnosis_features
+from assessment.hosp_labevents import create_labsevents_features_chunked
+from assessment.hosp_labevents_scan import create_lab_feature_families
+from assessment.hosp_labevents_windowed import create_longitudinal_lab_features
+from assessment.hosp_meds import MEDS_FEATURE_COLUMNS, create_meds_features
+from assessment.hosp_procedure import create_procedures_features
+from assessment.profiling import count_rows, profile_block
+from assessment.synthetic import generate_hosp_tables
+
+app = typer.Typer()
+
+BENCHMARK_SIZES = [1000, 10000, 100000]
+BASELINE_PATH = Path(__file__).parent / "baseline.json"
+BENCHMARK_DATA_DIR = DATA_DIR / "benchmarks"
+BENCHMARK_REPORTS_DIR = REPORTS_DIR / "benchmarks"
+# Lab events generated per subject, labevents dominates the run time of the lab features
+BENCHMARK_LABS_PER_SUBJECT = 50
+
+# A result regresses when it exceeds its baseline by these factors, plus an absolute slack
+# so that the small sizes do not flap on timer and allocator noise.
+WALL_TOLERANCE = 1.3
+WALL_SLACK_S = 0.05
+MEMORY_TOLERANCE = 1.2
+MEMORY_SLACK_MB = 32
+
+# Benchmarked functions, run in this order
+BENCHMARK_NAMES = [
+    'prepare_cohort',
+    'create_diagnosis_features',
+    'create_procedures_features',
+    'create_meds_features',
+    'create_labsevents_features_chunked',
+    'create_longitudinal_lab_features',
+    'merge_csvs_in_dir',
+]
+
+
+# ------------------------------------------------------
+#   Worker side: runs with DATA_DIR set to one benchmark size
+# ------------------------------------------------------
+
+BENCHMARK_COHORT_PATH = INTERIM_DATA_DIR / "benchmark_cohort_df.pkl"
+BENCHMARK_FEATURES_DIR = INTERIM_DATA_DIR / "benchmark_features"
+
+
+@app.command()
+def setup(n_subjects: int, seed: int = 0):
+    """
+    Worker command, prepares the benchmark data of one size:
+    synthetic hosp tables, their columnar cache, the cohort and the feature tables merged by
+    merge_csvs_in_dir, everything reused while the size and seed are unchanged.
+    """
+    manifest_path = MIMIC_HOSP_DATA_DIR / "benchmark.json"
+    manifest = {'subjects': n_subjects, 'seed': seed}
+    if manifest_path.exists() and json.loads(manifest_path.read_text()) == manifest:
+        return
+
+    generate_hosp_tables(MIMIC_HOSP_DATA_DIR, n_subjects, n_labevents=BENCHMARK_LABS_PER_SUBJECT * n_subjects,
+                         seed=seed, force=True)
+    build_hosp_cache()
+    cohort_df = prepare_cohort()
+    BENCHMARK_COHORT_PATH.parent.mkdir(parents=True, exist_ok=True)
+    cohort_df.to_pickle(BENCHMARK_COHORT_PATH)
+
+    # merge_csvs_in_dir writes the merged table next to the processed hosp tables
+    PROCESSED_HOSP_DATA_DIR.mkdir(parents=True, exist_ok=True)
+    BENCHMARK_FEATURES_DIR.mkdir(parents=True, exist_ok=True)
+    subjects = cohort_df['subject_id'].unique()
+    feature_tables = {
+        'time_to_death_df': filter_time_to_death_dataframe(cohort_df),
+        'diagnosis_feat_df': create_diagnosis_features(cohort_df, load_diagnoses_data()),
+        'procedures_feat_df': create_procedures_features(cohort_df, load_procedures_data()),
+        'prescriptions_feat_df': create_meds_features(
+            cohort_df, load_prescriptions_data(usecols=MEDS_FEATURE_COLUMNS, subject_ids=subjects)),
+        **create_lab_feature_families(cohort_df, LABEVENTS_PATH),
+    }
+    for name, feature_df in feature_tables.items():
+        feature_df.to_csv(BENCHMARK_FEATURES_DIR / f"{name}.csv", index=False)
+    manifest_path.write_text(json.dumps(manifest))
+
+
+def _benchmark_call(name):
+    """
+    Benchmarked function and its arguments, loaded before the measurement starts.
+    """
+    if name == 'prepare_cohort':
+        return prepare_cohort, ()
+    if name == 'merge_csvs_in_dir':
+        return merge_csvs_in_dir, (BENCHMARK_FEATURES_DIR,)
+
+    cohort_df = pd.read_pickle(BENCHMARK_COHORT_PATH)
+    if name == 'create_diagnosis_features':
+        return create_diagnosis_features, (cohort_df, load_diagnoses_data())
+    if name == 'create_procedures_features':
+        return create_procedures_features, (cohort_df, load_procedures_data())
+    if name == 'create_meds_features':
+        prescriptions_df = load_prescriptions_data(usecols=MEDS_FEATURE_COLUMNS,
+                                                   subject_ids=cohort_df['subject_id'].unique())
+        return create_meds_features, (cohort_df, prescriptions_df)
+    if name == 'create_labsevents_features_chunked':
+        return create_labsevents_features_chunked, (cohort_df, LABEVENTS_PATH)
+    if name == 'create_longitudinal_lab_features':
+        return create_longitudinal_lab_features, (cohort_df, LABEVENTS_PATH)
+    raise ValueError(f"Unknown benchmark {name}")
+
+
+@app.command()
+def measure(name: str, n_subjects: int, result_path: Path, repeat: int = 1):
+    """
+    Worker command: time one benchmark in this process and write its record to `result_path`.
+    The benchmark data must have been prepared with `setup`.
+    """
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    runs = []
+    for _ in range(repeat):
+        func, args = _benchmark_call(name)
+        with profile_block(name, rows_in=count_rows(args)) as record:
+            record['rows_out'] = count_rows(func(*args))
+        runs.append(record)
+
+    # Fastest run for time, first run for memory (later runs reuse memory already mapped)
+    fastest = min(runs, key=lambda run: run['wall_s'])
+    result = {
+        'name': name, 'subjects': n_subjects, 'repeat': repeat,
+        'wall_s': fastest['wall_s'], 'cpu_s': fastest['cpu_s'],
+        'peak_rss_mb': runs[0]['peak_rss_mb'], 'peak_rss_increase_mb': runs[0]['peak_rss_increase_mb'],
+        'rows_in': fastest['rows_in'], 'rows_out': fastest['rows_out'], 'chunk_rows': fastest['chunk_rows'],
+        'subjects_per_s': round(n_subjects / fastest['wall_s'], 1) if fastest['wall_s'] > 0 else None,
+        'rows_per_s': round((fastest['rows_in'] + fastest['chunk_rows']) / fastest['wall_s'], 1)
+        if fastest['wall_s'] > 0 else None,
+    }
+    result_path.write_text(json.dumps(result))
+
+
+# ------------------------------------------------------
+#   Driver side
+# ------------------------------------------------------
+
+def _run_worker(args, n_subjects, data_dir):
+    """
+    Run a worker command in a fresh process with DATA_DIR pointing at the data of `n_subjects`,
+    so that the peak RSS of a benchmark is not inflated by earlier ones.
+    """
+    env = {**os.environ, 'DATA_DIR': str(data_dir / f"subjects_{n_subjects}"), 'PROFILE_CPROFILE': '0'}
+    command = [sys.executable, '-m', 'benchmarks.bench_features', *map(str, args)]
+    completed = subprocess.run(command, env=env, cwd=PROJ_ROOT, capture_output=True, text=True)
+    if completed.returncode != 0:
+        sys.stderr.write(completed.stderr)
+        raise RuntimeError(f"Benchmark worker {args} failed")
+
+
+def _run_benchmark(name, n_subjects, repeat, data_dir):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result_path = Path(tmp_dir) / "result.json"
+        _run_worker(['measure', name, n_subjects, result_path, '--repeat', repeat], n_subjects, data_dir)
+        return json.loads(result_path.read_text())
+
+
+def _key(result):
+    return f"{result['name']}[{result['subjects']}]"
+
+
+def compare_to_baseline(results, baseline) -> List[dict]:
+    """
+    Regressions of `results` against the `baseline` records, with the same key (function and size).
+    """
+    regressions = []
+    for result in results:
+        reference = baseline.get(_key(result))
+        if reference is None:
+            continue
+        if result['wall_s'] > reference['wall_s'] * WALL_TOLERANCE + WALL_SLACK_S:
+            regressions.append({'benchmark': _key(result), 'metric': 'wall_s',
+                                'baseline': reference['wall_s'], 'value': result['wall_s']})
+        memory_limit = reference['peak_rss_increase_mb'] * MEMORY_TOLERANCE + MEMORY_SLACK_MB
+        if result['peak_rss_increase_mb'] > memory_limit:
+            regressions.append({'benchmark': _key(result), 'metric': 'peak_rss_increase_mb',
+                                'baseline': reference['peak_rss_increase_mb'], 'value': result['peak_rss_increase_mb']})
+    return regressions
+
+
+def scaling_exponents(results) -> dict:
+    """
+    Dict[name] = growth exponent of the wall time between successive sizes (1.0 is linear).
+    """
+    exponents = {}
+    by_name = {}
+    for result in results:
+        by_name.setdefault(result['name'], []).append(result)
+    for name, runs in by_name.items():
+        runs = sorted(runs, key=lambda run: run['subjects'])
+        exponents[name] = [
+            round(math.log(max(large['wall_s'], 1e-6) / max(small['wall_s'], 1e-6))
+                  / math.log(large['subjects'] / small['subjects']), 2)
+            for small, large in zip(runs, runs[1:])
+        ]
+    return exponents
+
+
+@app.command()
+def run(
+    sizes: List[int] = typer.Option(BENCHMARK_SIZES, help="Cohort sizes (subjects) to benchmark"),
+    names: List[str] = typer.Option(BENCHMARK_NAMES, help="Benchmarks to run"),
+    repeat: int = 3,
+    seed: int = 0,
+    data_dir: Path = BENCHMARK_DATA_DIR,
+    baseline_path: Path = BASELINE_PATH,
+    update_baseline: bool = False,
+):
+    """
+    Time every benchmark at every size, report throughput, memory and scaling, and compare
+    against the stored baseline. Exits with code 1 on regressions.
+    """
+    results = []
+    for n_subjects in sorted(sizes):
+        logger.info(f"Preparing benchmark data for {n_subjects} subjects...")
+        _run_worker(['setup', n_subjects, '--seed', seed], n_subjects, data_dir)
+        for name in names:
+            logger.info(f"Benchmarking {name} with {n_subjects} subjects...")
+            result = _run_benchmark(name, n_subjects, repeat, data_dir)
+            logger.info(f"{name}[{n_subjects}]: {result['wall_s']:.3f}s, {result['subjects_per_s']} subjects/s, "
+                        f"+{result['peak_rss_increase_mb']} MB peak RSS")
+            results.append(result)
+
+    baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+    # Timings recorded on another number of cores are not comparable
+    cpu_count = os.cpu_count()
+    references = {key: reference for key, reference in baseline.items() if reference.get('cpu_count') == cpu_count}
+    if len(references) < len(baseline):
+        logger.warning(f"{len(baseline) - len(references)} baseline records were recorded on another number of "
+                       f"cores than this machine ({cpu_count}) and are not compared")
+    regressions = compare_to_baseline(results, references)
+    exponents = scaling_exponents(results)
+
+    table = pd.DataFrame(results).set_index(['name', 'subjects'])
+    table['baseline_wall_s'] = [references.get(_key(result), {}).get('wall_s') for result in results]
+    logger.info("Benchmark results:\n" + table[['wall_s', 'baseline_wall_s', 'cpu_s', 'subjects_per_s', 'rows_per_s',
+                                               'peak_rss_increase_mb']].to_string())
+    logger.info(f"Wall time scaling exponents between sizes {sorted(sizes)}: {exponents}")
+
+    BENCHMARK_REPORTS_DIR.mkdir(parents=True, exist_ok=True)
+    report_path = BENCHMARK_REPORTS_DIR / f"benchmarks_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    report_path.write_text(json.dumps({
+        'started_at': datetime.now().isoformat(timespec='seconds'), 'cpu_count': cpu_count,
+        'results': results, 'scaling_exponents': exponents, 'regressions': regressions,
+    }, indent=2))
+    logger.info(f"Benchmark report saved to {report_path}")
+
+    if update_baseline:
+        baseline.update({
+            _key(result): {**{metric: result[metric] for metric in ('wall_s', 'peak_rss_increase_mb', 'subjects_per_s')},
+                           'cpu_count': cpu_count}
+            for result in results
+        })
+        baseline_path.write_text(json.dumps(dict(sorted(baseline.items())), indent=2) + "\n")
+        logger.success(f"Baseline updated in {baseline_path}")
+    elif regressions:
+        for regression in regressions:
+            logger.error(f"Regression in {regression['benchmark']}: {regression['metric']} "
+                         f"{regression['value']} vs baseline {regression['baseline']}")
+        raise typer.Exit(code=1)
+    else:
+        logger.success("No regression against the baseline")
+
+
+if __name__ == "__main__":
+    app()
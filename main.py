@@ -1,22 +1,33 @@
 from loguru import logger
+import typer
 
 import warnings
 warnings.filterwarnings("ignore")
 
-from assessment.config import FILTER_OVER_AGE_18, INTERIM_DATA_DIR, PROCESSED_DATA_DIR, LABEVENTS_PATH, PROCESSED_HOSP_DATA_DIR
-from assessment.datasets import load_diagnoses_data, load_procedures_data, load_prescriptions_data
+from assessment.config import (
+    FILTER_OVER_AGE_18, INTERIM_DATA_DIR, PROCESSED_HOSP_DATA_DIR, LAB_FEATURE_WORKERS, LAB_STAGE_CPU_BUDGET, LAB_FEATURES_INCREMENTAL,
+    PIPELINE_WORKERS, USE_STAGE_CACHE, ADMISSIONS_PATH, PATIENTS_PATH, DIAGNOSES_ICD_PATH, PROCEDURES_ICD_PATH,
+    PRESCRIPTIONS_PATH, LABEVENTS_PATH, D_LABITEMS_PATH, FEATURE_BACKEND
+)
+from assessment.backends import BACKENDS, get_backend
 from assessment.features_hosp import prepare_cohort, filter_time_to_death_dataframe
 
 from assessment.hosp_diagnosis import create_diagnosis_features
 from assessment.hosp_procedure import create_procedures_features
-from assessment.hosp_meds import create_meds_features
-from assessment.hosp_labevents import create_labsevents_features_chunked, identify_itemids_from_d_labelitems
-from assessment.hosp_labevents_windowed import create_longitudinal_lab_features
-from assessment.hosp_agg_processed_features import merge_csvs_in_dir
+from assessment.hosp_meds import create_meds_features, MEDS_FEATURE_COLUMNS
+from assessment.hosp_labevents_scan import LAB_FEATURE_FAMILIES, create_lab_feature_families
+from assessment.hosp_labevents_shards import create_lab_feature_families_parallel
+from assessment.hosp_labevents_incremental import update_lab_feature_families
+from assessment.hosp_agg_processed_features import merge_feature_frames
+from assessment.pipeline import Stage, run_stages, stage_cpu_budget
+from assessment.stage_cache import StageCache
+from assessment.profiling import RunReport
+from assessment.outputs import OutputWriter
 
+app = typer.Typer()
 
 
-def run_cohort_preparation_pipeline():
+def cohort_stage():
 # ------------------------------------------------------
 #               HOSP COHORT PREPARATION
 # ------------------------------------------------------
@@ -24,111 +35,178 @@ def run_cohort_preparation_pipeline():
     logger.info("-------------------------- Running cohort preparation pipeline...")
     cohort_df = prepare_cohort(FILTER_OVER_AGE_18)
 
-    # Save to interim data for inspection
-    OUTPUT_PATH = INTERIM_DATA_DIR / "cohort_df.csv"
-    cohort_df.to_csv(OUTPUT_PATH, index=False)
-    logger.info(f"Interim data saved to {OUTPUT_PATH}")
-
 # ----------------- ADD TIME TO DEATH ----------------- DONE
 
 
     time_to_death_df = filter_time_to_death_dataframe(cohort_df)
-
-    # Save to processed data for inspection
-    OUTPUT_PATH = PROCESSED_DATA_DIR / "hosp/time_to_death_df.csv"
-    time_to_death_df.to_csv(OUTPUT_PATH, index=False)
-    logger.info(f"Time to death processed data saved to {OUTPUT_PATH}")
     logger.info("-------------------------- Cohort preparation pipeline completed.")
 
 
-    return cohort_df, time_to_death_df
+    return {'cohort_df': cohort_df, 'time_to_death_df': time_to_death_df}
 
 
-def run_feature_creation_pipeline(cohort_df):
+COHORT_STAGE = Stage(
+    'cohort', cohort_stage, inputs=[], outputs=['cohort_df', 'time_to_death_df'],
+    sources=[ADMISSIONS_PATH, PATIENTS_PATH],
+    config=['FILTER_OVER_AGE_18', 'ETHNICITY_MAPPING', 'ADMISSION_TYPE_MAPPING'],
+    code=['assessment.features_hosp', 'assessment.datasets', 'assessment.timestamps'],
+    # Saved for inspection, cohort_df to interim data
+    artifacts={'cohort_df': INTERIM_DATA_DIR / "cohort_df",
+               'time_to_death_df': PROCESSED_HOSP_DATA_DIR / "time_to_death_df"},
+)
 
-# ------------------------------------------------------
-#                 FEATURE CREATION
-# ------------------------------------------------------
 
-    logger.info(f"------------------------------------------------------")
-    logger.info(f"                FEATURE CREATION                      ")
-    logger.info(f"------------------------------------------------------")
+def run_cohort_preparation_pipeline(cache = None, report = None, writer = None):
+    """
+    Cohort and time to death tables, loaded from `cache` when admissions, patients and the cohort code are unchanged.
+    """
+    (stage, outputs), = run_stages([COHORT_STAGE], {}, max_workers=1, cache=cache, report=report, writer=writer)
+    return outputs['cohort_df'], outputs['time_to_death_df']
 
-    logger.info(f"Creating features for {len(cohort_df)} cohort entries")
 
+def diagnosis_features_stage(cohort_df, backend):
     logger.info("----------------- STEP I - DIAGNOSIS FEATURES -----------------")
 
     logger.info(f"Creating diagnosis features for {len(cohort_df)} cohort entries.")
-    diagnosis_df = load_diagnoses_data()
+    # Only the diagnoses of cohort admissions are read, the scan and filter run on the backend engine
+    diagnosis_df = get_backend(backend).load_table('diagnoses_icd', DIAGNOSES_ICD_PATH, hadm_ids=cohort_df['hadm_id'])
     diagnosis_feat_df = create_diagnosis_features(cohort_df, diagnosis_df)
     logger.info(f"Diagnosis features created for {len(diagnosis_feat_df)} cohort entries.")
-    # Save to interim data for inspection
-    OUTPUT_PATH = PROCESSED_DATA_DIR / "hosp/diagnosis_feat_df.csv"
-    diagnosis_feat_df.to_csv(OUTPUT_PATH, index=False)
-    logger.info(f"Diagnosis features interim data saved to {OUTPUT_PATH}")
+    return {'diagnosis_feat_df': diagnosis_feat_df}
 
 
+def procedure_features_stage(cohort_df, backend):
     logger.info("----------------- STEP II - PROCEDURE FEATURES -----------------")
 
     logger.info(f"Creating procedure features for {len(cohort_df)} cohort entries.")
-    procedures_df = load_procedures_data()
+    procedures_df = get_backend(backend).load_table('procedures_icd', PROCEDURES_ICD_PATH,
+                                                    hadm_ids=cohort_df['hadm_id'])
     procedures_feat_df = create_procedures_features(cohort_df, procedures_df)
     logger.info(f"Procedure features created for {len(procedures_feat_df)} cohort entries.")
-    # # Save to interim data for inspection
-    OUTPUT_PATH = PROCESSED_DATA_DIR / "hosp/procedures_feat_df.csv"
-    procedures_feat_df.to_csv(OUTPUT_PATH, index=False)
-    logger.info(f"Procedure features interim data saved to {OUTPUT_PATH}")
+    return {'procedures_feat_df': procedures_feat_df}
 
+
+def medication_features_stage(cohort_df, backend):
     logger.info("----------------- STEP III - MEDICATION FEATURES -----------------")
     logger.info(f"Creating medication features for {len(cohort_df)} cohort entries.")
-    prescriptions_df = load_prescriptions_data()
+    # Only the projected columns of cohort subjects are kept while streaming prescriptions
+    prescriptions_df = get_backend(backend).load_table('prescriptions', PRESCRIPTIONS_PATH, usecols=MEDS_FEATURE_COLUMNS,
+                                                       subject_ids=cohort_df['subject_id'])
     prescriptions_feat_df = create_meds_features(cohort_df, prescriptions_df)
     logger.info(f"Medication features created for {len(prescriptions_feat_df)} cohort entries.")
-    # Save to interim data for inspection
-    OUTPUT_PATH = PROCESSED_DATA_DIR / "hosp/prescriptions_feat_df.csv"
-    prescriptions_feat_df.to_csv(OUTPUT_PATH, index=False)
-    logger.info(f"Medication features interim data saved to {OUTPUT_PATH}")
+    return {'prescriptions_feat_df': prescriptions_feat_df}
 
 
-# # ----------------- LAB TESTS FEATURES ----------------- DONE
-    logger.info("----------------- STEP IV - LABEVENTS FEATURES -----------------")
+def lab_features_stage(cohort_df, backend):
+    logger.info("----------------- STEP IV - LABEVENTS FEATURES (PRIOR + TEMPORAL) -----------------")
     logger.info(f"Creating lab tests features for {len(cohort_df)} cohort entries.")
-    labs_feature_df = create_labsevents_features_chunked(cohort_df, LABEVENTS_PATH)
-    logger.info(f"Lab tests features created for {len(labs_feature_df)} cohort entries.")
-    # # Save to interim data for inspection
-    OUTPUT_PATH = PROCESSED_DATA_DIR / "hosp/labs_feature_df.csv"
-    labs_feature_df.to_csv(OUTPUT_PATH, index=False)
-    logger.info(f"Lab tests features interim data saved to {OUTPUT_PATH}")
+    # One scan of labevents feeds every registered lab feature family, per subject shard when
+    # several cores are available. The incremental mode only reads rows appended since the last run.
+    # DuckDB and Polars run the scan on all cores themselves.
+    # The shard pool takes the cores of LAB_STAGE_CPU_BUDGET, see the labevents Stage
+    lab_workers = min(LAB_FEATURE_WORKERS, stage_cpu_budget())
+    if LAB_FEATURES_INCREMENTAL:
+        lab_feature_dfs = update_lab_feature_families(cohort_df, LABEVENTS_PATH)
+    elif get_backend(backend).name != 'pandas':
+        lab_feature_dfs = create_lab_feature_families(cohort_df, LABEVENTS_PATH, backend=get_backend(backend))
+    elif lab_workers > 1:
+        lab_feature_dfs = create_lab_feature_families_parallel(cohort_df, LABEVENTS_PATH, max_workers=lab_workers)
+    else:
+        lab_feature_dfs = create_lab_feature_families(cohort_df, LABEVENTS_PATH)
+    for name, lab_feature_df in lab_feature_dfs.items():
+        logger.info(f"Lab features {name} created for {len(lab_feature_df)} cohort entries.")
+    return lab_feature_dfs
+
+
+# Feature families of the hosp module. They only depend on the cohort, so the scheduler runs them in parallel.
+# sources, config and code key the stage cache: changing DRUG_CLASS_MAP only re-runs the medication stage.
+# Every feature table is saved for inspection to the processed hosp data.
+# `backend` names the engine running their scans and filters, see assessment.backends.
+FEATURE_STAGES = [
+    Stage('diagnosis', diagnosis_features_stage, inputs=['cohort_df', 'backend'], outputs=['diagnosis_feat_df'],
+          sources=[DIAGNOSES_ICD_PATH], config=['ICD_CONDITION_MAP'],
+          code=['assessment.hosp_diagnosis', 'assessment.code_classifiers', 'assessment.features_hosp',
+                'assessment.datasets', 'assessment.backends', 'assessment.timestamps'],
+          artifacts={'diagnosis_feat_df': PROCESSED_HOSP_DATA_DIR / "diagnosis_feat_df"}),
+    Stage('procedures', procedure_features_stage, inputs=['cohort_df', 'backend'], outputs=['procedures_feat_df'],
+          sources=[PROCEDURES_ICD_PATH], config=['PROCEDURE_ICD_MAP'],
+          code=['assessment.hosp_procedure', 'assessment.code_classifiers', 'assessment.features_hosp',
+                'assessment.datasets', 'assessment.backends', 'assessment.timestamps'],
+          artifacts={'procedures_feat_df': PROCESSED_HOSP_DATA_DIR / "procedures_feat_df"}),
+    Stage('medications', medication_features_stage, inputs=['cohort_df', 'backend'], outputs=['prescriptions_feat_df'],
+          sources=[PRESCRIPTIONS_PATH], config=['DRUG_CLASS_MAP'],
+          code=['assessment.hosp_meds', 'assessment.code_classifiers', 'assessment.datasets', 'assessment.backends', 'assessment.timestamps'],
+          artifacts={'prescriptions_feat_df': PROCESSED_HOSP_DATA_DIR / "prescriptions_feat_df"}),
+    Stage('labevents', lab_features_stage, inputs=['cohort_df', 'backend'], outputs=list(LAB_FEATURE_FAMILIES),
+          sources=[LABEVENTS_PATH, D_LABITEMS_PATH],
+          config=['LAB_KEYWORDS', 'LAB_ITEM_ID_MAP', 'ANEMIA_THRESH', 'HYPONATREMIA_THRESH', 'AKI_RISE_THRESH'],
+          code=['assessment.hosp_labevents', 'assessment.hosp_labevents_windowed', 'assessment.hosp_labevents_scan',
+                'assessment.hosp_labevents_shards', 'assessment.hosp_labevents_incremental',
+                'assessment.lab_accumulators', 'assessment.datasets', 'assessment.backends', 'assessment.timestamps'],
+          artifacts={name: PROCESSED_HOSP_DATA_DIR / name for name in LAB_FEATURE_FAMILIES},
+          cpu_budget=LAB_STAGE_CPU_BUDGET),
+]
+
+
+def run_feature_creation_pipeline(cohort_df, time_to_death_df = None, max_workers = PIPELINE_WORKERS, cache = None,
+                                  report = None, writer = None, backend = FEATURE_BACKEND):
 
+# ------------------------------------------------------
+#                 FEATURE CREATION
+# ------------------------------------------------------
 
-# # ------------------- TIME WINDOW LAB TEST FEATURES -----------------
-    logger.info("----------------- STEP V - TEMPORAL LABEVENTS FEATURES -----------------")
-    logger.info(f"Creating temporal lab tests features for {len(cohort_df)} cohort entries.")
-    labs_feature_time_window_df = create_longitudinal_lab_features(cohort_df, LABEVENTS_PATH)
-    logger.info(f"Temporal lab tests features created for {len(labs_feature_time_window_df)} cohort entries.")
-    # Save to interim data for inspection
-    OUTPUT_PATH = PROCESSED_DATA_DIR / "hosp/temporal_labs_feature_df.csv"
-    labs_feature_time_window_df.to_csv(OUTPUT_PATH, index=False)
-    logger.info(f"Temporal lab tests features interim data saved to {OUTPUT_PATH}")
+    logger.info(f"------------------------------------------------------")
+    logger.info(f"                FEATURE CREATION                      ")
+    logger.info(f"------------------------------------------------------")
 
+    logger.info(f"Creating features for {len(cohort_df)} cohort entries with up to {max_workers} parallel stages")
+    if time_to_death_df is None:
+        time_to_death_df = filter_time_to_death_dataframe(cohort_df)
 
     # ------------------- MERGE ALL FEATURES -----------------
-    # logger.info(f"Merging all features for {len(cohort_df)} patients.")
-    # Merge all features
-    return merge_csvs_in_dir(PROCESSED_HOSP_DATA_DIR)
+    # Each feature table is merged as soon as its stage finishes, onto the time to death table
+    def finished_feature_tables():
+        yield 'time_to_death_df', time_to_death_df
+        initial = {'cohort_df': cohort_df, 'backend': backend}
+        for stage, outputs in run_stages(FEATURE_STAGES, initial, max_workers, cache, report, writer):
+            yield from outputs.items()
+
+    order = ['time_to_death_df'] + [name for stage in FEATURE_STAGES for name in stage.outputs]
+    return merge_feature_frames(finished_feature_tables(), order=order, writer=writer)
+
+
+@app.command()
+def main(backend: str = FEATURE_BACKEND):
+    """
+    Run the cohort and feature pipelines, the feature families on `backend` ('pandas', 'duckdb' or 'polars').
+    """
+    if backend not in BACKENDS:
+        raise typer.BadParameter(f"Unknown backend {backend}, expected one of {list(BACKENDS)}")
+    stage_cache = StageCache() if USE_STAGE_CACHE else None
+    # Wall/CPU time, peak RSS, rows and chunk throughput of every stage, see assessment.profiling
+    run_report = RunReport()
+
+    # Outputs are saved in OUTPUT_FORMAT by a background thread while the next stages run
+    with OutputWriter() as output_writer:
+        # Run the cohort preparation pipeline
+        cohort_df, time_to_death_df = run_cohort_preparation_pipeline(stage_cache, run_report, output_writer)
+
+
+        # Run the feature creation pipeline
+        logger.info("-------------------------- Running feature creation pipeline...")
+        final_feature_df = run_feature_creation_pipeline(cohort_df, time_to_death_df, cache=stage_cache,
+                                                         report=run_report, writer=output_writer, backend=backend)
+        logger.info("-------------------------- Feature creation pipeline completed.")
+
+        # Save the final feature dataframe
+        OUTPUT_PATH = output_writer.write(final_feature_df, PROCESSED_HOSP_DATA_DIR / "final_feature_df",
+                                          name="Final feature dataframe")
+        # Time spent waiting for the outputs still queued, i.e. not overlapped with the pipeline
+        with run_report.block('save_outputs', rows_in=len(final_feature_df)):
+            output_writer.flush()
+        logger.info(f"-------------------------- Final feature dataframe saved to {OUTPUT_PATH}")
+    run_report.save()
 
 
 if __name__ == "__main__":
-    # Run the cohort preparation pipeline
-    cohort_df, time_to_death_df = run_cohort_preparation_pipeline()
-    
-
-    # Run the feature creation pipeline
-    logger.info("-------------------------- Running feature creation pipeline...")
-    final_feature_df = run_feature_creation_pipeline(cohort_df)
-    logger.info("-------------------------- Feature creation pipeline completed.")
-
-    # Save the final feature dataframe
-    OUTPUT_PATH = PROCESSED_DATA_DIR / "hosp/final_feature_df.csv"
-    final_feature_df.to_csv(OUTPUT_PATH, index=False)
-    logger.info(f"-------------------------- Final feature dataframe saved to {OUTPUT_PATH}")
\ No newline at end of file
+    app()
@@ -0,0 +1,63 @@
+"""
+Small synthetic MIMIC-IV hosp tables shared by the tests, generated once per test run.
+
+Importing this module points DATA_DIR at a temporary directory, so it must be imported
+before any assessment module: every path of assessment.config derives from DATA_DIR.
+"""
+import atexit
+from functools import cache
+import os
+from pathlib import Path
+import shutil
+import tempfile
+
+DATA_DIR = Path(tempfile.mkdtemp(prefix="assessment_tests_"))
+os.environ["DATA_DIR"] = str(DATA_DIR)
+atexit.register(shutil.rmtree, DATA_DIR, ignore_errors=True)
+
+from loguru import logger  # noqa: E402
+import pandas as pd  # noqa: E402
+
+from assessment.config import LABEVENTS_PATH, MIMIC_HOSP_DATA_DIR  # noqa: E402
+from assessment.features_hosp import prepare_cohort  # noqa: E402
+from assessment.synthetic import generate_hosp_tables  # noqa: E402
+
+N_SUBJECTS = 800
+N_LABEVENTS = 40000
+# Outpatient lab events (no hadm_id) of cohort subjects appended again, after their final admission
+N_LATE_OUTPATIENT_EVENTS = 100
+
+# Only warnings and errors of the pipeline in the test output
+logger.remove()
+logger.add(lambda message: print(message, end=""), level="WARNING")
+
+
+def _add_late_outpatient_events(labevents_path, subject_ids):
+    labevents = pd.read_csv(labevents_path, dtype=str, keep_default_na=False)
+    outpatient = labevents[(labevents['hadm_id'] == '') & labevents['subject_id'].isin(subject_ids.astype(str))]
+    outpatient = outpatient.head(N_LATE_OUTPATIENT_EVENTS).copy()
+    charttime = pd.to_datetime(outpatient['charttime']) + pd.DateOffset(years=30)
+    outpatient['charttime'] = charttime.dt.strftime('%Y-%m-%d %H:%M:%S')
+    outpatient.to_csv(labevents_path, mode='a', header=False, index=False)
+
+
+@cache
+def _hosp_tables():
+    generate_hosp_tables(MIMIC_HOSP_DATA_DIR, N_SUBJECTS, n_labevents=N_LABEVENTS, seed=7)
+    cohort_df = prepare_cohort()
+    _add_late_outpatient_events(LABEVENTS_PATH, cohort_df['subject_id'].unique())
+    return MIMIC_HOSP_DATA_DIR, cohort_df
+
+
+def hosp_tables() -> Path:
+    """
+    Directory of the synthetic hosp tables, the MIMIC_HOSP_DATA_DIR of the tests.
+    """
+    return _hosp_tables()[0]
+
+
+def cohort() -> pd.DataFrame:
+    """
+    Cohort of the synthetic tables (a copy, the tests may modify it).
+    """
+    return _hosp_tables()[1].copy()
@@ -0,0 +1,107 @@
+from functools import partial
+import unittest
+from unittest import mock
+
+import hosp_fixture  # noqa: F401  (sets DATA_DIR, imported first)
+import pandas as pd
+
+from assessment.backends import HAS_DUCKDB, HAS_POLARS, DuckDBBackend, PandasBackend, PolarsBackend
+from assessment.config import (
+    ADMISSIONS_PATH,
+    DIAGNOSES_ICD_PATH,
+    LABEVENTS_PATH,
+    PRESCRIPTIONS_PATH,
+)
+from assessment.hosp_labevents import PriorLabFeatures, identify_lab_itemid_map, scan_labevents
+from assessment.hosp_labevents_windowed import WindowedLabFeatures
+from assessment.hosp_meds import MEDS_FEATURE_COLUMNS
+
+
+def sorted_rows(df) -> pd.DataFrame:
+    """
+    Rows of `df` in a fixed order, engines may return them in any order. Categories sort on their text.
+    """
+    def sort_key(col):
+        return col.astype(str) if isinstance(col.dtype, pd.CategoricalDtype) else col
+    return df.sort_values(list(df.columns), key=sort_key, kind='stable', ignore_index=True)
+
+
+class BackendParity:
+    """
+    Tables, lab event chunks and lab features of a backend match the pandas reference backend,
+    up to the order of the rows.
+    """
+
+    def make_backend(self):
+        raise NotImplementedError
+
+    @classmethod
+    def setUpClass(cls):
+        hosp_fixture.hosp_tables()
+        cls.cohort_df = hosp_fixture.cohort()
+        cls.itemids = list(identify_lab_itemid_map())
+
+    def setUp(self):
+        self.backend = self.make_backend()
+        self.reference = PandasBackend()
+
+    def assert_same_table(self, *args, **kwargs):
+        pd.testing.assert_frame_equal(sorted_rows(self.backend.load_table(*args, **kwargs)),
+                                      sorted_rows(self.reference.load_table(*args, **kwargs)),
+                                      check_categorical=False)
+
+    def assert_same_tables(self):
+        self.assert_same_table('admissions', ADMISSIONS_PATH)
+        self.assert_same_table('diagnoses_icd', DIAGNOSES_ICD_PATH, hadm_ids=self.cohort_df['hadm_id'])
+        self.assert_same_table('prescriptions', PRESCRIPTIONS_PATH, usecols=MEDS_FEATURE_COLUMNS,
+                               subject_ids=self.cohort_df['subject_id'], hadm_ids=self.cohort_df['hadm_id'])
+
+    def test_tables_from_cache(self):
+        self.assert_same_tables()
+
+    def test_tables_from_csv(self):
+        with mock.patch('assessment.backends.USE_HOSP_CACHE', False):
+            self.assert_same_tables()
+
+    def assert_same_labevents(self, subject_ids, chunksize):
+        def read(backend):
+            chunks = backend.iter_labevents_chunks(LABEVENTS_PATH, self.itemids, subject_ids, chunksize=chunksize)
+            return [chunk.reset_index(drop=True) for chunk in chunks]
+
+        chunks, reference = read(self.backend), read(self.reference)
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), chunksize)
+        pd.testing.assert_frame_equal(sorted_rows(pd.concat(chunks, ignore_index=True)),
+                                      sorted_rows(pd.concat(reference, ignore_index=True)))
+
+    def test_labevents_of_cohort(self):
+        self.assert_same_labevents(self.cohort_df['subject_id'].unique(), chunksize=1000)
+
+    def test_labevents_of_every_subject(self):
+        self.assert_same_labevents(None, chunksize=5000)
+
+    def test_lab_features(self):
+        factories = {'labs_feature_df': PriorLabFeatures,
+                     'labs_windowed_feature_df': partial(WindowedLabFeatures, window_days=[365, 30, 7])}
+        features = scan_labevents(self.cohort_df, LABEVENTS_PATH, factories, chunksize=1000, backend=self.backend)
+        reference = scan_labevents(self.cohort_df, LABEVENTS_PATH, factories, chunksize=1000)
+        for name, feature_df in features.items():
+            with self.subTest(name=name):
+                pd.testing.assert_frame_equal(feature_df, reference[name])
+
+
+@unittest.skipUnless(HAS_DUCKDB, "duckdb is not installed")
+class TestDuckDBBackend(BackendParity, unittest.TestCase):
+
+    def make_backend(self):
+        return DuckDBBackend(threads=2)
+
+
+@unittest.skipUnless(HAS_POLARS, "polars is not installed")
+class TestPolarsBackend(BackendParity, unittest.TestCase):
+
+    def make_backend(self):
+        return PolarsBackend()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+
+import hosp_fixture  # noqa: F401  (sets DATA_DIR, imported first)
+import numpy as np
+import pandas as pd
+
+from assessment.code_classifiers import KeywordClassifier, PrefixClassifier
+from assessment.config import DRUG_CLASS_MAP, ICD_CONDITION_MAP, PROCEDURE_ICD_MAP
+from assessment.datasets import load_diagnoses_data, load_prescriptions_data, load_procedures_data
+
+
+def startswith_flags(codes, prefix_map) -> pd.DataFrame:
+    """
+    The original per code prefix test of the diagnosis and procedure features.
+    """
+    codes = codes.astype(str)
+    return pd.DataFrame({label: codes.apply(lambda code, prefixes=tuple(prefixes): code.startswith(prefixes))
+                         for label, prefixes in prefix_map.items()}, index=codes.index)
+
+
+def contains_flags(drugs, keyword_map) -> pd.DataFrame:
+    """
+    The original per class substring test of the medication features.
+    """
+    return pd.DataFrame({label: drugs.str.lower().str.contains('|'.join(keywords), na=False)
+                         for label, keywords in keyword_map.items()}, index=drugs.index)
+
+
+class TestPrefixClassifier(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        hosp_fixture.hosp_tables()
+
+    def assert_flags_match(self, codes, prefix_map):
+        pd.testing.assert_frame_equal(PrefixClassifier(prefix_map).flags(codes), startswith_flags(codes, prefix_map))
+
+    def test_icd_conditions(self):
+        codes = load_diagnoses_data()['icd_code']
+        self.assertTrue(PrefixClassifier(ICD_CONDITION_MAP).flags(codes).any().any())
+        self.assert_flags_match(codes, ICD_CONDITION_MAP)
+
+    def test_procedures(self):
+        self.assert_flags_match(load_procedures_data()['icd_code'], PROCEDURE_ICD_MAP)
+
+    def test_overlapping_prefixes(self):
+        prefix_map = {'short': ['E1'], 'long': ['E11', 'I5'], 'exact': ['E119']}
+        codes = pd.Series(['E119', 'E11', 'E1', 'E', 'I50', 'e119', ''])
+        self.assert_flags_match(codes, prefix_map)
+
+    def test_missing_codes_have_no_label(self):
+        masks = PrefixClassifier({'a': ['A']}).classify(pd.Series(['A1', None, np.nan, 'B']))
+        np.testing.assert_array_equal(masks, [1, 0, 0, 0])
+
+
+class TestKeywordClassifier(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        hosp_fixture.hosp_tables()
+
+    def assert_flags_match(self, drugs, keyword_map):
+        pd.testing.assert_frame_equal(KeywordClassifier(keyword_map).flags(drugs).where(drugs.notna(), False),
+                                      contains_flags(drugs, keyword_map))
+
+    def test_drug_classes(self):
+        drugs = load_prescriptions_data()['drug']
+        self.assertTrue(KeywordClassifier(DRUG_CLASS_MAP).flags(drugs).any().any())
+        self.assert_flags_match(drugs, DRUG_CLASS_MAP)
+
+    def test_overlapping_keywords(self):
+        keyword_map = {'she': ['she'], 'he': ['he', 'hers'], 'his': ['his']}
+        drugs = pd.Series(['ushers', 'HIS', 'ahishers', 'h', 'sh', '', None])
+        self.assert_flags_match(drugs, keyword_map)
+
+    def test_too_many_labels(self):
+        with self.assertRaises(ValueError):
+            KeywordClassifier({f'label_{i}': [str(i)] for i in range(65)})
+
+
+if __name__ == '__main__':
+    unittest.main()
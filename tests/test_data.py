@@ -1,10 +1,114 @@
 import unittest
+from unittest import mock
 
+import hosp_fixture  # noqa: F401  (sets DATA_DIR, imported first)
+import pandas as pd
 
-class TestCodeIsTested(unittest.TestCase):
+from assessment.config import (
+    ADMISSIONS_PATH,
+    LABEVENTS_PATH,
+    PRESCRIPTIONS_PATH,
+    PROCEDURES_ICD_PATH,
+)
+from assessment.datasets import (
+    HAS_PYARROW,
+    HOSP_DATE_COLUMNS,
+    HOSP_TABLE_SCHEMAS,
+    LABEVENTS_FEATURE_COLUMNS,
+    iter_labevents_chunks,
+    load_hosp_table,
+    read_raw_table,
+)
 
-    def test_code_is_tested(self):
-        self.assertTrue(False)
+
+def read_csv(table, source_path, usecols = None) -> pd.DataFrame:
+    """
+    The original untyped read of a hosp table, datetimes parsed afterwards. The columns the schema
+    keeps as text (codes, doses) are read as text.
+    """
+    schema = HOSP_TABLE_SCHEMAS[table]
+    text = {col: str for col, dtype in schema['dtype'].items() if dtype == 'str'}
+    df = pd.read_csv(source_path, usecols=usecols, dtype=text)
+    for col in schema['datetimes']:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col]).astype('datetime64[ns]')
+    return df
+
+
+class TestHospTables(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        hosp_fixture.hosp_tables()
+        cls.subject_ids = hosp_fixture.cohort()['subject_id'].unique()
+
+    def assert_same_values(self, typed, reference):
+        self.assertEqual(list(typed.columns), list(reference.columns))
+        pd.testing.assert_frame_equal(typed.astype(object).where(typed.notna(), None),
+                                      reference.astype(object).where(reference.notna(), None), check_dtype=False)
+
+    def test_typed_read_matches_plain_read(self):
+        for table, path in [('admissions', ADMISSIONS_PATH), ('procedures_icd', PROCEDURES_ICD_PATH),
+                            ('prescriptions', PRESCRIPTIONS_PATH)]:
+            with self.subTest(table=table):
+                typed = read_raw_table(table, path)
+                self.assertEqual(str(typed['subject_id'].dtype), 'int32')
+                self.assert_same_values(typed, read_csv(table, path))
+
+    def test_projection_and_subject_filter(self):
+        # In file order, the order the typed reader keeps
+        usecols = ['hadm_id', 'starttime', 'drug']
+        typed = read_raw_table('prescriptions', PRESCRIPTIONS_PATH, usecols, self.subject_ids)
+        reference = read_csv('prescriptions', PRESCRIPTIONS_PATH)
+        reference = reference[reference['subject_id'].isin(self.subject_ids)][usecols].reset_index(drop=True)
+        self.assert_same_values(typed, reference)
+
+    def test_dates_are_parsed(self):
+        typed = read_raw_table('procedures_icd', PROCEDURES_ICD_PATH)
+        self.assertIn('chartdate', HOSP_DATE_COLUMNS)
+        self.assertEqual(str(typed['chartdate'].dtype), 'datetime64[ns]')
+
+    @unittest.skipUnless(HAS_PYARROW, "pyarrow is not installed")
+    def test_cache_matches_raw_read(self):
+        usecols = ['subject_id', 'hadm_id', 'drug', 'route']
+        cached = load_hosp_table('prescriptions', PRESCRIPTIONS_PATH, usecols, self.subject_ids)
+        with mock.patch('assessment.datasets.USE_HOSP_CACHE', False):
+            raw = load_hosp_table('prescriptions', PRESCRIPTIONS_PATH, usecols, self.subject_ids)
+        pd.testing.assert_frame_equal(cached, raw, check_categorical=False)
+
+
+class TestLabeventsChunks(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        hosp_fixture.hosp_tables()
+        cls.subject_ids = hosp_fixture.cohort()['subject_id'].unique()
+
+    def read(self, engine, **kwargs) -> pd.DataFrame:
+        chunks = iter_labevents_chunks(LABEVENTS_PATH, engine=engine, chunksize=5000, **kwargs)
+        return pd.concat(chunks, ignore_index=True)
+
+    def assert_same_events(self, chunks, reference):
+        self.assertGreater(len(chunks), 0)
+        pd.testing.assert_frame_equal(chunks, reference, check_dtype=False)
+
+    def test_pandas_reader_matches_plain_read(self):
+        itemids = [50983, 50912]
+        reference = pd.read_csv(LABEVENTS_PATH, usecols=LABEVENTS_FEATURE_COLUMNS)
+        reference = reference[reference['itemid'].isin(itemids) & reference['subject_id'].isin(self.subject_ids)]
+        chunks = self.read('pandas', itemids=itemids, subject_ids=self.subject_ids)
+        self.assert_same_events(chunks, reference[LABEVENTS_FEATURE_COLUMNS].reset_index(drop=True))
+
+    @unittest.skipUnless(HAS_PYARROW, "pyarrow is not installed")
+    def test_arrow_reader_matches_pandas_reader(self):
+        reference = self.read('pandas', subject_ids=self.subject_ids)
+        chunks = self.read('pyarrow', subject_ids=self.subject_ids)
+        chunks['charttime'] = chunks['charttime'].dt.strftime('%Y-%m-%d %H:%M:%S')
+        pd.testing.assert_frame_equal(chunks, reference)
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            iter_labevents_chunks(LABEVENTS_PATH, engine='spark')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,97 @@
+from pathlib import Path
+import tempfile
+import unittest
+
+import hosp_fixture  # noqa: F401  (sets DATA_DIR, imported first)
+import numpy as np
+import pandas as pd
+
+from assessment.feature_dtypes import (
+    compact_dtypes,
+    compact_feature_frame,
+    load_compact_features,
+    manifest_path,
+    save_compact_features,
+)
+from assessment.outputs import OutputWriter
+
+
+def feature_frame() -> pd.DataFrame:
+    """
+    Merged features of 6 subjects, with MIMIC sized ids (above 2**24) and missing values.
+    """
+    return pd.DataFrame({
+        'subject_id': np.arange(19999990, 19999996, dtype='int64'),
+        # Ids with missing values are read as floats
+        'hadm_id': [29999991.0, np.nan, 29999993.0, 29999994.0, 29999995.0, 29999997.0],
+        'count_prior_admissions': np.array([0, 1, 2, 3, 4, 120], dtype='int64'),
+        'n_events': pd.array([3, None, 40000, 1, 2, 5], dtype='Int64'),
+        'total_stay_minutes': [16777217.0, 20000001.0, np.nan, 3.0, 5.0, 7.0],
+        'sodium_prior_avg': [140.5, np.nan, 135.25, 138.0, 141.0, 139.0],
+        'lactate_7d_max': [np.nan, np.nan, np.nan, np.nan, 2.5, np.nan],
+        'flag_history_on_insulin': [True, False, False, True, False, False],
+        'admittime': pd.to_datetime(['2150-01-01 10:00:00', None, '2151-02-03 04:05:06', '2152-01-01 00:00:00',
+                                     '2153-01-01 00:00:00', '2154-01-01 00:00:00']).astype('datetime64[ns]'),
+    })
+
+
+class TestCompactDtypes(unittest.TestCase):
+
+    def test_dtypes(self):
+        self.assertEqual(compact_dtypes(feature_frame()), {
+            'subject_id': 'int32',
+            'hadm_id': 'Int32',
+            'count_prior_admissions': 'int8',
+            'n_events': 'Int32',
+            'total_stay_minutes': 'Int32',
+            'sodium_prior_avg': 'float32',
+            'lactate_7d_max': 'Sparse[float32, nan]',
+            'flag_history_on_insulin': 'bool',
+            'admittime': 'datetime64[ns]',
+        })
+
+    def test_ids_and_large_integers_are_exact(self):
+        df = feature_frame()
+        compact_df, _ = compact_feature_frame(df)
+        for col in ['subject_id', 'hadm_id', 'n_events', 'total_stay_minutes']:
+            with self.subTest(col=col):
+                np.testing.assert_array_equal(compact_df[col].astype('float64'), df[col].astype('float64'))
+
+    def test_fractional_ids_keep_their_dtype(self):
+        df = pd.DataFrame({'stay_id': [1.5, np.nan, 3.0]})
+        self.assertEqual(compact_dtypes(df), {'stay_id': 'float64'})
+
+
+class TestCompactRoundTrip(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.path = Path(self.tmp_dir.name) / "final_feature_df_compact"
+
+    def assert_round_trip(self, format):
+        df = feature_frame()
+        compact_df, dtypes = compact_feature_frame(df)
+        path = save_compact_features(df, self.path, writer=OutputWriter(format, background=False))
+        self.assertTrue(manifest_path(path).exists())
+
+        loaded = load_compact_features(path)
+        self.assertEqual({col: str(dtype) for col, dtype in loaded.dtypes.items()}, dtypes)
+        pd.testing.assert_frame_equal(loaded, compact_df)
+        # Values are those of the original table, floats to float32 precision
+        pd.testing.assert_frame_equal(loaded.astype({col: 'float64' for col in dtypes if col != 'admittime'}),
+                                      df.astype({col: 'float64' for col in dtypes if col != 'admittime'}),
+                                      check_dtype=False, rtol=1e-6)
+
+    def test_csv(self):
+        self.assert_round_trip('csv')
+
+    def test_parquet(self):
+        self.assert_round_trip('parquet')
+
+    def test_feather(self):
+        self.assert_round_trip('feather')
+
+
+if __name__ == '__main__':
+    unittest.main()
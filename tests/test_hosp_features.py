@@ -0,0 +1,175 @@
+from datetime import timedelta
+import unittest
+
+import hosp_fixture  # noqa: F401  (sets DATA_DIR, imported first)
+import numpy as np
+import pandas as pd
+
+from assessment.config import DRUG_CLASS_MAP, ICD_CONDITION_MAP, PROCEDURE_ICD_MAP
+from assessment.datasets import load_diagnoses_data, load_prescriptions_data, load_procedures_data
+from assessment.hosp_diagnosis import create_diagnosis_features
+from assessment.hosp_meds import MEDS_FEATURE_COLUMNS, create_meds_features
+from assessment.hosp_procedure import create_procedures_features
+
+
+def per_subject_diagnosis_features(cohort_df, diagnoses_df) -> pd.DataFrame:
+    """
+    The per subject loop of the original create_diagnosis_features.
+    """
+    feature_rows = []
+    for sid, group in cohort_df.groupby('subject_id'):
+        patient_diag = diagnoses_df[diagnoses_df['subject_id'] == sid]
+        admissions_sorted = group.sort_values('admittime')
+        if len(admissions_sorted) < 2:
+            continue
+        final_adm = admissions_sorted.iloc[-1]
+        prior_adms = admissions_sorted.iloc[:-1]
+        final_adm_time = final_adm['admittime']
+
+        prior_diag = patient_diag[patient_diag['hadm_id'].isin(prior_adms['hadm_id'])]
+        icd_codes = prior_diag['icd_code'].astype(str)
+        flags = {f"flag_history_{k}": int(any(icd.startswith(tuple(v)) for icd in icd_codes))
+                 for k, v in ICD_CONDITION_MAP.items()}
+        condition_stats = {}
+        for condition, codes in ICD_CONDITION_MAP.items():
+            cond_mask = icd_codes.apply(lambda x, codes=codes: any(x.startswith(code) for code in codes))
+            condition_stats[f'count_prior_admissions_with_{condition}'] = prior_diag[cond_mask]['hadm_id'].nunique()
+            relevant_diag = prior_diag[cond_mask]
+            if not relevant_diag.empty:
+                merged_dates = relevant_diag.merge(cohort_df[['hadm_id', 'admittime']], on='hadm_id')
+                time_first = (final_adm_time - merged_dates['admittime'].min()).days / 365.0
+                condition_stats[f'time_since_first_diagnosis_{condition}_years'] = round(time_first, 2)
+            else:
+                condition_stats[f'time_since_first_diagnosis_{condition}_years'] = np.nan
+
+        one_year_ago = final_adm_time - timedelta(days=365)
+        feature_rows.append({
+            'subject_id': sid,
+            'hadm_id': final_adm['hadm_id'],
+            'count_prior_admissions': len(prior_adms),
+            'count_unique_diagnoses_prior': icd_codes.nunique(),
+            'avg_diagnoses_per_prior_admission': prior_diag.groupby('hadm_id')['icd_code'].count().mean(),
+            'time_since_last_admission_days': (final_adm_time - prior_adms['dischtime'].max()).days,
+            'admission_frequency_last_year': len(prior_adms[prior_adms['admittime'] >= one_year_ago]),
+            **flags,
+            **condition_stats,
+        })
+    return pd.DataFrame(feature_rows)
+
+
+def per_subject_procedures_features(cohort_df, procedures_df) -> pd.DataFrame:
+    """
+    The per subject loop of the original create_procedures_features.
+    """
+    feature_rows = []
+    for sid, group in cohort_df.groupby('subject_id'):
+        patient_proc = procedures_df[procedures_df['subject_id'] == sid]
+        admissions_sorted = group.sort_values('admittime')
+        if len(admissions_sorted) < 2:
+            continue
+        final_adm = admissions_sorted.iloc[-1]
+        prior_adms = admissions_sorted.iloc[:-1]
+        final_adm_time = final_adm['admittime']
+
+        prior_proc = patient_proc[patient_proc['hadm_id'].isin(prior_adms['hadm_id'])]
+        proc_codes = prior_proc['icd_code'].astype(str)
+        flags = {f"flag_history_{k}": int(any(code.startswith(tuple(v)) for code in proc_codes))
+                 for k, v in PROCEDURE_ICD_MAP.items()}
+
+        major_surg_codes = PROCEDURE_ICD_MAP['major_surgery']
+        major_surg_mask = proc_codes.apply(lambda x: any(x.startswith(code) for code in major_surg_codes))
+        prior_major_surg = prior_proc[major_surg_mask]
+        if not prior_major_surg.empty:
+            merged_dates = prior_major_surg.merge(cohort_df[['hadm_id', 'admittime']], on='hadm_id')
+            time_since_major_surg = round((final_adm_time - merged_dates['admittime'].max()).days / 365.0, 2)
+        else:
+            time_since_major_surg = np.nan
+
+        feature_rows.append({
+            'subject_id': sid,
+            'hadm_id': final_adm['hadm_id'],
+            'count_prior_procedures': len(proc_codes),
+            'count_unique_procedures_prior': proc_codes.nunique(),
+            'count_prior_admissions_with_procedure': prior_proc['hadm_id'].nunique(),
+            'time_since_last_major_surgery_years': time_since_major_surg,
+            'flag_procedure_in_last_prior_admission': int(prior_adms.iloc[-1]['hadm_id']
+                                                          in prior_proc['hadm_id'].unique()),
+            **flags,
+        })
+    return pd.DataFrame(feature_rows)
+
+
+def per_subject_meds_features(cohort_df, prescriptions_df) -> pd.DataFrame:
+    """
+    The per subject loop of the original create_meds_features.
+    """
+    feature_rows = []
+    for sid, group in cohort_df.groupby('subject_id'):
+        patient_presc = prescriptions_df[prescriptions_df['subject_id'] == sid]
+        group = group.sort_values('admittime')
+        final_admit_time = group.iloc[-1]['admittime']
+        prior_admits = group[group['admittime'] < final_admit_time]['hadm_id'].values
+        prior_presc = patient_presc[patient_presc['hadm_id'].isin(prior_admits)]
+
+        feature = {
+            'subject_id': sid,
+            'count_prior_prescriptions': len(prior_presc),
+            'count_unique_drugs_prior': prior_presc['drug'].nunique(),
+            'avg_drugs_per_prior_admission': (
+                prior_presc.groupby('hadm_id')['drug'].nunique().mean() if len(prior_admits) > 0 else 0
+            ),
+        }
+        drug_list = prior_presc['drug'].str.lower().dropna().unique()
+        for drug_class, keywords in DRUG_CLASS_MAP.items():
+            feature[f'flag_history_on_{drug_class}'] = int(any(any(kw in drug for kw in keywords)
+                                                               for drug in drug_list))
+            matched_hadm = prior_presc[
+                prior_presc['drug'].str.lower().str.contains('|'.join(keywords), na=False)
+            ]['hadm_id'].unique()
+            feature[f'count_prior_admissions_on_{drug_class}'] = len(matched_hadm)
+
+        if len(prior_admits) > 0:
+            last_admit = group[group['admittime'] < final_admit_time].iloc[-1]
+            last_presc = patient_presc[patient_presc['hadm_id'] == last_admit['hadm_id']]
+            last_steroids = last_presc['drug'].str.lower().str.contains('|'.join(DRUG_CLASS_MAP['steroids']),
+                                                                       na=False).any()
+            feature['flag_on_steroids_last_prior_admission'] = int(last_steroids)
+        else:
+            feature['flag_on_steroids_last_prior_admission'] = 0
+        feature_rows.append(feature)
+    return pd.DataFrame(feature_rows)
+
+
+class TestHospFeatureBuilders(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        hosp_fixture.hosp_tables()
+        cls.cohort_df = hosp_fixture.cohort()
+
+    def assert_matches_reference(self, actual, expected):
+        self.assertGreater(len(actual), 0)
+        pd.testing.assert_frame_equal(actual.reset_index(drop=True), expected, check_dtype=False)
+
+    def test_diagnosis_features(self):
+        diagnoses_df = load_diagnoses_data()
+        actual = create_diagnosis_features(self.cohort_df, diagnoses_df)
+        self.assertTrue(actual.filter(like='flag_history_').any().any())
+        self.assert_matches_reference(actual, per_subject_diagnosis_features(self.cohort_df, diagnoses_df))
+
+    def test_procedures_features(self):
+        procedures_df = load_procedures_data()
+        actual = create_procedures_features(self.cohort_df, procedures_df)
+        self.assertTrue(actual['time_since_last_major_surgery_years'].notna().any())
+        self.assert_matches_reference(actual, per_subject_procedures_features(self.cohort_df, procedures_df))
+
+    def test_meds_features(self):
+        prescriptions_df = load_prescriptions_data(usecols=MEDS_FEATURE_COLUMNS,
+                                                   subject_ids=self.cohort_df['subject_id'])
+        actual = create_meds_features(self.cohort_df, prescriptions_df)
+        self.assertTrue(actual.filter(like='flag_history_on_').any().any())
+        self.assert_matches_reference(actual, per_subject_meds_features(self.cohort_df, prescriptions_df))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,356 @@
+from collections import defaultdict
+from pathlib import Path
+import shutil
+import tempfile
+import unittest
+
+import hosp_fixture  # noqa: F401  (sets DATA_DIR, imported first)
+import numpy as np
+import pandas as pd
+
+from assessment.config import ANEMIA_THRESH, HYPONATREMIA_THRESH, LAB_KEYWORDS, LABEVENTS_PATH
+from assessment.hosp_labevents import (
+    PriorLabFeatures,
+    create_labsevents_features_chunked,
+    identify_lab_itemid_map,
+    prepare_lab_events,
+)
+from assessment.hosp_labevents_incremental import update_lab_feature_families
+from assessment.hosp_labevents_scan import create_lab_feature_families
+from assessment.hosp_labevents_shards import create_lab_feature_families_parallel
+from assessment.hosp_labevents_windowed import (
+    WindowedLabFeatures,
+    create_longitudinal_lab_features,
+)
+from assessment.lab_accumulators import LabStatsAccumulator
+
+
+def per_event_prior_lab_features(cohort_df, labevents_path, lab_itemid_map) -> pd.DataFrame:
+    """
+    The per event loop of the original create_labsevents_features_chunked, the reference of the
+    vectorized PriorLabFeatures, with the tie rule of the last value of lab_accumulators. Outpatient
+    events (no hadm_id) count when drawn before the final admission.
+    """
+    admittime = pd.to_datetime(cohort_df['admittime'])
+    final_admit_time = admittime.groupby(cohort_df['subject_id']).max()
+    prior_hadm_ids = set(cohort_df.loc[admittime < cohort_df['subject_id'].map(final_admit_time), 'hadm_id'])
+    events = pd.read_csv(labevents_path, usecols=['subject_id', 'hadm_id', 'itemid', 'charttime', 'valuenum'])
+    events['charttime'] = pd.to_datetime(events['charttime'])
+
+    lab_stats = defaultdict(lambda: defaultdict(list))
+    last_lab_values = defaultdict(dict)
+    lab_abnormal_counts = defaultdict(lambda: defaultdict(int))
+    for row in events.itertuples(index=False):
+        lab_name = lab_itemid_map.get(row.itemid)
+        if row.subject_id not in final_admit_time.index or lab_name is None or pd.isna(row.valuenum):
+            continue
+        if pd.isna(row.hadm_id):
+            if not row.charttime < final_admit_time[row.subject_id]:
+                continue
+        elif row.hadm_id not in prior_hadm_ids:
+            continue
+
+        sid, val = row.subject_id, row.valuenum
+        lab_stats[sid][lab_name].append(val)
+        current_last = last_lab_values[sid].get(lab_name, (pd.Timestamp.min, np.nan))
+        # The larger value wins on equal charttimes, whatever the order the events are read in
+        if row.charttime > current_last[0] or (row.charttime == current_last[0] and val > current_last[1]):
+            last_lab_values[sid][lab_name] = (row.charttime, val)
+        if lab_name == 'hemoglobin' and val < ANEMIA_THRESH:
+            lab_abnormal_counts[sid]['chronic_anemia'] += 1
+        if lab_name == 'sodium' and val < HYPONATREMIA_THRESH:
+            lab_abnormal_counts[sid]['severe_hyponatremia'] += 1
+
+    feature_rows = []
+    for sid in set(cohort_df['subject_id']):
+        row = {'subject_id': sid}
+        labs = lab_stats.get(sid, {})
+        row['count_prior_labevents'] = sum(len(vals) for vals in labs.values())
+        row['count_unique_labs_tested_prior'] = len(labs)
+        for lab, values in labs.items():
+            row[f'{lab}_prior_avg'] = np.mean(values)
+            row[f'{lab}_prior_min'] = np.min(values)
+            row[f'{lab}_prior_max'] = np.max(values)
+            row[f'{lab}_prior_std'] = np.std(values)
+        for lab in lab_itemid_map.values():
+            row[f'last_{lab}_value_prior'] = last_lab_values[sid].get(lab, (None, np.nan))[1]
+        row['count_prior_severe_hyponatremia'] = lab_abnormal_counts[sid].get('severe_hyponatremia', 0)
+        row['flag_chronic_anemia_prior'] = int(lab_abnormal_counts[sid].get('chronic_anemia', 0) >= 2)
+        feature_rows.append(row)
+    return pd.DataFrame(feature_rows)
+
+
+def per_event_windowed_lab_features(cohort_df, events, lab_itemid_map, window_days) -> pd.DataFrame:
+    """
+    The per event loop of the original create_longitudinal_lab_features over parsed events, the
+    reference of the window tagging of WindowedLabFeatures. An event is in every window whose
+    start (final admittime - days) it is not before, events after the final admission included.
+    """
+    final_admit_time = pd.to_datetime(cohort_df['admittime']).groupby(cohort_df['subject_id']).max()
+    lab_stats = {days: defaultdict(lambda: defaultdict(list)) for days in window_days}
+    last_lab_values = {days: defaultdict(dict) for days in window_days}
+    abnormal_counts = {days: defaultdict(lambda: defaultdict(int)) for days in window_days}
+    for row in events.itertuples(index=False):
+        lab_name = lab_itemid_map.get(row.itemid)
+        if row.subject_id not in final_admit_time.index or lab_name is None or pd.isna(row.valuenum) \
+                or pd.isna(row.charttime):
+            continue
+        sid, val = row.subject_id, row.valuenum
+        for days in window_days:
+            if row.charttime >= final_admit_time[sid] - pd.Timedelta(days=days):
+                lab_stats[days][sid][lab_name].append(val)
+                curr_last = last_lab_values[days][sid].get(lab_name, (pd.Timestamp.min, np.nan))
+                if row.charttime > curr_last[0] or (row.charttime == curr_last[0] and val > curr_last[1]):
+                    last_lab_values[days][sid][lab_name] = (row.charttime, val)
+                if lab_name == 'hemoglobin' and val < ANEMIA_THRESH:
+                    abnormal_counts[days][sid]['chronic_anemia'] += 1
+                if lab_name == 'sodium' and val < HYPONATREMIA_THRESH:
+                    abnormal_counts[days][sid]['severe_hyponatremia'] += 1
+
+    feature_rows = []
+    for sid in cohort_df['subject_id'].unique():
+        row = {'subject_id': sid}
+        for days in window_days:
+            prefix = f'window_{days}d'
+            labs = lab_stats[days].get(sid, {})
+            row[f'{prefix}_count_labevents'] = sum(len(vals) for vals in labs.values())
+            row[f'{prefix}_count_unique_labs'] = len(labs)
+            for lab, values in labs.items():
+                row[f'{prefix}_{lab}_avg'] = np.mean(values)
+                row[f'{prefix}_{lab}_min'] = np.min(values)
+                row[f'{prefix}_{lab}_max'] = np.max(values)
+                row[f'{prefix}_{lab}_std'] = np.std(values)
+            for lab in set(lab_itemid_map.values()):
+                row[f'{prefix}_last_{lab}'] = last_lab_values[days][sid].get(lab, (None, np.nan))[1]
+            row[f'{prefix}_count_severe_hyponatremia'] = abnormal_counts[days][sid].get('severe_hyponatremia', 0)
+            row[f'{prefix}_flag_chronic_anemia'] = int(abnormal_counts[days][sid].get('chronic_anemia', 0) >= 2)
+        feature_rows.append(row)
+    return pd.DataFrame(feature_rows)
+
+
+def assert_same_features(actual, expected):
+    """
+    Same columns in the same order, and the same values for every subject.
+    """
+    assert list(actual.columns) == list(expected.columns), (list(actual.columns), list(expected.columns))
+    pd.testing.assert_frame_equal(actual.sort_values('subject_id').reset_index(drop=True),
+                                  expected.sort_values('subject_id').reset_index(drop=True), check_dtype=False)
+
+
+class TestPriorLabFeatures(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        hosp_fixture.hosp_tables()
+        cls.cohort_df = hosp_fixture.cohort()
+        cls.lab_itemid_map = identify_lab_itemid_map()
+
+    def test_matches_per_event_loop(self):
+        expected = per_event_prior_lab_features(self.cohort_df, LABEVENTS_PATH, self.lab_itemid_map)
+        actual = create_labsevents_features_chunked(self.cohort_df, LABEVENTS_PATH, chunksize=1000)
+        self.assertGreater(actual['count_prior_labevents'].sum(), 0)
+        # The loop ordered the columns by the subject it visited first, the engine by LAB_KEYWORDS
+        self.assertEqual(sorted(actual.columns), sorted(expected.columns))
+        assert_same_features(actual, expected[actual.columns])
+
+    def test_columns_follow_lab_keywords(self):
+        actual = create_labsevents_features_chunked(self.cohort_df, LABEVENTS_PATH, chunksize=1000)
+        labs = [lab for lab in LAB_KEYWORDS if lab in self.lab_itemid_map.values()]
+        stat_labs = [lab for lab in labs if f'{lab}_prior_avg' in actual.columns]
+        self.assertEqual(list(actual.columns),
+                         ['subject_id', 'count_prior_labevents', 'count_unique_labs_tested_prior']
+                         + [f'{lab}_prior_{stat}' for lab in stat_labs for stat in ('avg', 'min', 'max', 'std')]
+                         + [f'last_{lab}_value_prior' for lab in labs]
+                         + ['count_prior_severe_hyponatremia', 'flag_chronic_anemia_prior'])
+
+    def test_chunk_size_does_not_change_features(self):
+        assert_same_features(create_labsevents_features_chunked(self.cohort_df, LABEVENTS_PATH, chunksize=777),
+                             create_labsevents_features_chunked(self.cohort_df, LABEVENTS_PATH, chunksize=10**6))
+
+    def test_events_outside_prior_admissions(self):
+        cohort_df = pd.DataFrame({
+            'subject_id': [1, 1],
+            'hadm_id': [10, 11],
+            'admittime': pd.to_datetime(['2150-01-01 00:00:00', '2150-06-01 00:00:00']),
+        })
+        events = pd.DataFrame({
+            'subject_id': [1, 1, 1, 1],
+            'hadm_id': [10, 11, np.nan, np.nan],
+            'itemid': [1, 1, 1, 1],
+            'lab_name': ['sodium'] * 4,
+            'charttime': pd.to_datetime(['2150-01-02', '2150-06-02', '2150-03-01', '2150-07-01']),
+            'valuenum': [140.0, 120.0, 136.0, 110.0],
+        })
+        family = PriorLabFeatures(cohort_df, {1: 'sodium'})
+        family.update(events)
+        features = family.finalize().iloc[0]
+
+        # The prior admission and the outpatient event before the final admission
+        self.assertEqual(features['count_prior_labevents'], 2)
+        self.assertEqual(features['sodium_prior_min'], 136.0)
+        self.assertEqual(features['last_sodium_value_prior'], 136.0)
+
+    def test_last_value_ties_do_not_depend_on_event_order(self):
+        cohort_df = pd.DataFrame({
+            'subject_id': [1, 1],
+            'hadm_id': [10, 11],
+            'admittime': pd.to_datetime(['2150-01-01 00:00:00', '2150-06-01 00:00:00']),
+        })
+        events = pd.DataFrame({
+            'subject_id': [1, 1, 1, 1],
+            'hadm_id': [10, 10, 10, 10],
+            'itemid': [1, 1, 1, 1],
+            'lab_name': ['sodium'] * 4,
+            'charttime': pd.to_datetime(['2150-01-02', '2150-01-03', '2150-01-03', '2150-01-03']),
+            'valuenum': [150.0, 131.0, 138.0, 135.0],
+        })
+        for order in ([0, 1, 2, 3], [3, 2, 1, 0], [2, 0, 3, 1]):
+            with self.subTest(order=order):
+                family = PriorLabFeatures(cohort_df, {1: 'sodium'})
+                # One event per chunk, ties are also met across chunks
+                for position in order:
+                    family.update(events.iloc[[position]])
+                self.assertEqual(family.finalize().iloc[0]['last_sodium_value_prior'], 138.0)
+
+
+class TestWindowedLabFeatures(unittest.TestCase):
+
+    window_days = (365, 180, 90, 30, 7)
+
+    def assert_matches_per_event_loop(self, actual, expected):
+        self.assertEqual(sorted(actual.columns), sorted(expected.columns))
+        assert_same_features(actual, expected[actual.columns])
+
+    def test_events_on_window_boundaries(self):
+        cohort_df = pd.DataFrame({
+            'subject_id': [1, 1, 2],
+            'hadm_id': [10, 11, 20],
+            'admittime': ['2150-01-01 00:00:00', '2150-06-01 12:00:00', '2150-03-01 00:00:00'],
+        })
+        charttimes = [
+            '2150-05-25 12:00:00',  # exactly 7 days before the final admission
+            '2150-05-25 11:59:59',  # just outside the 7 day window
+            '2149-06-01 12:00:00',  # exactly 365 days before
+            '2149-06-01 11:59:59',  # outside every window
+            '2150-06-01 12:00:00',  # at the final admission
+            '2150-06-03 00:00:00',  # after the final admission
+            None,
+            '2150-02-20 00:00:00',
+        ]
+        events = pd.DataFrame({
+            'subject_id': [1, 1, 1, 1, 1, 1, 1, 2],
+            'hadm_id': [11, np.nan, 10, np.nan, 11, 11, 11, 20],
+            'itemid': [1, 2, 1, 2, 2, 1, 1, 2],
+            'charttime': charttimes,
+            'valuenum': [8.0, 118.0, 9.0, 140.0, 119.0, 12.0, 5.0, 121.0],
+        })
+        lab_itemid_map = {1: 'hemoglobin', 2: 'sodium'}
+        family = WindowedLabFeatures(cohort_df, lab_itemid_map, window_days=self.window_days)
+        family.update(prepare_lab_events(events, lab_itemid_map))
+        actual = family.finalize()
+
+        events['charttime'] = pd.to_datetime(events['charttime'])
+        expected = per_event_windowed_lab_features(cohort_df, events, lab_itemid_map, self.window_days)
+        self.assert_matches_per_event_loop(actual, expected)
+        counts = actual.set_index('subject_id').loc[1, [f'window_{days}d_count_labevents' for days in self.window_days]]
+        self.assertEqual(counts.tolist(), [5, 4, 4, 4, 3])
+
+    def test_matches_per_event_loop(self):
+        hosp_fixture.hosp_tables()
+        cohort_df = hosp_fixture.cohort()
+        lab_itemid_map = identify_lab_itemid_map()
+        events = pd.read_csv(LABEVENTS_PATH, usecols=['subject_id', 'hadm_id', 'itemid', 'charttime', 'valuenum'])
+        events['charttime'] = pd.to_datetime(events['charttime'])
+        # Some events are drawn after the final admission (the late outpatient events of the fixture)
+        final_admit_time = pd.to_datetime(cohort_df['admittime']).groupby(cohort_df['subject_id']).max()
+        self.assertTrue((events['charttime'] > events['subject_id'].map(final_admit_time)).any())
+
+        expected = per_event_windowed_lab_features(cohort_df, events, lab_itemid_map, self.window_days)
+        actual = create_longitudinal_lab_features(cohort_df, LABEVENTS_PATH, window_days=self.window_days,
+                                                  chunksize=1000)
+        self.assertGreater(actual['window_365d_count_labevents'].sum(), 0)
+        self.assert_matches_per_event_loop(actual, expected)
+
+
+class TestLabStatsAccumulator(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        hosp_fixture.hosp_tables()
+        cohort_df = hosp_fixture.cohort()
+        lab_itemid_map = identify_lab_itemid_map()
+        cls.events = prepare_lab_events(pd.read_csv(LABEVENTS_PATH), lab_itemid_map)
+        cls.subjects = cohort_df['subject_id'].unique()
+        cls.lab_names = list(dict.fromkeys(lab_itemid_map.values()))
+
+    def store(self, chunks = 1) -> LabStatsAccumulator:
+        store = LabStatsAccumulator(self.subjects, self.lab_names)
+        for rows in np.array_split(np.arange(len(self.events)), chunks):
+            store.update(self.events.iloc[rows])
+        return store
+
+    def assert_same_store(self, actual, expected):
+        np.testing.assert_array_equal(actual.subjects, expected.subjects)
+        for field in LabStatsAccumulator.ARRAYS:
+            np.testing.assert_allclose(getattr(actual, field), getattr(expected, field), rtol=1e-9, err_msg=field)
+
+    def test_chunked_updates_match_one_update(self):
+        self.assert_same_store(self.store(chunks=13), self.store())
+
+    def test_save_and_load(self):
+        store = self.store(chunks=3)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store.save(f"{tmp_dir}/store.npz")
+            loaded = LabStatsAccumulator.load(f"{tmp_dir}/store.npz")
+        self.assert_same_store(loaded, store)
+
+    def test_concat_of_disjoint_subjects(self):
+        store = self.store()
+        halves = [store.take(self.subjects[::2]), store.take(self.subjects[1::2])]
+        self.assert_same_store(LabStatsAccumulator.concat(halves).take(self.subjects), store)
+
+
+class TestLabFeatureFamilies(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        hosp_fixture.hosp_tables()
+        cls.cohort_df = hosp_fixture.cohort()
+        cls.expected = create_lab_feature_families(cls.cohort_df, LABEVENTS_PATH, chunksize=1000)
+
+    def setUp(self):
+        self.tmp_dir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def assert_same_families(self, actual):
+        self.assertEqual(list(actual), list(self.expected))
+        for name, features in actual.items():
+            assert_same_features(features, self.expected[name])
+
+    def test_sharded_scan_matches_sequential_scan(self):
+        actual = create_lab_feature_families_parallel(self.cohort_df, LABEVENTS_PATH, n_shards=3, max_workers=2,
+                                                      shard_dir=self.tmp_dir / "shards", chunksize=1000)
+        self.assert_same_families(actual)
+
+    def test_incremental_update_matches_full_rebuild(self):
+        # The first run sees the head of the file, the second one the rows appended since
+        lines = LABEVENTS_PATH.read_bytes().splitlines(keepends=True)
+        labevents_path = self.tmp_dir / "labevents.csv"
+        with open(labevents_path, "wb") as labevents_file:
+            labevents_file.writelines(lines[:len(lines) // 2])
+        state_dir = self.tmp_dir / "state"
+        update_lab_feature_families(self.cohort_df, labevents_path, state_dir=state_dir, chunksize=1000)
+        with open(labevents_path, "ab") as labevents_file:
+            labevents_file.writelines(lines[len(lines) // 2:])
+
+        self.assert_same_families(update_lab_feature_families(self.cohort_df, labevents_path, state_dir=state_dir,
+                                                              chunksize=1000))
+        # Nothing appended since
+        self.assert_same_families(update_lab_feature_families(self.cohort_df, labevents_path, state_dir=state_dir,
+                                                              chunksize=1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
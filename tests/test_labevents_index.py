@@ -0,0 +1,90 @@
+from pathlib import Path
+import shutil
+import tempfile
+import unittest
+
+import hosp_fixture  # noqa: F401  (sets DATA_DIR, imported first)
+import numpy as np
+import pandas as pd
+
+from assessment.config import LABEVENTS_PATH
+from assessment.hosp_labevents import create_labsevents_features_chunked
+from assessment.hosp_labevents_index import (
+    HADM_MISSING,
+    build_labevents_index,
+    compute_subject_lab_features,
+    get_subject_labs,
+)
+
+# Smaller than the events of one subject, so a sort block can hold a single subject
+SORT_BLOCK_ROWS = 5
+# Not a divisor of the subject row counts, so chunks split the rows of subjects
+CHUNKSIZE = 777
+
+
+def sorted_subject_events(labevents_path) -> dict:
+    """
+    Dict[subject_id] = events of the subject from a plain read, stable sorted by charttime.
+    """
+    events = pd.read_csv(labevents_path, usecols=['subject_id', 'hadm_id', 'itemid', 'charttime', 'valuenum'])
+    events['charttime'] = pd.to_datetime(events['charttime'])
+    events = events.sort_values(['subject_id', 'charttime'], kind='stable', na_position='first')
+    return {subject_id: rows.reset_index(drop=True) for subject_id, rows in events.groupby('subject_id')}
+
+
+class TestLabEventsIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        hosp_fixture.hosp_tables()
+        cls.cohort_df = hosp_fixture.cohort()
+        cls.tmp_dir = Path(tempfile.mkdtemp())
+        cls.index_dir = build_labevents_index(LABEVENTS_PATH, cls.tmp_dir / "index", chunksize=CHUNKSIZE,
+                                              sort_block_rows=SORT_BLOCK_ROWS)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def assert_same_events(self, labs, expected):
+        np.testing.assert_array_equal(labs['hadm_id'], expected['hadm_id'].fillna(HADM_MISSING).to_numpy('int32'))
+        np.testing.assert_array_equal(labs['itemid'], expected['itemid'].to_numpy('int32'))
+        np.testing.assert_array_equal(labs['charttime'], expected['charttime'].to_numpy('datetime64[ns]'))
+        np.testing.assert_array_equal(labs['valuenum'], expected['valuenum'].to_numpy('float64'))
+
+    def test_subject_rows_match_sorted_read(self):
+        expected = sorted_subject_events(LABEVENTS_PATH)
+        self.assertGreater(max(len(rows) for rows in expected.values()), SORT_BLOCK_ROWS)
+        for subject_id, rows in expected.items():
+            self.assert_same_events(get_subject_labs(subject_id, self.index_dir), rows)
+
+    def test_unknown_subject_has_no_events(self):
+        labs = get_subject_labs(1, self.index_dir)
+        self.assertEqual(len(labs['itemid']), 0)
+
+    def test_subject_features_match_chunked_scan(self):
+        expected = create_labsevents_features_chunked(self.cohort_df, LABEVENTS_PATH).set_index('subject_id')
+        for subject_id in self.cohort_df['subject_id'].unique()[:20]:
+            features = compute_subject_lab_features(subject_id, self.cohort_df, families=['labs_feature_df'],
+                                                    index_dir=self.index_dir)['labs_feature_df']
+            features = features.set_index('subject_id')
+            pd.testing.assert_frame_equal(features, expected.loc[[subject_id], features.columns], check_dtype=False)
+            # Stats of labs the subject has no events of are missing in the full table
+            self.assertTrue(expected.loc[subject_id, expected.columns.difference(features.columns)].isna().all())
+
+    def test_rebuild_replaces_open_index(self):
+        lines = LABEVENTS_PATH.read_bytes().splitlines(keepends=True)
+        labevents_path = self.tmp_dir / "labevents.csv"
+        labevents_path.write_bytes(b"".join(lines[:len(lines) // 2]))
+        index_dir = build_labevents_index(labevents_path, self.tmp_dir / "rebuilt", chunksize=CHUNKSIZE)
+        subject_id = int(pd.read_csv(labevents_path, usecols=['subject_id'])['subject_id'].iloc[-1])
+        get_subject_labs(subject_id, index_dir)
+
+        labevents_path.write_bytes(b"".join(lines))
+        build_labevents_index(labevents_path, index_dir, chunksize=CHUNKSIZE, force=True)
+        self.assert_same_events(get_subject_labs(subject_id, index_dir),
+                                sorted_subject_events(labevents_path)[subject_id])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+from functools import reduce
+from pathlib import Path
+import tempfile
+import unittest
+
+import hosp_fixture  # noqa: F401  (sets DATA_DIR, imported first)
+import numpy as np
+import pandas as pd
+
+from assessment.hosp_agg_processed_features import merge_csvs_in_dir, merge_feature_frames
+from assessment.outputs import OutputWriter
+
+
+def feature_tables() -> dict:
+    """
+    Three feature tables on overlapping, shuffled subjects. hadm_id is in 'diagnosis' and 'labs'.
+    """
+    rng = np.random.default_rng(0)
+
+    def table(subject_ids, **columns):
+        subject_ids = rng.permutation(subject_ids)
+        return pd.DataFrame({'subject_id': subject_ids,
+                             **{col: rng.random(len(subject_ids)) for col in columns}})
+
+    diagnosis = table(np.arange(0, 80), has_sepsis=True, has_ckd=True)
+    diagnosis.insert(1, 'hadm_id', diagnosis['subject_id'] + 1000)
+    meds = table(np.arange(10, 100), on_statin=True)
+    labs = table(np.arange(5, 70), sodium_prior_avg=True)
+    labs.insert(1, 'hadm_id', labs['subject_id'] + 2000)
+    return {'diagnosis': diagnosis, 'meds': meds, 'labs': labs}
+
+
+def merge_reference(frames, on = 'subject_id') -> pd.DataFrame:
+    """
+    The original merge: pd.merge of the tables one after the other.
+    """
+    return reduce(lambda left, right: pd.merge(left, right, on=on, how='inner'), frames)
+
+
+class TestMergeFeatureFrames(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.output_path = Path(self.tmp_dir.name) / "hosp_ttl"
+        self.writer = OutputWriter('csv', background=False)
+        self.tables = feature_tables()
+
+    def merge(self, names, order = None) -> pd.DataFrame:
+        return merge_feature_frames(((name, self.tables[name]) for name in names), order=order,
+                                    output_path=self.output_path, writer=self.writer)
+
+    def test_rows_match_merge(self):
+        tables = [self.tables['diagnosis'], self.tables['meds'], self.tables['labs'].drop(columns='hadm_id')]
+        reference = merge_reference(tables).sort_values('subject_id', ignore_index=True)
+        merged = merge_feature_frames([('diagnosis', tables[0]), ('meds', tables[1]), ('labs', tables[2])],
+                                      output_path=self.output_path, writer=self.writer)
+        pd.testing.assert_frame_equal(merged, reference)
+        self.assertEqual(merged['subject_id'].tolist(), list(range(10, 70)))
+
+    def test_columns_follow_order_whatever_the_arrival(self):
+        order = ['diagnosis', 'meds', 'labs']
+        expected = self.merge(order, order=order)
+        self.assertEqual(list(expected.columns), ['subject_id', 'hadm_id', 'has_sepsis', 'has_ckd',
+                                                  'on_statin', 'sodium_prior_avg'])
+        # hadm_id is owned by diagnosis, the first table of `order`, even when labs arrives first
+        pd.testing.assert_series_equal(expected['hadm_id'], expected['subject_id'] + 1000, check_names=False)
+        arrivals = [['labs', 'meds', 'diagnosis'], ['meds', 'labs', 'diagnosis'], ['labs', 'diagnosis', 'meds']]
+        for arrival in arrivals:
+            with self.subTest(arrival=arrival):
+                pd.testing.assert_frame_equal(self.merge(arrival, order=order), expected)
+
+    def test_arrival_order_without_order(self):
+        merged = self.merge(['labs', 'diagnosis', 'meds'])
+        self.assertEqual(list(merged.columns), ['subject_id', 'hadm_id', 'sodium_prior_avg', 'has_sepsis',
+                                                'has_ckd', 'on_statin'])
+        pd.testing.assert_series_equal(merged['hadm_id'], merged['subject_id'] + 2000, check_names=False)
+
+    def test_several_rows_per_key(self):
+        meds = self.tables['meds']
+        with self.assertRaises(ValueError):
+            merge_feature_frames([('meds', pd.concat([meds, meds.head(1)]))], output_path=self.output_path,
+                                 writer=self.writer)
+
+    def test_no_tables(self):
+        with self.assertRaises(ValueError):
+            merge_feature_frames([], output_path=self.output_path, writer=self.writer)
+
+
+class TestMergeCsvsInDir(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.dir_path = Path(self.tmp_dir.name) / "hosp"
+        self.dir_path.mkdir()
+        self.output_path = Path(self.tmp_dir.name) / "hosp_ttl"
+        self.writer = OutputWriter('csv', background=False)
+
+    def merge(self) -> pd.DataFrame:
+        return merge_csvs_in_dir(self.dir_path, output_path=self.output_path, writer=self.writer)
+
+    def test_matches_merge_of_files(self):
+        tables = feature_tables()
+        tables['labs'] = tables['labs'].drop(columns='hadm_id')
+        for format, (name, df) in zip(['csv', 'parquet', 'csv'], tables.items()):
+            OutputWriter(format, background=False).write(df, self.dir_path / name)
+        merged = self.merge()
+        # Files are merged in name order: diagnosis, labs, meds
+        reference = merge_reference([tables[name] for name in sorted(tables)])
+        reference = reference.sort_values('subject_id', ignore_index=True)
+        pd.testing.assert_frame_equal(merged, reference)
+
+    def test_column_from_first_file(self):
+        tables = feature_tables()
+        for name, df in tables.items():
+            OutputWriter('csv', background=False).write(df, self.dir_path / name)
+        merged = self.merge()
+        self.assertEqual(list(merged.columns), ['subject_id', 'hadm_id', 'has_sepsis', 'has_ckd',
+                                                'sodium_prior_avg', 'on_statin'])
+        pd.testing.assert_series_equal(merged['hadm_id'], merged['subject_id'] + 1000, check_names=False)
+
+    def test_empty_dir(self):
+        with self.assertRaises(ValueError):
+            self.merge()
+
+
+if __name__ == '__main__':
+    unittest.main()
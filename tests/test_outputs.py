@@ -0,0 +1,109 @@
+from pathlib import Path
+import tempfile
+import unittest
+
+import hosp_fixture  # noqa: F401  (sets DATA_DIR, imported first)
+import numpy as np
+import pandas as pd
+
+from assessment.outputs import (
+    OutputWriter,
+    output_columns,
+    output_format,
+    output_path,
+    read_output,
+)
+
+
+def feature_frame() -> pd.DataFrame:
+    return pd.DataFrame({
+        'subject_id': np.arange(10000000, 10000005),
+        'count_prior_admissions': [0, 1, 2, 3, 4],
+        'sodium_prior_avg': [140.5, np.nan, 135.25, 138.0, 141.0],
+        'admittime': pd.to_datetime(['2150-01-01 10:00:00', None, '2151-02-03 04:05:06',
+                                     '2152-01-01 00:00:00', '2153-01-01 00:00:00']),
+        # Missing locations filled with 0, a column mixing text and numbers
+        'admission_location': pd.Series(['EMERGENCY ROOM', 0, 'CLINIC REFERRAL', 0, 'WALK-IN/SELF REFERRAL'],
+                                        dtype='category'),
+    })
+
+
+class TestOutputPaths(unittest.TestCase):
+
+    def test_suffixes(self):
+        self.assertEqual(output_path('data/hosp_ttl', 'parquet'), Path('data/hosp_ttl.parquet'))
+        self.assertEqual(output_path('data/hosp_ttl.csv', 'feather'), Path('data/hosp_ttl.feather'))
+        self.assertEqual(output_path('data/hosp_ttl', 'csv', 'gzip'), Path('data/hosp_ttl.csv.gz'))
+        self.assertEqual(output_path('data/hosp_ttl.csv.gz', 'csv'), Path('data/hosp_ttl.csv'))
+
+    def test_format_from_suffix(self):
+        self.assertEqual(output_format('hosp_ttl.csv.zst'), 'csv')
+        self.assertEqual(output_format('hosp_ttl.parquet'), 'parquet')
+        self.assertIsNone(output_format('hosp_ttl.parquet.dtypes.json'))
+
+
+class TestOutputWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.path = Path(self.tmp_dir.name) / "hosp" / "features"
+
+    def assert_round_trip(self, format, compression = None):
+        df = feature_frame()
+        with OutputWriter(format, compression) as writer:
+            path = writer.write(df, self.path)
+        self.assertEqual(path, output_path(self.path, format, compression))
+        self.assertEqual(output_columns(path), list(df.columns))
+
+        saved = read_output(path)
+        pd.testing.assert_frame_equal(saved.drop(columns=['admittime', 'admission_location']),
+                                      df.drop(columns=['admittime', 'admission_location']))
+        pd.testing.assert_series_equal(pd.to_datetime(saved['admittime']).astype('datetime64[ns]'), df['admittime'])
+        self.assertEqual(saved['admission_location'].astype(str).tolist(),
+                         df['admission_location'].astype(str).tolist())
+
+    def test_csv(self):
+        self.assert_round_trip('csv')
+
+    def test_compressed_csv(self):
+        self.assert_round_trip('csv', 'gzip')
+
+    def test_parquet(self):
+        self.assert_round_trip('parquet')
+
+    def test_feather(self):
+        self.assert_round_trip('feather', 'zstd')
+
+    def test_background_writes_keep_their_order(self):
+        with OutputWriter('csv', queue_size=1) as writer:
+            for i in range(5):
+                writer.write(pd.DataFrame({'write': [i]}), self.path)
+        self.assertEqual(read_output(output_path(self.path, 'csv'))['write'].item(), 4)
+
+    def test_custom_save(self):
+        def save(df, path):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            df.assign(saved=True).to_csv(path, index=False)
+
+        with OutputWriter('csv') as writer:
+            path = writer.write(pd.DataFrame({'x': [1]}), self.path, save=save)
+        self.assertTrue(read_output(path)['saved'].item())
+
+    def test_failed_write_is_raised(self):
+        def save(df, path):
+            raise OSError("disk full")
+
+        writer = OutputWriter('csv')
+        writer.write(pd.DataFrame({'x': [1]}), self.path, save=save)
+        with self.assertRaises(OSError):
+            writer.flush()
+        writer.close()
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            OutputWriter('xlsx')
+
+
+if __name__ == '__main__':
+    unittest.main()
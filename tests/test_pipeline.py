@@ -0,0 +1,126 @@
+from functools import partial
+from pathlib import Path
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import hosp_fixture  # noqa: F401  (sets DATA_DIR, imported first)
+import pandas as pd
+
+from assessment import config
+from assessment.outputs import OutputWriter, read_output
+from assessment.pipeline import Stage, run_stages, stage_cpu_budget
+from assessment.stage_cache import StageCache, stage_key, value_digest
+
+# Names of the stage functions called in this process
+CALLS = []
+
+
+def double_stage(values):
+    CALLS.append('double')
+    return {'doubled': values * 2}
+
+
+def total_stage(doubled):
+    CALLS.append('total')
+    return {'total': pd.DataFrame({'x': [doubled['x'].sum()]})}
+
+
+def broken_stage(values):
+    return {}
+
+
+def budget_stage(name, values):
+    return {name: stage_cpu_budget()}
+
+
+class TestRunStages(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        self.cache = StageCache(self.tmp_dir / "stage_cache")
+        self.stages = [
+            Stage('total', total_stage, ['doubled'], ['total']),
+            Stage('double', double_stage, ['values'], ['doubled'], artifacts={'doubled': self.tmp_dir / "doubled"}),
+        ]
+        self.values = pd.DataFrame({'x': [1, 2, 3]})
+        CALLS.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def run_stages(self, values = None, max_workers = 1, writer = None) -> dict:
+        values = self.values if values is None else values
+        results = run_stages(self.stages, {'values': values}, max_workers=max_workers, cache=self.cache,
+                             writer=writer)
+        return {stage.name: outputs for stage, outputs in results}
+
+    def test_dependency_order(self):
+        outputs = self.run_stages()
+        self.assertEqual(list(outputs), ['double', 'total'])
+        self.assertEqual(outputs['total']['total']['x'].item(), 12)
+
+    def test_process_pool(self):
+        serial = self.run_stages()
+        shutil.rmtree(self.tmp_dir / "stage_cache")
+        pooled = self.run_stages(max_workers=2)
+        for name, outputs in serial.items():
+            for output, value in outputs.items():
+                pd.testing.assert_frame_equal(pooled[name][output], value)
+
+    def test_cache_hit(self):
+        first = self.run_stages()
+        CALLS.clear()
+        second = self.run_stages()
+        self.assertEqual(CALLS, [])
+        pd.testing.assert_frame_equal(second['total']['total'], first['total']['total'])
+
+    def test_cache_miss_on_changed_input(self):
+        self.run_stages()
+        CALLS.clear()
+        outputs = self.run_stages(values=pd.DataFrame({'x': [1, 2, 4]}))
+        self.assertEqual(CALLS, ['double', 'total'])
+        self.assertEqual(outputs['total']['total']['x'].item(), 14)
+
+    def test_cache_key_follows_shared_config(self):
+        stage = self.stages[1]
+        digests = {'values': value_digest(self.values)}
+        key = stage_key(stage, digests)
+        self.assertEqual(stage_key(stage, digests), key)
+        with mock.patch.object(config, 'MIMIC_DATETIME_FORMAT', '%Y-%m-%dT%H:%M:%S'):
+            self.assertNotEqual(stage_key(stage, digests), key)
+
+    def test_cache_hit_writes_missing_artifacts(self):
+        with OutputWriter(format='csv') as writer:
+            self.run_stages(writer=writer)
+        artifact = self.tmp_dir / "doubled.csv"
+        artifact.unlink()
+
+        CALLS.clear()
+        for format in ('csv', 'parquet'):
+            with OutputWriter(format=format) as writer:
+                self.run_stages(writer=writer)
+            path = writer.path_for(self.tmp_dir / "doubled")
+            pd.testing.assert_frame_equal(read_output(path), self.values * 2)
+        self.assertEqual(CALLS, [])
+
+    def test_stage_cpu_budget(self):
+        stages = [Stage(name, partial(budget_stage, name), ['values'], [name], cpu_budget=cpu_budget)
+                  for name, cpu_budget in [('shared', None), ('own', 6), ('capped', 16)]]
+        with mock.patch('assessment.pipeline.os.cpu_count', return_value=8):
+            pooled = {stage.name: outputs[stage.name]
+                      for stage, outputs in run_stages(stages, {'values': self.values}, max_workers=2)}
+        self.assertEqual(pooled, {'shared': 4, 'own': 6, 'capped': 8})
+
+    def test_missing_output(self):
+        with self.assertRaises(ValueError):
+            list(run_stages([Stage('broken', broken_stage, ['values'], ['result'])], {'values': self.values}))
+
+    def test_missing_input(self):
+        with self.assertRaises(ValueError):
+            list(run_stages(self.stages, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import hosp_fixture  # noqa: F401  (sets DATA_DIR, imported first)
+import pandas as pd
+
+from assessment.config import LABEVENTS_PATH
+from assessment.datasets import iter_labevents_chunks
+from assessment.pipeline import Stage, run_stages
+from assessment.profiling import RunReport, profile_block, profiled, record_chunk
+
+RECORD_KEYS = {'name', 'pid', 'started_at', 'rows_in', 'rows_out', 'steps', 'wall_s', 'cpu_s',
+               'cpu_children_s', 'peak_rss_mb', 'peak_rss_increase_mb', 'bytes_read', 'chunks', 'chunk_rows',
+               'chunks_per_s', 'chunk_rows_per_s'}
+
+
+@profiled
+def head_rows(df, n = 2):
+    return df.head(n)
+
+
+def double_stage(values):
+    return {'doubled': head_rows(values * 2, n=3)}
+
+
+class TestProfileBlock(unittest.TestCase):
+
+    def test_record(self):
+        df = pd.DataFrame({'x': range(10)})
+        with profile_block('block', rows_in=len(df)) as record:
+            record['rows_out'] = len(df) // 2
+        self.assertEqual(set(record), RECORD_KEYS)
+        self.assertEqual((record['name'], record['pid']), ('block', os.getpid()))
+        self.assertEqual((record['rows_in'], record['rows_out'], record['steps']), (10, 5, []))
+        self.assertGreaterEqual(record['wall_s'], 0)
+        self.assertNotIn('cprofile', record)
+
+    def test_chunks_accumulate_in_enclosing_blocks(self):
+        with profile_block('outer') as outer:
+            record_chunk(5)
+            with profile_block('inner') as inner:
+                record_chunk(7)
+                record_chunk(8)
+            record_chunk(1)
+        self.assertEqual((inner['chunks'], inner['chunk_rows']), (2, 15))
+        self.assertEqual((outer['chunks'], outer['chunk_rows']), (4, 21))
+        self.assertEqual(outer['steps'], [inner])
+
+    def test_chunk_readers_count_their_rows(self):
+        hosp_fixture.hosp_tables()
+        with profile_block('scan') as record:
+            for _ in iter_labevents_chunks(LABEVENTS_PATH, engine='pandas', chunksize=5000):
+                pass
+        n_rows = len(pd.read_csv(LABEVENTS_PATH, usecols=['subject_id']))
+        self.assertEqual(record['chunk_rows'], n_rows)
+        self.assertEqual(record['chunks'], -(-n_rows // 5000))
+
+    def test_profiled_is_a_step(self):
+        df = pd.DataFrame({'x': range(10)})
+        with profile_block('block') as record:
+            result = head_rows(df, n=4)
+        self.assertEqual(len(result), 4)
+        [step] = record['steps']
+        self.assertEqual(set(step), RECORD_KEYS)
+        self.assertEqual((step['name'], step['rows_in'], step['rows_out']), ('head_rows', 10, 4))
+
+    def test_cprofile_of_outermost_block_only(self):
+        with tempfile.TemporaryDirectory() as profile_dir:
+            with profile_block('outer', profile_dir=profile_dir) as outer:
+                with profile_block('inner', profile_dir=profile_dir) as inner:
+                    pass
+            self.assertEqual(outer['cprofile'], str(Path(profile_dir) / "outer.prof"))
+            self.assertTrue(Path(outer['cprofile']).exists())
+            self.assertNotIn('cprofile', inner)
+
+
+class TestRunReport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.reports_dir = Path(self.tmp_dir.name) / "reports"
+        self.stages = [Stage('double', double_stage, ['values'], ['doubled'])]
+        self.values = pd.DataFrame({'x': range(6)})
+
+    def run_report(self, cprofile) -> dict:
+        report = RunReport('test', reports_dir=self.reports_dir, cprofile=cprofile)
+        with report.block('load', rows_in=6) as record:
+            record['rows_out'] = 6
+        list(run_stages(self.stages, {'values': self.values}, max_workers=1, report=report))
+        report_path = report.save()
+        self.assertEqual(report_path, self.reports_dir / f"test_{report.run_id}.json")
+        return json.loads(report_path.read_text())
+
+    def test_report_is_written(self):
+        saved = self.run_report(cprofile=False)
+        self.assertEqual(saved['run'], 'test')
+        self.assertEqual([stage['name'] for stage in saved['stages']], ['load', 'double'])
+        load, double = saved['stages']
+        self.assertEqual(set(load), RECORD_KEYS)
+        self.assertEqual(set(double), RECORD_KEYS | {'cached'})
+        self.assertEqual((double['rows_in'], double['rows_out']), (6, 3))
+        self.assertEqual([step['name'] for step in double['steps']], ['head_rows'])
+
+    def test_cprofile_stats_of_stages(self):
+        saved = self.run_report(cprofile=True)
+        double = saved['stages'][1]
+        self.assertTrue(Path(double['cprofile']).exists())
+        self.assertEqual(Path(double['cprofile']).parent.parent, self.reports_dir)
+
+    def test_no_cprofile(self):
+        saved = self.run_report(cprofile=False)
+        self.assertNotIn('cprofile', saved['stages'][1])
+        report_path = self.reports_dir / f"test_{saved['run_id']}.json"
+        self.assertEqual(list(self.reports_dir.iterdir()), [report_path])
+
+    def test_cprofile_env(self):
+        # PROFILE_CPROFILE is read once, when the config is imported
+        for value, expected in [('0', 'False'), ('1', 'True'), ('', 'False')]:
+            with self.subTest(value=value):
+                env = {**os.environ, 'PROFILE_CPROFILE': value}
+                out = subprocess.run([sys.executable, '-c', 'from assessment.config import PROFILE_CPROFILE; '
+                                      'print(PROFILE_CPROFILE)'], env=env, capture_output=True, text=True,
+                                     check=True, cwd=Path(__file__).resolve().parents[1])
+                self.assertEqual(out.stdout.strip().splitlines()[-1], expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+
+import hosp_fixture  # noqa: F401  (sets DATA_DIR, imported first)
+import numpy as np
+import pandas as pd
+
+from assessment.config import MIMIC_DATETIME_FORMAT
+from assessment.timestamps import TimestampParser, parse_dates, parse_timestamps
+
+
+def to_datetime(values) -> pd.Series:
+    """
+    Reference parse: the MIMIC layout, ISO 8601 for other layouts, NaT when neither parses.
+    """
+    values = pd.Series(values, dtype=object)
+    parsed = pd.to_datetime(values, format=MIMIC_DATETIME_FORMAT, errors='coerce')
+    return parsed.fillna(pd.to_datetime(values.where(parsed.isna()), format='ISO8601', errors='coerce'))
+
+
+def timestamp_strings(n, n_distinct, seed = 0) -> pd.Series:
+    rng = np.random.default_rng(seed)
+    times = pd.Timestamp('2150-01-01') + pd.to_timedelta(rng.integers(0, 10**8, n_distinct), unit='s')
+    return pd.Series(times.strftime(MIMIC_DATETIME_FORMAT)[rng.integers(0, n_distinct, n)])
+
+
+class TestParseTimestamps(unittest.TestCase):
+
+    def assert_parsed(self, actual, values):
+        pd.testing.assert_series_equal(actual, to_datetime(values).astype('datetime64[ns]'), check_names=False,
+                                       check_index=False)
+
+    def test_mimic_layout_with_missing_and_bad_values(self):
+        values = pd.Series(['2150-01-01 10:00:00', None, '2150-01-01 10:00:00', 'not a time', np.nan,
+                            '2180-12-31 23:59:59'])
+        self.assert_parsed(parse_timestamps(values), values)
+
+    def test_other_layouts_fall_back_to_iso(self):
+        values = pd.Series(['2150-01-01T10:00:00', '2150-01-01', '2150-01-01 10:00'])
+        self.assert_parsed(parse_timestamps(values), values)
+
+    def test_index_and_name_are_kept(self):
+        values = pd.Series(['2150-01-01 10:00:00'] * 3, index=[7, 3, 5], name='charttime')
+        parsed = parse_timestamps(values)
+        self.assertEqual(list(parsed.index), [7, 3, 5])
+        self.assertEqual(parsed.name, 'charttime')
+
+    def test_parsed_values_are_returned_as_they_are(self):
+        values = pd.Series(pd.to_datetime(['2150-01-01 10:00:00', None]))
+        self.assertIs(parse_timestamps(values), values)
+
+    def test_dates(self):
+        values = pd.Series(['2150-01-01', None, '2151-02-28'])
+        pd.testing.assert_series_equal(parse_dates(values), pd.to_datetime(values).astype('datetime64[ns]'))
+
+    def test_repeated_chunks_through_bounded_cache(self):
+        parser = TimestampParser(max_size=2000)
+        # Three sets of 800 distinct strings, more than the cache holds
+        for call in range(40):
+            values = timestamp_strings(5000, 800, seed=call % 3)
+            self.assert_parsed(parser.parse(values), values)
+        self.assertGreater(parser.hits, 0)
+        self.assertLessEqual(len(parser._keys), parser.max_size)
+
+    def test_mostly_distinct_values(self):
+        parser = TimestampParser(max_size=1000)
+        values = timestamp_strings(5000, 10**6)
+        self.assert_parsed(parser.parse(values), values)
+        self.assertEqual(len(parser), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()